@@ -25,6 +25,7 @@
 
 
 #include <stdio.h>
+#include <string.h>
 #include <strings.h>
 #include <stdlib.h>
 #include <math.h>
@@ -519,12 +520,42 @@ char** read_variants_file(char *variants_file) {
   return include_variants;
 }
 
-int check_include_variants(bcf1_t *line, char** include_variants, char* variant) {
+int find_variant(char **variants, int num_variants, char *id) {
+  int i;
+  for(i=0; i<num_variants; i++) {
+    if(strcmp(variants[i], id) == 0) return i;
+  }
+  return -1;
+}
+
+char** split_variants(char *variant, int *num_variants) {
+  // -v takes one variant, or a comma-separated list of variants
+  int n = 1;
+  char *c;
+  for(c=variant; *c; c++) {
+    if(*c == ',') n++;
+  }
+
+  char **variants = (char **)malloc(sizeof(char*)*n);
+  if (variants==NULL) {
+    fprintf(stderr, "Out of memory.\n");
+    exit(SYSTEM_ERROR);
+  }
+
+  *num_variants = 0;
+  char *token;
+  for(token = strtok(variant, ","); token; token = strtok(NULL, ",")) {
+    variants[(*num_variants)++] = token;
+  }
+  return variants;
+}
+
+int check_include_variants(bcf1_t *line, char** include_variants, char **variants, int num_variants) {
   bcf_unpack(line, 1);
   char * id = line->d.id;      
 
-  // could be the variant given with -v
-  if(variant && strcmp(id, variant) == 0) return 1;
+  // could be a variant given with -v
+  if(find_variant(variants, num_variants, id) >= 0) return 1;
 
   // or could be in the file given
   int i;
@@ -544,6 +575,8 @@ int main(int argc, char *argv[]) {
   char *samples_list = NULL;
   char *variants_file;
   char *variant = NULL;
+  char **variants = NULL;
+  int num_variants = 0;
   int numfiles = 0;
   int numregions = 0;
   int windowsize = WINDOW_SIZE;
@@ -640,6 +673,21 @@ int main(int argc, char *argv[]) {
     windowsize = 1000000000;
   }
 
+  // variants of interest, the window around each is computed separately
+  int *variant_indices = NULL;
+  if(variant) {
+    variants = split_variants(variant, &num_variants);
+    variant_indices = (int *)malloc(sizeof(int)*num_variants);
+    if (variant_indices==NULL) {
+      fprintf(stderr, "Out of memory.\n");
+      exit(SYSTEM_ERROR);
+    }
+    int i;
+    for(i=0; i<num_variants; i++) {
+      variant_indices[i] = -1;
+    }
+  }
+
   // variant list in file
   char **include_variants = NULL;
   int have_include_variants = 0;
@@ -730,18 +778,22 @@ int main(int argc, char *argv[]) {
         if(vcf_parse(&str, hdr, line) == 0) {
 
           // check include_variants
-          if(have_include_variants && check_include_variants(line, include_variants, variant) == 0) 
+          if(have_include_variants && check_include_variants(line, include_variants, variants, num_variants) == 0) 
             continue;
 
           position = line->pos + (2 - bcf_is_snp(line));
-	  if (windowsize && variant_index > 0 && abs(position - locus_list.locus[variant_index].position) > windowsize)
+	  if (windowsize && num_variants == 1 && variant_index > 0 && abs(position - locus_list.locus[variant_index].position) > windowsize)
 	    continue;
 
           if (get_genotypes(&locus_list, hdr, line, position)) {
             if (!variant) {
               process_window(&locus_list, windowsize, fh, position, exhaustive);
-            } else if (!strcmp(variant, locus_list.locus[locus_list.tail].var_id)) {
-              variant_index = locus_list.tail;
+            } else {
+              int i = find_variant(variants, num_variants, locus_list.locus[locus_list.tail].var_id);
+              if (i >= 0) {
+                variant_indices[i] = locus_list.tail;
+                variant_index = variant_indices[0];
+              }
             }
           }
         }
@@ -772,18 +824,22 @@ int main(int argc, char *argv[]) {
 
       while(bcf_itr_next(htsfile, itr, line) >= 0) {
         // check include_variants
-        if(have_include_variants && check_include_variants(line, include_variants, variant) == 0) 
+        if(have_include_variants && check_include_variants(line, include_variants, variants, num_variants) == 0) 
           continue;
 
         position = line->pos + (2 - bcf_is_snp(line));
-        if (windowsize && variant_index > 0 && abs(position - locus_list.locus[variant_index].position) > windowsize)
+        if (windowsize && num_variants == 1 && variant_index > 0 && abs(position - locus_list.locus[variant_index].position) > windowsize)
 	  continue;
 
         if (get_genotypes(&locus_list, hdr, line, position)) {
           if (!variant) {
             process_window(&locus_list, windowsize, fh, position, exhaustive);
-          } else if (!strcmp(variant, locus_list.locus[locus_list.tail].var_id)) {
-            variant_index = locus_list.tail;
+          } else {
+            int i = find_variant(variants, num_variants, locus_list.locus[locus_list.tail].var_id);
+            if (i >= 0) {
+              variant_indices[i] = locus_list.tail;
+              variant_index = variant_indices[0];
+            }
           }
         }
       }
@@ -808,9 +864,13 @@ int main(int argc, char *argv[]) {
   if (!variant) {
     // process any remaining buffer
     process_window(&locus_list, 0, fh, position, exhaustive);
-  } else if (variant_index >= 0) {
-    // Compute LD around variant of interest
-    calculate_ld(&locus_list, fh, windowsize, variant_index, exhaustive);
+  } else {
+    // Compute LD around each variant of interest
+    int i;
+    for(i=0; i<num_variants; i++) {
+      if (variant_indices[i] >= 0)
+        calculate_ld(&locus_list, fh, windowsize, variant_indices[i], exhaustive);
+    }
   }
   return 0;
 }
@@ -44,6 +44,8 @@ import postgap.Reg
 import postgap.EFO
 import postgap.Globals
 import postgap.Integration
+import postgap.REST
+import postgap.Liftover
 from postgap.Utils import *
 import os.path
 
@@ -54,6 +56,7 @@ from pprint import pformat
 r2_cache = collections.defaultdict(dict)
 r2_sets = set()
 GRCh38_snp_locations= dict()
+GRCh38_genes = dict()
 known_chroms = map(str, range(1,23)) + ['X','Y']
 
 def main():
@@ -109,8 +112,10 @@ def main():
 
 	if options.child_terms:
 		# Expand list of EFOs to children, concatenate, remove duplicates
-		expanded_efo_iris = efo_iris + concatenate(map(postgap.EFO.children, efo_iris))
+		efo_children = dict((efo_iri, postgap.EFO.children(efo_iri)) for efo_iri in efo_iris)
+		expanded_efo_iris = efo_iris + concatenate(efo_children[efo_iri] for efo_iri in efo_iris)
 	else:
+		efo_children = dict((efo_iri, []) for efo_iri in efo_iris)
 		expanded_efo_iris = efo_iris
 
 	if options.GWAS is not None:
@@ -122,7 +127,21 @@ def main():
 	if options.Reg is not None:
 		postgap.Globals.Reg_adaptors = options.Reg
 
-	if len(options.diseases) > 0 or len(expanded_efo_iris) > 0 or postgap.Globals.GWAS_SUMMARY_STATS_FILE is not None:
+	if options.separate_efos and len(efo_iris) > 0:
+		# One query per EFO term and its children, plus one for the disease descriptions,
+		# all served by a single pass over each GWAS database
+		queries = collections.OrderedDict((efo_iri, ([], [efo_iri] + (efo_children[efo_iri] or []))) for efo_iri in efo_iris)
+		if options.efos is not None and len(options.diseases) > 0:
+			queries[None] = (options.diseases, [])
+		logging.info("Starting diseases_to_genes_many for %i queries" % len(queries))
+		res_by_query = postgap.Integration.diseases_to_genes_many(queries, options.population, options.tissues)
+		res = concatenate(res_by_query[query_id] for query_id in queries)
+		if options.bayesian and options.output2 is not None:
+			output2 = open(options.output2, "w")
+			output2.write(pretty_gene_output(res))
+			output2.close()
+		logging.info("Done with diseases_to_genes_many")
+	elif len(options.diseases) > 0 or len(expanded_efo_iris) > 0 or postgap.Globals.GWAS_SUMMARY_STATS_FILE is not None:
 		logging.info("Starting diseases_to_genes")
 		res = postgap.Integration.diseases_to_genes(options.diseases, expanded_efo_iris, options.population, options.tissues)
 		if options.bayesian and options.output2 is not None:
@@ -156,6 +175,8 @@ def main():
 
 	output.write(formatted_results + "\n")
 
+	postgap.REST.log_connection_statistics()
+
 commandline_description = """
     Search GWAS/Regulatory/Cis-regulatory databases for causal genes. 
 
@@ -292,7 +313,7 @@ def get_options():
     """
     parser = argparse.ArgumentParser(description=commandline_description, formatter_class = RawTextHelpFormatter)
 
-    GWAS_options = ["GWAS_Catalog", "GRASP", "Phewas_Catalog", "GWAS_DB"]
+    GWAS_options = ["GWAS_Catalog", "GWAS_Catalog_File", "GRASP", "Phewas_Catalog", "GWAS_DB"]
     CisReg_options = ["GTEx", "VEP", "Fantom5", "DHS", "PCHiC", "Nearest"]
     Reg_options = ["Regulome", "VEP_reg"]
 
@@ -308,15 +329,33 @@ def get_options():
     parser.add_argument('--debug', '-g', action = 'store_true', help='Debug mode')
     parser.add_argument('--json_output', '-j', action = 'store_true', help='JSON output')
     parser.add_argument('--child_terms', action = 'store_true', help='Search for children terms of selected phenotype ontology term(s)')
+    parser.add_argument('--separate_efos', action = 'store_true', help='Run each phenotype ontology term (with its children, with --child_terms) as a separate query, scanning the GWAS databases once for all of them')
     parser.add_argument('--GWAS', default=None, nargs='*', choices=(GWAS_options), help='GWAS databases to query')
     parser.add_argument('--Cisreg', default=None, nargs='*', choices=(CisReg_options), help='Cisregulatory databases to query')
     parser.add_argument('--Reg', default=None, nargs='*', choices=(Reg_options), help='Regulatory databases to query')
     parser.add_argument('--bayesian', action = 'store_true', help='EXPERIMENTAL')
     parser.add_argument('--work_dir', default = 'postgap_temp_work_dir', help='Working directory for output file')
     parser.add_argument('--summary_stats', help='Location of input summary statistics file')
+    parser.add_argument('--summary_stats_columns', nargs='*', default=[], metavar='NAME=LABEL', help='Labels of the summary statistics columns, e.g. variant_id=MarkerName p-value=Pvalue beta=Beta')
+    parser.add_argument('--clump_window', type=int, default=500000, help='Width of the window around each lead SNP when clumping summary statistics SNPs (bp)')
+    parser.add_argument('--clump_r2', type=float, default=0.7, help='r2 above which summary statistics SNPs are clumped with a lead SNP')
     parser.add_argument('--hdf5',help='Location of eQTL HDF5 file')
     parser.add_argument('--sqlite',help='Location of eQTL sqlite file')
     parser.add_argument('--output2', help='gene-cluster association output file')
+    parser.add_argument('--rest_cache', help='SQLite file in which REST responses are cached across runs')
+    parser.add_argument('--rest_cache_size', type=int, default=1024, help='Maximum size of the REST cache in MB')
+    parser.add_argument('--rest_pool_size', type=int, default=10, help='Maximum number of keep-alive connections per REST server')
+    parser.add_argument('--rest_max_in_flight', type=int, default=10, help='Maximum number of concurrent REST queries')
+    parser.add_argument('--rest_max_retries', type=int, default=10, help='Maximum number of attempts for each REST query')
+    parser.add_argument('--rest_retry_budget', type=int, default=1000, help='Maximum number of REST retries per hour, over all servers')
+    parser.add_argument('--lookup_snapshot', help='SQLite file in which gene and SNP lookups are kept across runs (default: ensembl_lookups.sqlite in the working directory)')
+    parser.add_argument('--index_dir', help='Directory in which the indexes of the database files are written when the databases directory is not writable (default: flat_file_indexes in the working directory)')
+    parser.add_argument('--rest_record', help='Directory in which all REST responses are saved as fixtures')
+    parser.add_argument('--rest_replay', help='Directory of REST fixtures to answer queries from, without network access')
+    parser.add_argument('--rest_replay_latency', type=float, default=0, help='Delay added to each replayed REST response (seconds)')
+    parser.add_argument('--rest_replay_error_rate', type=float, default=0, help='Fraction of replayed REST responses replaced by errors')
+    parser.add_argument('--rest_replay_seed', type=int, default=0, help='Seed of the replayed REST errors')
+    parser.add_argument('--gwas_catalog_threads', type=int, default=1, help='Number of concurrent GWAS Catalog REST queries')
     if len(sys.argv) == 1:
 	    print commandline_description
 	    sys.exit(0)
@@ -331,7 +370,44 @@ def get_options():
 	logging.getLogger().setLevel(logging.ERROR)
 
     postgap.Globals.GWAS_SUMMARY_STATS_FILE = options.summary_stats
+    if options.separate_efos and options.summary_stats is not None:
+        parser.error("--separate_efos cannot be used with --summary_stats")
+    for column in options.summary_stats_columns:
+        if '=' not in column:
+            parser.error("--summary_stats_columns expects NAME=LABEL, got %s" % column)
+        name, label = column.split('=', 1)
+        if name not in postgap.Globals.SUMMARY_STATS_COLUMNS:
+            parser.error("Unknown summary statistics column %s, valid names are: %s" % (name, ", ".join(sorted(postgap.Globals.SUMMARY_STATS_COLUMNS))))
+        if label == '':
+            parser.error("--summary_stats_columns has no label for %s" % name)
+        postgap.Globals.SUMMARY_STATS_COLUMNS[name] = label
+    if options.clump_window <= 0:
+        parser.error("--clump_window must be positive")
+    if not 0 <= options.clump_r2 <= 1:
+        parser.error("--clump_r2 must be between 0 and 1")
+    postgap.Globals.CLUMP_WINDOW = options.clump_window
+    postgap.Globals.CLUMP_R2 = options.clump_r2
     postgap.Globals.PERFORM_BAYESIAN = options.bayesian
+    postgap.Globals.REST_CACHE_FILE = options.rest_cache
+    postgap.Globals.REST_CACHE_MAX_SIZE = options.rest_cache_size * 1024 * 1024
+    postgap.Globals.REST_POOL_SIZE = options.rest_pool_size
+    postgap.Globals.REST_MAX_IN_FLIGHT = options.rest_max_in_flight
+    postgap.Globals.REST_MAX_RETRIES = options.rest_max_retries
+    postgap.Globals.REST_RETRY_BUDGET = options.rest_retry_budget
+    if options.lookup_snapshot is not None:
+        postgap.Globals.LOOKUP_SNAPSHOT_FILE = options.lookup_snapshot
+    else:
+        postgap.Globals.LOOKUP_SNAPSHOT_FILE = os.path.join(options.work_dir, "ensembl_lookups.sqlite")
+    if options.index_dir is not None:
+        postgap.Globals.INDEX_CACHE_DIR = options.index_dir
+    else:
+        postgap.Globals.INDEX_CACHE_DIR = os.path.join(options.work_dir, "flat_file_indexes")
+    postgap.Globals.REST_RECORD_DIR = options.rest_record
+    postgap.Globals.REST_REPLAY_DIR = options.rest_replay
+    postgap.Globals.REST_REPLAY_LATENCY = options.rest_replay_latency
+    postgap.Globals.REST_REPLAY_ERROR_RATE = options.rest_replay_error_rate
+    postgap.Globals.REST_REPLAY_SEED = options.rest_replay_seed
+    postgap.Globals.GWAS_CATALOG_THREADS = options.gwas_catalog_threads
     
     if options.efos is not None:
         postgap.Globals.work_directory = options.work_dir + "/" + "_".join(options.efos)
@@ -348,7 +424,6 @@ def get_options():
     	assert options.rsID is None or (options.efos is None and options.diseases is None)
     	assert options.rsID is not None or options.efos is not None or options.diseases is not None or options.coords is not None
     
-    import os
     assert os.path.isdir(postgap.Globals.DATABASES_DIR), "--database_dir parameter " + options.databases + " does not point to an existing directory!"
     assert os.path.exists(postgap.Globals.DATABASES_DIR + "/GRASP.txt"), "Can't find GRASP.txt in " + options.databases
 
@@ -432,6 +507,12 @@ def pretty_output(associations, population):
 	if postgap.Globals.PERFORM_BAYESIAN: 
 		column_names += [tissue_name + "_CLPP" for tissue_name in postgap.Globals.ALL_TISSUES]
 	header = "\t".join(column_names).encode('utf-8')
+	if postgap.Liftover.available():
+		# Convert all LD SNPs in one batch
+		for snp in postgap.Liftover.lift_snps(set(snp for association in associations for snp in association.cluster.ld_snps if snp.rsID not in GRCh38_snp_locations)):
+			GRCh38_snp_locations[snp.rsID] = snp
+	else:
+		postgap.Ensembl_lookup.prefetch_genes([association.gene.id for association in associations], postgap.Ensembl_lookup.GRCH38_ENSEMBL_REST_SERVER)
 	content = filter(lambda X: len(X) > 0, [pretty_cluster_association(association, population) for association in associations])
 	return "\n".join([header] + content)
 
@@ -473,7 +554,7 @@ def genecluster_association_table(association, population):
 							r2_cache[SNPA][SNPB] = r_matrix.item((r_index[SNPA], r_index[SNPB]))**2
 					break
 
-	GRCh38_gene = postgap.Ensembl_lookup.get_ensembl_gene(association.gene.id, postgap.Ensembl_lookup.GRCH38_ENSEMBL_REST_SERVER)
+	GRCh38_gene = get_GRCh38_gene(association.gene)
 	if GRCh38_gene is None:
 		logging.info("%s not mapped onto GRCh38 - skipping" % association.gene.id)
 		return []
@@ -482,7 +563,7 @@ def genecluster_association_table(association, population):
 		logging.info("%s not on the principal GRCh38 assembly - skipping" % GRCh38_gene.chrom)
 		return []
 
-	GRCh38_snps = postgap.Ensembl_lookup.get_snp_locations([ld_snp.rsID for ld_snp in association.cluster.ld_snps if ld_snp.rsID not in GRCh38_snp_locations], postgap.Ensembl_lookup.GRCH38_ENSEMBL_REST_SERVER)
+	GRCh38_snps = get_GRCh38_snps([ld_snp for ld_snp in association.cluster.ld_snps if ld_snp.rsID not in GRCh38_snp_locations])
 
 	for snp in GRCh38_snps:
 		GRCh38_snp_locations[snp.rsID] = snp
@@ -657,6 +738,36 @@ def genecluster_association_table(association, population):
 
 	return results
 
+def get_GRCh38_gene(gene):
+	"""
+
+		Returns the GRCh38 coordinates of a gene, lifted over locally if a 
+		chain file is available, from the Ensembl REST server otherwise
+		Arg1: Gene
+		Returntype: Gene or None
+
+	"""
+	if gene.id not in GRCh38_genes:
+		if postgap.Liftover.available():
+			GRCh38_genes[gene.id] = postgap.Liftover.lift_gene(gene)
+		else:
+			GRCh38_genes[gene.id] = postgap.Ensembl_lookup.get_ensembl_gene(gene.id, postgap.Ensembl_lookup.GRCH38_ENSEMBL_REST_SERVER)
+	return GRCh38_genes[gene.id]
+
+def get_GRCh38_snps(snps):
+	"""
+
+		Returns the GRCh38 coordinates of SNPs, lifted over locally if a 
+		chain file is available, from the Ensembl REST server otherwise
+		Arg1: [ SNP ]
+		Returntype: [ SNP ]
+
+	"""
+	if postgap.Liftover.available():
+		return postgap.Liftover.lift_snps(snps)
+	else:
+		return postgap.Ensembl_lookup.get_snp_locations([snp.rsID for snp in snps], postgap.Ensembl_lookup.GRCH38_ENSEMBL_REST_SERVER)
+
 def clean_pmid(string):
 	"""
 		Cleans minor exceptions to PMID formatting, e.g. PUBMEDID:######### or just ##########
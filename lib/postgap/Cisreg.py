@@ -46,6 +46,9 @@ import numpy
 import postgap.FinemapIntegration
 
 
+# Maximum number of variants per VEP POST query, set by the Ensembl REST server
+VEP_MAX_BATCH_SIZE = 200
+
 VEP_impact_to_score = {
 	'HIGH': 4,
 	'MEDIUM': 3,
@@ -72,7 +75,10 @@ class GTEx(Cisreg_source):
 
 		"""
 
-		res = concatenate(map(self.snp, snps))
+		if postgap.Globals.GTEx_path is None:
+			res = concatenate(self._snps_rest(list(snps)))
+		else:
+			res = concatenate(map(self.snp, snps))
 		logging.info("\tFound %i interactions in GTEx" % (len(res)))
 		return res
 
@@ -90,6 +96,11 @@ class GTEx(Cisreg_source):
 		else:
 			res = self._snp_hdf5(snp)
 
+		self._log_snp_result(snp, res)
+
+		return res
+
+	def _log_snp_result(self, snp, res):
 		number_of_associated_genes = 0
 		if res is not None:
 			number_of_associated_genes = len(res)
@@ -98,8 +109,34 @@ class GTEx(Cisreg_source):
 		logging.info(
 			"\tFound %i genes associated the SNP %s in GTEx" % (number_of_associated_genes, snp.rsID))
 
-		return res
+	def _snps_rest(self, snps):
+		"""
+
+			Returns all SNPs associated to a set of SNPs in GTEx, sending the
+			REST queries of all SNPs concurrently
+			Args:
+			* [ SNP ]
+			Returntype: [[ Cisregulatory_Evidence ]]
 
+		"""
+		pvalue_eQTLs = postgap.REST.get_many(self._eqtl_query(snp, 'p-value') for snp in snps)
+		postgap.Ensembl_lookup.prefetch_genes(eQTL.get('gene') for eQTLs in pvalue_eQTLs if isinstance(eQTLs, list) for eQTL in eQTLs)
+		cisreg_with_pvalues = [self._pvalue_evidence(snp, eQTLs) for snp, eQTLs in zip(snps, pvalue_eQTLs)]
+
+		# Betas are only needed for SNPs with p-values
+		cisreg_betas = [None] * len(snps)
+		if postgap.Globals.PERFORM_BAYESIAN:
+			indices = [index for index, cisreg in enumerate(cisreg_with_pvalues) if cisreg is not None and len(cisreg) > 0]
+			beta_eQTLs = postgap.REST.get_many(self._eqtl_query(snps[index], 'beta') for index in indices)
+			for index, eQTLs in zip(indices, beta_eQTLs):
+				cisreg_betas[index] = self._beta_evidence(snps[index], eQTLs)
+
+		res = []
+		for snp, cisreg_with_pvalue, cisreg_beta in zip(snps, cisreg_with_pvalues, cisreg_betas):
+			snp_res = self._combine_pvalues_and_betas(cisreg_with_pvalue, cisreg_beta)
+			self._log_snp_result(snp, snp_res)
+			res.append(snp_res)
+		return res
 
 	def _snp_rest(self, snp):
 		"""
@@ -112,6 +149,21 @@ class GTEx(Cisreg_source):
 		"""
 		cisreg_with_pvalues = self._snp_pvalues(snp)
 		
+		if cisreg_with_pvalues is None or not postgap.Globals.PERFORM_BAYESIAN or len(cisreg_with_pvalues) == 0:
+			return self._combine_pvalues_and_betas(cisreg_with_pvalues, None)
+		
+		return self._combine_pvalues_and_betas(cisreg_with_pvalues, self._snp_betas(snp))
+
+	def _combine_pvalues_and_betas(self, cisreg_with_pvalues, cisreg_betas):
+		"""
+
+			Matches up GTEx p-values and betas of a SNP
+			Args:
+			* [ Cisregulatory_Evidence ] (with p-values)
+			* [ Cisregulatory_Evidence ] (with betas)
+			Returntype: [ Cisregulatory_Evidence ]
+
+		"""
 		if cisreg_with_pvalues is None:
 			return []
 
@@ -124,8 +176,6 @@ class GTEx(Cisreg_source):
 			# Empty list
 			return cisreg_with_pvalues
 		
-		cisreg_betas = self._snp_betas(snp)
-		
 		# Where there are pvalues, there must be betas
 		if cisreg_betas is None:
 			logging.warning("Got exception in _snp_rest")
@@ -185,6 +235,20 @@ class GTEx(Cisreg_source):
 		
 		return combined_cisreg_evidence_list
 
+	def _eqtl_query(self, snp, statistic):
+		"""
+
+			REST query for the GTEx eQTLs of a SNP
+			Args:
+			* SNP
+			* string (statistic, 'p-value' or 'beta')
+			Returntype: (string (server), string (extension))
+
+		"""
+		server = "http://rest.ensembl.org"
+		ext = "/eqtl/variant_name/%s/%s?content-type=application/json;statistic=%s" % ('homo_sapiens', snp.rsID, statistic);
+		return server, ext
+
 	def _snp_betas(self, snp):
 		"""
 
@@ -195,11 +259,33 @@ class GTEx(Cisreg_source):
 
 		"""
 		try:
-			server = "http://rest.ensembl.org"
-			ext = "/eqtl/variant_name/%s/%s?content-type=application/json;statistic=beta" % ('homo_sapiens', snp.rsID);
+			server, ext = self._eqtl_query(snp, 'beta')
 
 			eQTLs = postgap.REST.get(server, ext)
-		
+
+		except Exception as e:
+			logging.warning("Got exception when quering _snp_betas")
+			logging.warning("The exception is %s" % (e))
+			logging.warning("Returning 'None' and pretending this didn't happen.")
+			return None
+
+		return self._beta_evidence(snp, eQTLs)
+
+	def _beta_evidence(self, snp, eQTLs):
+		"""
+
+			Turns the beta eQTLs of a snp returned by the REST server into evidence
+			Args:
+			* SNP
+			* JSON object, or None if the query failed
+			Returntype: [ Cisregulatory_Evidence ]
+
+		"""
+		if eQTLs is None:
+			return None
+
+		try:
+			
 
 			'''
 				Example return object:
@@ -244,12 +330,33 @@ class GTEx(Cisreg_source):
 
 		"""
 		try:
-			server = "http://rest.ensembl.org"
-			ext = "/eqtl/variant_name/%s/%s?content-type=application/json;statistic=p-value" % (
-				'homo_sapiens', snp.rsID);
+			server, ext = self._eqtl_query(snp, 'p-value')
 
 			eQTLs = postgap.REST.get(server, ext)
 
+		except Exception, e:
+			logging.warning("Got exception when quering _snp_pvalues")
+			logging.warning("The exception is %s" % (e))
+			logging.warning("Returning 'None' and pretending this didn't happen.")
+			return None
+
+		return self._pvalue_evidence(snp, eQTLs)
+
+	def _pvalue_evidence(self, snp, eQTLs):
+		"""
+
+			Turns the p-value eQTLs of a snp returned by the REST server into evidence
+			Args:
+			* SNP
+			* JSON object, or None if the query failed
+			Returntype: [ Cisregulatory_Evidence ]
+
+		"""
+		if eQTLs is None:
+			return None
+
+		try:
+
 			'''
 			    Example return object:
 			    [
@@ -324,6 +431,7 @@ class GTEx(Cisreg_source):
 				gene_list_filtered = [gene_range[k] for k in gene_index_list]
 				gene_array_names = {k:(''.join(chr(i) for i in hdf5_file.get('dim_labels/2')[k])).rstrip('\0') for k in gene_list_filtered}
 
+			postgap.Ensembl_lookup.prefetch_genes(gene_array_names.values())
 
 			res = []
 			for k in range(len(p_val_index[0])):
@@ -383,7 +491,7 @@ class VEP(Cisreg_source):
 
 		"""
 
-		list = concatenate(self.get(chunk) for chunk in chunks(snps, 1))
+		list = self.get(snps)
 		'''
 
 			Example output from VEP:
@@ -447,6 +555,7 @@ class VEP(Cisreg_source):
 
 		snp_hash = dict( (snp.rsID, snp) for snp in snps)
 		transcript_consequences = filter(lambda X: 'transcript_consequences' in X, list)
+		postgap.Ensembl_lookup.prefetch_genes(consequence['gene_id'] for hit in transcript_consequences for consequence in hit['transcript_consequences'])
 		res = []
 
 		for hit in transcript_consequences:
@@ -479,8 +588,9 @@ class VEP(Cisreg_source):
 	def get(self, chunk_param):
 		"""
 
-			Queries Ensembl servers. Recursively breaks down query if error code 400 
-			("Bad request") is returned
+			Queries Ensembl servers in batches. Batches rejected with error 
+			code 400 ("Bad request") are broken down until the offending SNP
+			is isolated
 			Args:
 			* [ SNP ]
 			Returntype: [ Regulatory_Evidence ]
@@ -493,27 +603,9 @@ class VEP(Cisreg_source):
 		if len(chunk) == 0:
 			return []
 
-		try:
-			server = "http://grch37.rest.ensembl.org"
-			ext = "/vep/%s/id" % (postgap.Globals.SPECIES)
-			return postgap.REST.get(server, ext, data = {"ids" : [snp.rsID for snp in chunk]})
-
-		except requests.exceptions.HTTPError as error:
-			#if error.response.status_code == 400 or error.response.status_code == 504:
-			if \
-				error.response.status_code == requests.codes.bad_request \
-				or error.response.status_code == requests.codes.gateway_timeout:
-
-				if len(chunk) == 1:
-					return []
-				else:
-					return self.get(chunk[:len(chunk)/2]) + self.get(chunk[len(chunk)/2:])
-			raise
-		except Variation400error as error:
-			if len(chunk) == 1:
-				return []
-			else:
-				return self.get(chunk[:len(chunk)/2]) + self.get(chunk[len(chunk)/2:])
+		server = "http://grch37.rest.ensembl.org"
+		ext = "/vep/%s/id" % (postgap.Globals.SPECIES)
+		return concatenate(response for batch, response in postgap.REST.post_in_batches(server, ext, "ids", [snp.rsID for snp in chunk], VEP_MAX_BATCH_SIZE))
 				
 
 class Fantom5(Cisreg_source):
@@ -533,7 +625,8 @@ class Fantom5(Cisreg_source):
 
 		logging.info("\tSearching for overlaps from %i SNPs to Fantom5" % len(snps))
 		
-		intersection = postgap.BedTools.overlap_snps_to_bed(snps, postgap.Globals.DATABASES_DIR + "/Fantom5.bed")
+		intersection = list(postgap.BedTools.overlap_snps_to_bed(snps, postgap.Globals.DATABASES_DIR + "/Fantom5.bed"))
+		postgap.Ensembl_lookup.prefetch_genes(feature[3] for feature in intersection)
 		fdr_model = pickle.load(open(postgap.Globals.DATABASES_DIR + "/Fantom5.fdrs"))
 		snp_hash = dict( (snp.rsID, snp) for snp in snps)
 		hits  = filter(lambda X: X is not None, map(lambda X: self.get_evidence(X, fdr_model, snp_hash), intersection))
@@ -597,7 +690,8 @@ class DHS(Cisreg_source):
 
 		logging.info("\tSearching for gene associations in DHS")
 		
-		intersection = postgap.BedTools.overlap_snps_to_bed(snps, postgap.Globals.DATABASES_DIR + "/DHS.bed")
+		intersection = list(postgap.BedTools.overlap_snps_to_bed(snps, postgap.Globals.DATABASES_DIR + "/DHS.bed"))
+		postgap.Ensembl_lookup.prefetch_genes(feature[3] for feature in intersection)
 		fdr_model = pickle.load(open(postgap.Globals.DATABASES_DIR+"/DHS.fdrs"))
 		snp_hash = dict( (snp.rsID, snp) for snp in snps)
 		res = filter (lambda X: X is not None and X.score, (self.get_evidence(feature, fdr_model, snp_hash) for feature in intersection))
@@ -700,7 +794,8 @@ class PCHIC(Cisreg_source):
 
 		logging.info("\tSearching for gene associations in PCHIC")
 		
-		intersection = postgap.BedTools.overlap_snps_to_bed(snps, postgap.Globals.DATABASES_DIR + "/pchic.bed")
+		intersection = list(postgap.BedTools.overlap_snps_to_bed(snps, postgap.Globals.DATABASES_DIR + "/pchic.bed"))
+		postgap.Ensembl_lookup.prefetch_genes(feature[4] for feature in intersection)
 		snp_hash = dict( (snp.rsID, snp) for snp in snps)
 		res = filter (lambda X: X is not None and X.score, (self.get_evidence(feature, snp_hash) for feature in intersection))
 
@@ -767,8 +862,9 @@ class nearest_gene(Cisreg_source):
 
 		snps = list(snps)
 		bed = postgap.Globals.DATABASES_DIR + "/Ensembl_TSSs.bed"
-		res = postgap.BedTools.closest(snps, bed)
+		res = list(postgap.BedTools.closest(snps, bed))
 		snp_hash = dict((snp.rsID, snp) for snp in snps)
+		postgap.Ensembl_lookup.prefetch_genes(row[7] for row in res)
 
 		'''
 			Parse output: first 4 columns are from SNP file, next 4 Gene coords
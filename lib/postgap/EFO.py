@@ -28,6 +28,7 @@ limitations under the License.
 
 """
 import re
+import logging
 
 import postgap.REST
 from postgap.Globals import *
@@ -309,17 +310,34 @@ def term(efo):
 		known_terms[efo] = lookup_term(efo)
 	return known_terms[efo]
 
-def lookup_term(iri):
+def prefetch_terms(iris):
 	"""
 
-	Return term associated to ontology IRI
+	Looks up the terms of several ontology IRIs concurrently, and stores
+	them in known_terms. IRIs which could not be looked up are left to term()
+	Arg:
+	* [ string ] (EFO IRIs)
+
+	"""
+	iris = sorted(set(iri for iri in iris if iri not in known_terms))
+	if len(iris) == 0:
+		return
+
+	logging.info("Looking up the terms of %i ontology IRIs" % len(iris))
+	hashes = postgap.REST.get_many(term_query(iri) for iri in iris)
+	for iri, hash in zip(iris, hashes):
+		if hash is not None:
+			known_terms[iri] = hash['label']
+
+def term_query(iri):
+	"""
+
+	Return the OLS query for an ontology IRI
 	Arg:
 	* string (EFO IRI)
-	Returntype: string (term)
+	Returntype: (string (server), string (extension))
 
 	"""
-	import logging
-	
 	server = 'http://www.ebi.ac.uk'
 
 	import urllib
@@ -327,6 +345,18 @@ def lookup_term(iri):
 
 	# E.g.: http://www.ebi.ac.uk/ols/api/ontologies/efo/terms/http%253A%252F%252Fwww.ebi.ac.uk%252Fefo%252FEFO_0000400
 	ext = "/ols/api/ontologies/efo/terms/" + double_quoted_iri
+	return server, ext
+
+def lookup_term(iri):
+	"""
+
+	Return term associated to ontology IRI
+	Arg:
+	* string (EFO IRI)
+	Returntype: string (term)
+
+	"""
+	server, ext = term_query(iri)
 	hash = postgap.REST.get(server, ext)
 	'''
         {
@@ -29,18 +29,49 @@ limitations under the License.
 """
 
 import postgap.REST
+import postgap.LookupSnapshot
 from postgap.DataModel import *
 import postgap.Globals
 from postgap.Utils import *
 import logging
+import os
+import re
+import threading
+import numpy
 
 GRCH37_ENSEMBL_REST_SERVER = "http://grch37.rest.ensembl.org"
 GRCH38_ENSEMBL_REST_SERVER = "http://rest.ensembl.org"
-known_genes = {}
-known_snps = {}
+# Lookup results, persisted across runs in Globals.LOOKUP_SNAPSHOT_FILE
+known_genes = postgap.LookupSnapshot.persistent_dict('genes', Gene)
+known_snps = postgap.LookupSnapshot.persistent_dict('snps', SNP)
 # Naughty hack only take into account main assembly, since patches filtered later on
 known_chroms = map(str, range(1,23)) + ['X','Y']
 
+# Gene tables built from the Ensembl GTF files (see scripts/build_data_files/Makefile)
+GENE_TABLE_FILES = {
+	GRCH37_ENSEMBL_REST_SERVER: "Ensembl_genes.GRCh37.tsv",
+	GRCH38_ENSEMBL_REST_SERVER: "Ensembl_genes.GRCh38.tsv",
+}
+gene_tables = {}
+gene_tables_lock = threading.Lock()
+
+# rsID location indexes built from dbSNP VCF files (see scripts/build_data_files/Makefile)
+SNP_INDEX_PREFIXES = {
+	GRCH37_ENSEMBL_REST_SERVER: "rsID_index.GRCh37",
+	GRCH38_ENSEMBL_REST_SERVER: "rsID_index.GRCh38",
+}
+snp_indexes = {}
+RSID_REGEX = re.compile('^rs([0-9]+)$')
+
+# Maximum number of genes per POST lookup query, set by the Ensembl REST server
+LOOKUP_BATCH_SIZE = 1000
+
+# Maximum length of a region queried on the overlap endpoint, set by the Ensembl REST server
+MAX_REGION_SIZE = 5000000
+
+# Maximum number of variants per POST variation query, set by the Ensembl REST server
+VARIATION_MAX_BATCH_SIZE = 200
+
 def get_gene(gene_name, ENSEMBL_REST_SERVER = GRCH37_ENSEMBL_REST_SERVER):
 	"""
 
@@ -52,21 +83,124 @@ def get_gene(gene_name, ENSEMBL_REST_SERVER = GRCH37_ENSEMBL_REST_SERVER):
 	key = (gene_name, ENSEMBL_REST_SERVER)
 	if key not in known_genes:
 		if gene_name[:4] != 'ENSG':
-			gene = fetch_gene(gene_name, ENSEMBL_REST_SERVER)
-			if gene is None:
-				known_genes[key] = None
-			else:
-				key2 = (gene.id, ENSEMBL_REST_SERVER)
-				if key2 in known_genes:
-					# Already found the same gene but under a different name (capitalisation changes etc)
-					known_genes[key] = known_genes[key2]
-				else:
-					known_genes[key] = gene
-					known_genes[key2] = gene
+			remember_gene(gene_name, fetch_gene(gene_name, ENSEMBL_REST_SERVER), ENSEMBL_REST_SERVER)
 		else:
 			known_genes[key] = fetch_gene_id(gene_name)
 	return known_genes[key]
 
+def remember_gene(gene_name, gene, ENSEMBL_REST_SERVER = GRCH37_ENSEMBL_REST_SERVER):
+	"""
+
+		Stores the gene found for a gene name
+		* string
+		* Gene or None
+		* string
+
+	"""
+	key = (gene_name, ENSEMBL_REST_SERVER)
+	if gene is None:
+		known_genes[key] = None
+	else:
+		key2 = (gene.id, ENSEMBL_REST_SERVER)
+		if key2 in known_genes and known_genes[key2] is not None:
+			# Already found the same gene but under a different name (capitalisation changes etc)
+			known_genes[key] = known_genes[key2]
+		else:
+			known_genes[key] = gene
+			known_genes[key2] = gene
+
+def gene_from_lookup(hash, gene_name = None):
+	"""
+
+		Builds a gene from the response of an Ensembl lookup
+		* dict
+		* string (name under which the gene was queried, defaults to its display name)
+		Returntype: Gene
+
+	"""
+	return Gene(
+		name = gene_name if gene_name is not None else hash['display_name'],
+		id = hash['id'],
+		chrom = hash['seq_region_name'],
+		tss = int(hash['start']) if hash['strand'] > 0 else int(hash['end']),
+		biotype = hash['biotype']
+		)
+
+def get_gene_table(ENSEMBL_REST_SERVER = GRCH37_ENSEMBL_REST_SERVER):
+	"""
+
+		Loads the local gene table of an assembly, if available
+		* string
+		Returntype: (dict(gene ID => Gene), dict(upper case symbol => Gene)) or None
+
+	"""
+	with gene_tables_lock:
+		if ENSEMBL_REST_SERVER not in gene_tables:
+			gene_tables[ENSEMBL_REST_SERVER] = load_gene_table(ENSEMBL_REST_SERVER)
+		return gene_tables[ENSEMBL_REST_SERVER]
+
+def load_gene_table(ENSEMBL_REST_SERVER):
+	"""
+
+		Reads the local gene table of an assembly, with columns gene ID, 
+		symbol, synonyms, chrom, TSS, strand and biotype
+		* string
+		Returntype: (dict(gene ID => Gene), dict(upper case symbol => Gene)) or None
+
+	"""
+	if postgap.Globals.DATABASES_DIR is None or ENSEMBL_REST_SERVER not in GENE_TABLE_FILES:
+		return None
+
+	filename = os.path.join(postgap.Globals.DATABASES_DIR, GENE_TABLE_FILES[ENSEMBL_REST_SERVER])
+	if not os.path.exists(filename):
+		return None
+
+	genes_by_id = dict()
+	genes_by_symbol = dict()
+	synonyms = []
+	with open(filename) as file:
+		for line in file:
+			gene_id, symbol, gene_synonyms, chrom, tss, strand, biotype = line.rstrip('\n').split('\t')
+			gene = Gene(
+				name = symbol,
+				id = gene_id,
+				chrom = chrom,
+				tss = int(tss),
+				biotype = biotype
+				)
+			genes_by_id[gene_id] = gene
+			genes_by_symbol.setdefault(symbol.upper(), gene)
+			if gene_synonyms != '':
+				synonyms += [(synonym.upper(), gene) for synonym in gene_synonyms.split(',')]
+
+	# Official symbols take precedence over synonyms
+	for synonym, gene in synonyms:
+		genes_by_symbol.setdefault(synonym, gene)
+
+	logging.info("Loaded %i genes from %s" % (len(genes_by_id), filename))
+	return genes_by_id, genes_by_symbol
+
+def lookup_local_gene(gene_name, ENSEMBL_REST_SERVER = GRCH37_ENSEMBL_REST_SERVER):
+	"""
+
+		Get gene details from name or Ensembl ID in the local gene table
+		* string
+		Returntype: Gene or None if not found
+
+	"""
+	gene_table = get_gene_table(ENSEMBL_REST_SERVER)
+	if gene_table is None:
+		return None
+
+	genes_by_id, genes_by_symbol = gene_table
+	if gene_name[:4] == 'ENSG':
+		return genes_by_id.get(gene_name.split('.')[0])
+
+	gene = genes_by_symbol.get(gene_name.upper())
+	if gene is None:
+		return None
+	return gene._replace(name = gene_name)
+
 def fetch_gene(gene_name, ENSEMBL_REST_SERVER = GRCH37_ENSEMBL_REST_SERVER):
 	"""
 
@@ -75,17 +209,17 @@ def fetch_gene(gene_name, ENSEMBL_REST_SERVER = GRCH37_ENSEMBL_REST_SERVER):
 		Returntype: Gene
 
 	"""
+	gene = lookup_local_gene(gene_name, ENSEMBL_REST_SERVER)
+	if gene is not None:
+		return gene
+
 	server = ENSEMBL_REST_SERVER
 	ext = "/lookup/symbol/%s/%s?content-type=application/json" % (postgap.Globals.SPECIES, gene_name)
 	try:
-		hash = postgap.REST.get(server, ext)
-		return Gene(
-			name = gene_name,
-			id = hash['id'],
-			chrom = hash['seq_region_name'],
-			tss = int(hash['start']) if hash['strand'] > 0 else int(hash['end']),
-			biotype = hash['biotype']
-			)
+		return gene_from_lookup(postgap.REST.get(server, ext), gene_name)
+	except postgap.REST.GENE400error:
+		known_genes.set_missing((gene_name, ENSEMBL_REST_SERVER))
+		return None
 	except:
 		return None
 
@@ -97,17 +231,17 @@ def fetch_gene_id(gene_id, ENSEMBL_REST_SERVER = GRCH37_ENSEMBL_REST_SERVER):
 		Returntype: Gene
 
 	"""
+	gene = lookup_local_gene(gene_id, ENSEMBL_REST_SERVER)
+	if gene is not None:
+		return gene
+
 	server = ENSEMBL_REST_SERVER
 	ext = "/lookup/id/%s?content-type=application/json" % (gene_id)
 	try:
-		hash = postgap.REST.get(server, ext)
-		return Gene(
-			name = hash['display_name'],
-			id = hash['id'],
-			chrom = hash['seq_region_name'],
-			tss = int(hash['start']) if hash['strand'] > 0 else int(hash['end']),
-			biotype = hash['biotype']
-			)
+		return gene_from_lookup(postgap.REST.get(server, ext))
+	except postgap.REST.GENE400error:
+		known_genes.set_missing((gene_id, ENSEMBL_REST_SERVER))
+		return None
 	except:
 		return None
 
@@ -125,6 +259,125 @@ def get_ensembl_gene(ensembl_id, ENSEMBL_REST_SERVER = GRCH37_ENSEMBL_REST_SERVE
 		known_genes[key] = fetch_gene_id(ensembl_id, ENSEMBL_REST_SERVER)
 	return known_genes[key]
 
+def prefetch_genes(gene_names, ENSEMBL_REST_SERVER = GRCH37_ENSEMBL_REST_SERVER):
+	"""
+
+		Resolves a batch of gene names and Ensembl IDs with the POST lookup
+		endpoints, so that subsequent calls to get_gene and get_ensembl_gene
+		are answered from known_genes. Names missing from the responses,
+		or which could not be looked up, are not cached, so that get_gene
+		queries them individually.
+		* [ string ]
+		* string
+
+	"""
+	unknown_names = set(gene_name for gene_name in gene_names if gene_name is not None and (gene_name, ENSEMBL_REST_SERVER) not in known_genes)
+
+	# Genes in the local gene table need no query
+	for gene_name in list(unknown_names):
+		gene = lookup_local_gene(gene_name, ENSEMBL_REST_SERVER)
+		if gene is not None:
+			if gene_name[:4] == 'ENSG':
+				known_genes[(gene_name, ENSEMBL_REST_SERVER)] = gene
+			else:
+				remember_gene(gene_name, gene, ENSEMBL_REST_SERVER)
+			unknown_names.remove(gene_name)
+
+	gene_ids = sorted(gene_name for gene_name in unknown_names if gene_name[:4] == 'ENSG')
+	symbols = sorted(gene_name for gene_name in unknown_names if gene_name[:4] != 'ENSG')
+
+	for chunk, hash in fetch_lookup_batches(ENSEMBL_REST_SERVER, "/lookup/id?content-type=application/json", 'ids', gene_ids):
+		for gene_id in chunk:
+			# Unresolved IDs stay uncached, get_gene looks them up on its own
+			if hash.get(gene_id) is None:
+				continue
+			try:
+				known_genes[(gene_id, ENSEMBL_REST_SERVER)] = gene_from_lookup(hash[gene_id])
+			except:
+				continue
+
+	for chunk, hash in fetch_lookup_batches(ENSEMBL_REST_SERVER, "/lookup/symbol/%s?content-type=application/json" % (postgap.Globals.SPECIES), 'symbols', symbols):
+		for symbol in chunk:
+			if hash.get(symbol) is None:
+				continue
+			try:
+				gene = gene_from_lookup(hash[symbol], symbol)
+			except:
+				continue
+			remember_gene(symbol, gene, ENSEMBL_REST_SERVER)
+
+	logging.debug("Looked up %i gene IDs and %i gene symbols" % (len(gene_ids), len(symbols)))
+
+def prefetch_region_genes(regions, ENSEMBL_REST_SERVER = GRCH37_ENSEMBL_REST_SERVER):
+	"""
+
+		Fetches all the genes overlapping a set of regions, with one overlap
+		query per region, and stores them in known_genes under their 
+		Ensembl ID and symbol. Unnecessary when a local gene table is 
+		available.
+		* [ (string (chrom), int (start), int (end)) ]
+		* string
+
+	"""
+	if get_gene_table(ENSEMBL_REST_SERVER) is not None:
+		return
+
+	queries = []
+	for chrom, start, end in regions:
+		for region_start in range(max(1, start), end + 1, MAX_REGION_SIZE):
+			region_end = min(end, region_start + MAX_REGION_SIZE - 1)
+			queries.append((ENSEMBL_REST_SERVER, "/overlap/region/%s/%s:%i-%i?feature=gene;content-type=application/json" % (postgap.Globals.SPECIES, chrom, region_start, region_end)))
+
+	'''
+		Example response:
+		[
+			{
+				"id": "ENSG00000157764",
+				"external_name": "BRAF",
+				"seq_region_name": "7",
+				"start": 140424943,
+				"end": 140624564,
+				"strand": -1,
+				"biotype": "protein_coding",
+				...
+			}
+		]
+	'''
+	count = 0
+	for features in postgap.REST.get_many(queries):
+		if features is None:
+			continue
+		for feature in features:
+			try:
+				gene = gene_from_lookup(dict(feature, display_name = feature.get('external_name') or feature['id']))
+			except Exception as e:
+				logging.warning("Could not parse gene %s: %s" % (feature, e))
+				continue
+			known_genes[(gene.id, ENSEMBL_REST_SERVER)] = gene
+			if feature.get('external_name') is not None and (gene.name, ENSEMBL_REST_SERVER) not in known_genes:
+				remember_gene(gene.name, gene, ENSEMBL_REST_SERVER)
+			count += 1
+
+	logging.info("Prefetched %i genes in %i regions" % (count, len(queries)))
+
+def fetch_lookup_batches(server, ext, key, names):
+	"""
+
+		Sends POST lookup queries
+		* string (server)
+		* string (extension)
+		* string (key of the name list in the POST data)
+		* [ string ]
+		Returntype: [ ([ string ], dict) ], empty if the queries failed
+
+	"""
+	try:
+		return postgap.REST.post_in_batches(server, ext, key, names, LOOKUP_BATCH_SIZE)
+	except Exception as e:
+		logging.warning("Got exception when looking up genes in batch")
+		logging.warning("The exception is %s" % (e))
+		return []
+
 def get_snp_locations(rsIDs, ENSEMBL_REST_SERVER = GRCH37_ENSEMBL_REST_SERVER):
 	"""
 
@@ -137,17 +390,96 @@ def get_snp_locations(rsIDs, ENSEMBL_REST_SERVER = GRCH37_ENSEMBL_REST_SERVER):
 		return []
 
 	unknown_rsIDs = filter(lambda rsID: (rsID, ENSEMBL_REST_SERVER) not in known_snps, rsIDs)
+	unknown_rsIDs = lookup_local_snps(unknown_rsIDs, ENSEMBL_REST_SERVER)
 
-	res = get_snp_locations_simple(unknown_rsIDs, ENSEMBL_REST_SERVER) 
-
-	if len(res) == 0:
-		if len(unknown_rsIDs) == 1:
-			res = []
-		else:
-			res = get_snp_locations(unknown_rsIDs[:len(unknown_rsIDs)/2]) + get_snp_locations(unknown_rsIDs[len(unknown_rsIDs)/2:])
+	if len(unknown_rsIDs) > 0:
+		get_snp_locations_simple(unknown_rsIDs, ENSEMBL_REST_SERVER) 
 	
-	return [known_snps[(rsID, ENSEMBL_REST_SERVER)] for rsID in rsIDs if (rsID, ENSEMBL_REST_SERVER) in known_snps]
+	# Unmapped SNPs are known as None
+	return [known_snps[(rsID, ENSEMBL_REST_SERVER)] for rsID in rsIDs if known_snps.get((rsID, ENSEMBL_REST_SERVER)) is not None]
+
+
+def get_snp_index(ENSEMBL_REST_SERVER = GRCH37_ENSEMBL_REST_SERVER):
+	"""
+
+		Memory maps the local rsID index of an assembly, if available
+		* string
+		Returntype: dict(string => numpy.array) or None
+
+	"""
+	with gene_tables_lock:
+		if ENSEMBL_REST_SERVER not in snp_indexes:
+			snp_indexes[ENSEMBL_REST_SERVER] = load_snp_index(ENSEMBL_REST_SERVER)
+		return snp_indexes[ENSEMBL_REST_SERVER]
+
+def load_snp_index(ENSEMBL_REST_SERVER):
+	"""
+
+		Memory maps the arrays of a local rsID index: rsids, chroms and 
+		positions sorted by rsID, and optionally merged_from and merged_to
+		sorted by merged rsID
+		* string
+		Returntype: dict(string => numpy.array) or None
+
+	"""
+	if postgap.Globals.DATABASES_DIR is None or ENSEMBL_REST_SERVER not in SNP_INDEX_PREFIXES:
+		return None
 
+	prefix = os.path.join(postgap.Globals.DATABASES_DIR, SNP_INDEX_PREFIXES[ENSEMBL_REST_SERVER])
+	index = dict()
+	for name in ['rsids', 'chroms', 'positions', 'merged_from', 'merged_to']:
+		filename = "%s.%s.npy" % (prefix, name)
+		if os.path.exists(filename):
+			index[name] = numpy.load(filename, mmap_mode='r')
+
+	if 'rsids' not in index or 'chroms' not in index or 'positions' not in index:
+		return None
+
+	logging.info("Loaded index of %i rsIDs from %s" % (len(index['rsids']), prefix))
+	return index
+
+def lookup_local_snps(rsIDs, ENSEMBL_REST_SERVER = GRCH37_ENSEMBL_REST_SERVER):
+	"""
+
+		Finds SNP locations in the local rsID index, and stores them in 
+		known_snps
+		* [ string ]
+		* string
+		Returntype: [ string ] (rsIDs not found in the index)
+
+	"""
+	index = get_snp_index(ENSEMBL_REST_SERVER)
+	if index is None or len(rsIDs) == 0:
+		return rsIDs
+
+	matches = [RSID_REGEX.match(rsID) for rsID in rsIDs]
+	numbered_rsIDs = [rsID for rsID, match in zip(rsIDs, matches) if match is not None]
+	numbers = numpy.array([int(match.group(1)) for match in matches if match is not None], dtype=numpy.int64)
+
+	# Merged rsIDs are looked up under their current rsID
+	if 'merged_from' in index and 'merged_to' in index and len(index['merged_from']) > 0:
+		merged_positions = numpy.minimum(numpy.searchsorted(index['merged_from'], numbers), len(index['merged_from']) - 1)
+		merged = index['merged_from'][merged_positions] == numbers
+		numbers[merged] = index['merged_to'][merged_positions[merged]]
+
+	if len(index['rsids']) == 0:
+		return rsIDs
+	positions = numpy.minimum(numpy.searchsorted(index['rsids'], numbers), len(index['rsids']) - 1)
+	found = index['rsids'][positions] == numbers
+	chroms = index['chroms'][positions[found]]
+	locations = index['positions'][positions[found]]
+
+	for rsID, chrom, pos in zip([rsID for rsID, is_found in zip(numbered_rsIDs, found) if is_found], chroms, locations):
+		# No need to persist what the index already provides
+		known_snps.cache((rsID, ENSEMBL_REST_SERVER), SNP(
+			rsID = rsID,
+			chrom = known_chroms[chrom],
+			pos = int(pos),
+			approximated_zscore = None
+		))
+
+	logging.debug("Found %i out of %i SNPs in the local rsID index" % (numpy.sum(found), len(rsIDs)))
+	return [rsID for rsID in rsIDs if (rsID, ENSEMBL_REST_SERVER) not in known_snps]
 
 def get_snp_locations_simple(rsIDs, ENSEMBL_REST_SERVER = GRCH37_ENSEMBL_REST_SERVER):
 	"""
@@ -162,7 +494,8 @@ def get_snp_locations_simple(rsIDs, ENSEMBL_REST_SERVER = GRCH37_ENSEMBL_REST_SE
 	
 	server = ENSEMBL_REST_SERVER
 	ext = "/variation/%s?content-type=application/json" % (postgap.Globals.SPECIES)
-	hash = concatenate_hashes(postgap.REST.get(server, ext, data={'ids':chunk}) for chunk in chunks(rsIDs, 199))
+	batches = postgap.REST.post_in_batches(server, ext, 'ids', rsIDs, VARIATION_MAX_BATCH_SIZE)
+	hash = concatenate_hashes(response for batch, response in batches)
 	for record in hash.values():
 		for synonym in record["synonyms"]:
 			hash[synonym] = record
@@ -216,5 +549,11 @@ def get_snp_locations_simple(rsIDs, ENSEMBL_REST_SERVER = GRCH37_ENSEMBL_REST_SE
 				if mapping['seq_region_name'] in known_chroms:
 					known_snps[(rsID, ENSEMBL_REST_SERVER)] = snp
 
+	# SNPs the server answered for, but could not place on the main assembly
+	for batch, response in batches:
+		for rsID in batch:
+			if (rsID, ENSEMBL_REST_SERVER) not in known_snps:
+				known_snps.set_missing((rsID, ENSEMBL_REST_SERVER))
+
 	return results
 
@@ -31,6 +31,7 @@ limitations under the License.
 scipy = None
 import numpy
 import postgap.Globals
+import postgap.SummaryStats
 import collections
 
 from postgap.DataModel import *
@@ -112,25 +113,14 @@ def compute_ld_matrix(cluster, population):
 def extract_z_scores_from_file(cluster, population):
 	'''
 		Extracts Z-scores from summary stats file, computes LD matrix
-		TODO: It is inefficient torun through a 1GB file once per locus, this should be done only once
 		Arg1: Cluster
 		Returntype: [SNP], numpy.matrix (square LD matrix), numpy.matrix (Z-score vector)
 	'''
 	ld_snp_hash = dict((ld_snp.rsID, ld_snp) for index, ld_snp in enumerate(cluster.ld_snps))
 
 	## Extract or impute missing z_scores
-	ld_snp_results = dict()
-	missing = len(ld_snp_hash)
-	file = open(postgap.Globals.GWAS_SUMMARY_STATS_FILE)
-	for line in file:
-		# Chromosome	Position	MarkerName	Effect_allele	Non_Effect_allele	Beta	SE	Pvalue
-		#1	751343	rs28544273	A	T	-0.0146	0.0338	0.6651
-		chromosome, position, rsID, effect_allele, non_effect_allele, beta, se, pvalue = line.rstrip().split('\t')
-		if rsID in ld_snp_hash:
-			ld_snp_results[rsID] = (float(pvalue), float(beta))
-			missing -= 1
-			if missing == 0:
-				break
+	# rsID => (pvalue, beta), read from the cluster's region if the file is tabix indexed
+	ld_snp_results = postgap.SummaryStats.get_snp_results(postgap.Globals.GWAS_SUMMARY_STATS_FILE, cluster.ld_snps)
 	
 	# Update list of SNPss	
 	found_ld_snps = [ld_snp_hash[rsID] for rsID in ld_snp_results]
@@ -0,0 +1,318 @@
+#! /usr/bin/env python
+
+"""
+
+Copyright [1999-2018] EMBL-European Bioinformatics Institute
+
+Licensed under the Apache License, Version 2.0 (the "License")
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+		 http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+"""
+
+	Please email comments or questions to the public Ensembl
+	developers list at <http://lists.ensembl.org/mailman/listinfo/dev>.
+
+	Questions may also be sent to the Ensembl help desk at
+	<http://www.ensembl.org/Help/Contact>.
+
+"""
+import os
+import array
+import hashlib
+import logging
+import threading
+import numpy
+
+import postgap.Globals
+
+# Bumped whenever the layout of the index files changes
+INDEX_VERSION = 2
+
+indexes = {}
+indexes_lock = threading.Lock()
+
+def encode_key(key):
+	"""
+
+		Converts a key to the byte string stored in the index: keys read
+		from the file are kept as they are, unicode keys are UTF-8 encoded
+		Args:
+		* string or unicode
+		Returntype: string, or None if the key cannot be encoded
+
+	"""
+	if isinstance(key, unicode):
+		try:
+			return key.encode('utf-8')
+		except UnicodeError:
+			return None
+	return key
+
+class flat_file_index(object):
+	"""
+
+		Inverted index from keys (e.g. ontology IRIs) to the byte offsets of
+		the lines of a text file which contain them. The index is stored as
+		numpy arrays, which are memory-mapped on later runs:
+		* FILE.NAME.keys.npy: distinct keys, sorted
+		* FILE.NAME.starts.npy: start of the offsets of each key, plus the total
+		* FILE.NAME.offsets.npy: line offsets, grouped by key
+		* FILE.NAME.pvalues.npy: p-value of the line of each offset (NaN if
+		unknown), if the index was given a p-value function
+		* FILE.NAME.signature.npy: index version, size and mtime of the file
+
+		The files are written next to the file, or, if its directory is not
+		writable, in postgap.Globals.INDEX_CACHE_DIR. If neither can be
+		written, the index is only kept in memory. The index is rebuilt 
+		whenever the size or mtime of the file changes.
+
+	"""
+	def __init__(self, filename, name, key_function, header_lines=0, pvalue_function=None):
+		self.filename = filename
+		self.name = name
+		self.key_function = key_function
+		self.header_lines = header_lines
+		self.pvalue_function = pvalue_function
+		self.pvalues = None
+		self.signature_at_load = self.signature()
+		if not any(self.load(directory) for directory in self.index_directories()):
+			self.build()
+
+	def index_directories(self):
+		"""
+
+			Returns the directories in which the index files are looked for
+			and written, in order of preference
+			Returntype: [ string ]
+
+		"""
+		res = [os.path.dirname(os.path.abspath(self.filename))]
+		if postgap.Globals.INDEX_CACHE_DIR is not None:
+			res.append(postgap.Globals.INDEX_CACHE_DIR)
+		return res
+
+	def index_filename(self, part, directory=None):
+		if directory is None or directory == os.path.dirname(os.path.abspath(self.filename)):
+			return "%s.%s.%s.npy" % (self.filename, self.name, part)
+		# Files of the same name in different directories get different indexes in the cache
+		path_hash = hashlib.md5(os.path.abspath(self.filename)).hexdigest()[:8]
+		return os.path.join(directory, "%s.%s.%s.%s.npy" % (os.path.basename(self.filename), path_hash, self.name, part))
+
+	def index_parts(self):
+		res = ['keys', 'starts', 'offsets']
+		if self.pvalue_function is not None:
+			res.append('pvalues')
+		return res
+
+	def signature(self):
+		stat = os.stat(self.filename)
+		return numpy.array([INDEX_VERSION, stat.st_size, int(stat.st_mtime), self.pvalue_function is not None], dtype=numpy.int64)
+
+	def load(self, directory):
+		"""
+
+			Memory maps the index files of a directory, if they are up to date
+			Args:
+			* string (directory)
+			Returntype: boolean
+
+		"""
+		for part in ['signature'] + self.index_parts():
+			if not os.path.exists(self.index_filename(part, directory)):
+				return False
+
+		try:
+			if not numpy.array_equal(numpy.load(self.index_filename('signature', directory)), self.signature_at_load):
+				logging.info("Index %s is out of date" % (self.index_filename('keys', directory)))
+				return False
+			self.keys = numpy.load(self.index_filename('keys', directory), mmap_mode='r')
+			self.starts = numpy.load(self.index_filename('starts', directory), mmap_mode='r')
+			self.offsets = numpy.load(self.index_filename('offsets', directory), mmap_mode='r')
+			if self.pvalue_function is not None:
+				self.pvalues = numpy.load(self.index_filename('pvalues', directory), mmap_mode='r')
+		except (IOError, ValueError) as e:
+			logging.warning("Could not read index %s: %s" % (self.index_filename('keys', directory), e))
+			return False
+
+		logging.info("Loaded index of %i keys from %s" % (len(self.keys), self.index_filename('keys', directory)))
+		return True
+
+	def build(self):
+		"""
+
+			Scans the file once to build the index, and writes it out to the
+			first writable index directory. Keys are interned as they are 
+			read, so each posting only takes a key number, an offset and a 
+			p-value in compact arrays, whatever the size of the file.
+
+		"""
+		logging.info("Indexing %s by %s" % (self.filename, self.name))
+		key_ids = dict()
+		posting_key_ids = array.array('i')
+		posting_offsets = array.array('l')
+		posting_pvalues = array.array('d')
+
+		file = open(self.filename)
+		for i in range(self.header_lines):
+			file.readline()
+		# Line iteration reads ahead, so offsets are tracked explicitly
+		offset = file.tell()
+		while True:
+			line = file.readline()
+			if line == '':
+				break
+			if self.pvalue_function is not None:
+				pvalue = self.pvalue_function(line)
+				if pvalue is None:
+					pvalue = float('nan')
+			for key in set(encode_key(key) for key in self.key_function(line)):
+				if key is not None and key != '':
+					posting_key_ids.append(key_ids.setdefault(key, len(key_ids)))
+					posting_offsets.append(offset)
+					if self.pvalue_function is not None:
+						posting_pvalues.append(pvalue)
+			offset += len(line)
+		file.close()
+
+		keys = sorted(key_ids)
+		if len(keys) > 0:
+			self.keys = numpy.array(keys)
+		else:
+			self.keys = numpy.array([], dtype='S1')
+
+		# Rank of each key in sorted order, by key number
+		key_ranks = numpy.empty(len(keys), dtype=numpy.int32)
+		for rank, key in enumerate(keys):
+			key_ranks[key_ids[key]] = rank
+		del key_ids
+
+		posting_ranks = key_ranks[numpy.frombuffer(posting_key_ids, dtype=numpy.int32)]
+		del posting_key_ids
+		# A stable sort keeps the offsets of each key in file order
+		order = numpy.argsort(posting_ranks, kind='mergesort')
+		self.offsets = numpy.frombuffer(posting_offsets, dtype=numpy.int64)[order].astype(numpy.uint64)
+		if self.pvalue_function is not None:
+			self.pvalues = numpy.frombuffer(posting_pvalues, dtype=numpy.float64)[order]
+		del posting_offsets, posting_pvalues, order
+		self.starts = numpy.append(0, numpy.cumsum(numpy.bincount(posting_ranks, minlength=len(keys)))).astype(numpy.uint64)
+
+		for directory in self.index_directories():
+			if self.save(directory):
+				break
+		else:
+			logging.warning("Could not write index of %s in %s, keeping it in memory" % (self.filename, ", ".join(self.index_directories())))
+
+		logging.info("Indexed %i keys in %s" % (len(self.keys), self.filename))
+
+	def save(self, directory):
+		"""
+
+			Writes the index files to a directory, which is created if needed
+			Args:
+			* string (directory)
+			Returntype: boolean
+
+		"""
+		arrays = {'keys': self.keys, 'starts': self.starts, 'offsets': self.offsets, 'pvalues': self.pvalues}
+		temporary_filename = None
+		try:
+			if not os.path.isdir(directory):
+				os.makedirs(directory)
+			# The signature goes last, so that an interrupted write leaves an out of date index
+			for part in self.index_parts() + ['signature']:
+				# Written under a temporary name, so that readers never see a partial file
+				temporary_filename = "%s.%i.tmp" % (self.index_filename(part, directory), os.getpid())
+				with open(temporary_filename, 'wb') as index_file:
+					numpy.save(index_file, arrays.get(part, self.signature_at_load))
+				os.rename(temporary_filename, self.index_filename(part, directory))
+				temporary_filename = None
+		except (IOError, OSError) as e:
+			logging.info("Could not write index %s: %s" % (self.index_filename('keys', directory), e))
+			if temporary_filename is not None and os.path.isfile(temporary_filename):
+				os.remove(temporary_filename)
+			return False
+
+		logging.info("Wrote index %s" % (self.index_filename('keys', directory)))
+		return True
+
+	def lookup(self, keys, max_pvalue=None):
+		"""
+
+			Returns the offsets of the lines which contain any of the keys.
+			Given a p-value cutoff, lines whose p-value is known to be at or 
+			above it are left out, before they are read.
+			Args:
+			* [ string or unicode ]
+			* float (p-value cutoff, optional)
+			Returntype: [ int ], sorted
+
+		"""
+		keys = set(encode_key(key) for key in keys)
+		# Keys longer than the indexed ones cannot match, and would be truncated
+		keys = sorted(key for key in keys if key is not None and len(key) <= self.keys.dtype.itemsize)
+		if len(keys) == 0 or len(self.keys) == 0:
+			return []
+
+		keys = numpy.array(keys, dtype=self.keys.dtype)
+		positions = numpy.minimum(numpy.searchsorted(self.keys, keys), len(self.keys) - 1)
+		found = positions[self.keys[positions] == keys]
+
+		offsets = set()
+		for position in found:
+			key_offsets = self.offsets[self.starts[position]:self.starts[position + 1]]
+			if max_pvalue is not None and self.pvalues is not None:
+				key_pvalues = self.pvalues[self.starts[position]:self.starts[position + 1]]
+				# Comparisons to NaN are false, so lines of unknown p-value are kept
+				key_offsets = key_offsets[~(key_pvalues >= max_pvalue)]
+			offsets.update(key_offsets.tolist())
+		return sorted(offsets)
+
+	def lines(self, keys, max_pvalue=None):
+		"""
+
+			Reads the lines which contain any of the keys, in file order
+			Args:
+			* [ string or unicode ]
+			* float (p-value cutoff, optional)
+			Returntype: [ string ]
+
+		"""
+		offsets = self.lookup(keys, max_pvalue)
+		res = []
+		file = open(self.filename)
+		for offset in offsets:
+			file.seek(offset)
+			res.append(file.readline())
+		file.close()
+		return res
+
+def get_index(filename, name, key_function, header_lines=0, pvalue_function=None):
+	"""
+
+		Returns the index of a file, building it if needed
+		Args:
+		* string (filename)
+		* string (index name)
+		* function: string (line) => [ string ] (keys)
+		* int (number of header lines to skip)
+		* function: string (line) => float or None (p-value), optional
+		Returntype: flat_file_index
+
+	"""
+	with indexes_lock:
+		index = indexes.get((filename, name))
+		if index is None or not numpy.array_equal(index.signature(), index.signature_at_load):
+			index = flat_file_index(filename, name, key_function, header_lines, pvalue_function)
+			indexes[(filename, name)] = index
+		return index
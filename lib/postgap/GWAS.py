@@ -32,15 +32,38 @@ import requests
 import json
 import sys
 import logging
-from pprint import pformat
+import threading
+import collections
+from multiprocessing.pool import ThreadPool
 
 import postgap.REST
 import postgap.Globals
+import postgap.EFO
+import postgap.FlatFileIndex
+import postgap.SummaryStats
 from postgap.DataModel import *
 from postgap.Utils import *
 from postgap.GWAS_Lead_Snp_Orientation import *
 
+def read_pvalue(items, column):
+	"""
+
+		Reads the p-value in a column of a split line
+		Args:
+		* [ string ] (items)
+		* int (column)
+		Returntype: float, or None if the column is missing or not a number
+
+	"""
+	try:
+		return float(items[column])
+	except (IndexError, ValueError):
+		return None
+
 class GWAS_source(object):
+	# Flat file of the source in the databases directory, if any
+	data_file = None
+
 	def run(self, diseases, iris):
 		"""
 
@@ -53,6 +76,374 @@ class GWAS_source(object):
 		"""
 		assert False, "This stub should be defined"
 
+	def get_keys(self, line):
+		"""
+
+			Returns the trait IRIs, then the trait description, of a line of 
+			this source's file
+			Args:
+			* string (line)
+			Returntype: [ string ]
+
+		"""
+		assert False, "This stub should be defined"
+
+	def get_pvalue(self, line):
+		"""
+
+			Returns the p-value of a line of this source's file
+			Args:
+			* string (line)
+			Returntype: float, or None if unknown
+
+		"""
+		assert False, "This stub should be defined"
+
+	def get_matching_lines(self, filename, diseases, iris):
+		"""
+
+			Returns the lines of a flat file which mention any of the diseases
+			or IRIs, read through an index of the keys returned by get_keys.
+			Lines whose p-value is not below the GWAS p-value cutoff are 
+			skipped by the index, without being read. The terms of the IRIs
+			which get_association may report are looked up beforehand, all 
+			at once.
+			Args:
+			* string (filename)
+			* [ string ] (trait descriptions)
+			* [ string ] (trait Ontology IRIs)
+			Returntype: [ string ]
+
+		"""
+		index = postgap.FlatFileIndex.get_index(filename, 'traits', self.get_keys, pvalue_function=self.get_pvalue)
+		lines = index.lines(list(diseases or []) + list(iris or []), postgap.Globals.GWAS_PVALUE_CUTOFF)
+
+		# Either the queried IRIs found on a line, or its first IRI if the trait matched
+		iris = set(iris or [])
+		term_iris = set()
+		for line in lines:
+			keys = self.get_keys(line)
+			if len(keys) > 1:
+				term_iris.add(keys[0])
+				term_iris.update(iri for iri in keys[:-1] if iri in iris)
+		postgap.EFO.prefetch_terms(term_iris)
+
+		return lines
+
+	def run_many(self, queries):
+		"""
+
+			Returns the GWAS SNPs associated to each of several queries. The 
+			lines of the source's flat file which match any query are read
+			once, and routed to the queries which mention their IRIs or traits.
+			Sources without a flat file run each query in turn, and may return
+			iterators which read their results lazily, like GWAS_File.
+			Args:
+			* dict(query id => ([ string ] (trait descriptions), [ string ] (trait Ontology IRIs)))
+			Returntype: dict(query id => iterable of GWAS_Association)
+
+		"""
+		if self.data_file is None:
+			# run() may return None when a source has nothing to search
+			return dict((query_id, self.run(diseases, iris) or []) for query_id, (diseases, iris) in queries.items())
+
+		queries_by_key = collections.defaultdict(set)
+		all_diseases = set()
+		all_iris = set()
+		for query_id, (diseases, iris) in queries.items():
+			all_diseases.update(diseases or [])
+			all_iris.update(iris or [])
+			# Keys read from the file are UTF-8 byte strings
+			for key in list(diseases or []) + list(iris or []):
+				queries_by_key[postgap.FlatFileIndex.encode_key(key)].add(query_id)
+
+		res = dict((query_id, []) for query_id in queries)
+		lines = self.get_matching_lines(postgap.Globals.DATABASES_DIR + "/" + self.data_file, all_diseases, all_iris)
+		for line in lines:
+			query_ids = set()
+			for key in self.get_keys(line):
+				query_ids.update(queries_by_key.get(key, []))
+			for query_id in query_ids:
+				diseases, iris = queries[query_id]
+				association = self.get_association(line, diseases or [], iris or [])
+				if association is not None:
+					res[query_id].append(association)
+
+		logging.info("\tFound %i GWAS SNPs associated to %i queries in %s" % (sum(len(associations) for associations in res.values()), len(queries), self.display_name))
+
+		return res
+
+# GWAS Catalog resources fetched during this run, by URL
+known_association_lists = dict()
+known_study_lists = dict()
+known_snp_lists = dict()
+# Study metadata read during this run, by accession
+known_studies = dict()
+# Study accession and SNPs of the associations listed by studies, by association ID
+known_association_studies = dict()
+known_association_snps = dict()
+
+ASSOCIATION_ID_REGEX = re.compile('/associations/([0-9]+)')
+# Template parameters of HAL links, e.g. {?projection}
+LINK_TEMPLATE_REGEX = re.compile('\{[^}]*\}')
+
+def link(hash, name):
+	"""
+
+		Returns the URL of a link of a GWAS Catalog resource, without its
+		template parameters
+		Args:
+		* dict (resource hash)
+		* string (link name)
+		Returntype: string
+
+	"""
+	return LINK_TEMPLATE_REGEX.sub('', hash["_links"][name]["href"])
+
+def association_id(current_association):
+	"""
+
+		Returns the ID of a GWAS Catalog association, read from its link
+		Args:
+		* dict (association hash)
+		Returntype: string or None
+
+	"""
+	match = ASSOCIATION_ID_REGEX.search(link(current_association, "self"))
+	if match is None:
+		return None
+	return match.group(1)
+
+def study_metadata(study_response):
+	"""
+
+		Reads the metadata of a GWAS Catalog study
+		Args:
+		* dict (study hash)
+		Returntype: (study accession, PubMed ID, reported trait, sample size)
+
+	"""
+	"""
+	Example response:
+	{
+		author: "Barber MJ",
+		publicationDate: "2010-03-22T00:00:00.000+0000",
+		publication: "PLoS One",
+		title: "Genome-wide association of lipid-lowering response to statins in combined study populations.",
+		initialSampleSize: "3,928 European ancestry individuals",
+		replicateSampleSize: "NA",
+		pubmedId: "20339536",
+		gxe: false,
+		gxg: false,
+		genomewideArray: true,
+		targetedArray: false,
+		snpCount: 2500000,
+		qualifier: "~",
+		imputed: true,
+		pooled: false,
+		studyDesignComment: null,
+		accessionId: "GCST000635",
+		fullPvalueSet: false,
+		_links: {}
+	}
+	"""
+	study_id = study_response['accessionId']
+	pubmedId = study_response["publicationInfo"]["pubmedId"]
+
+	diseaseTrait = study_response["diseaseTrait"]["trait"]
+	ancestries = study_response["ancestries"]
+	"""
+	Example response:
+	{
+		_embedded: {
+			ancestries: [
+					{
+						type: "initial",
+						numberOfIndividuals: 3928,
+						description: "Los Angeles, CA; ",
+						previouslyReported: null,
+						notes: null,
+						_links: {}
+						}
+					]
+			},
+			_links: {}
+	}
+	"""
+	sample_size = sum(int(ancestry['numberOfIndividuals']) for ancestry in ancestries if ancestry['numberOfIndividuals'] is not None)
+
+	return (study_id, pubmedId, diseaseTrait, sample_size)
+
+class gwas_catalog_fetch_plan(object):
+	"""
+
+		Fetches the GWAS Catalog resources needed by one query. The studies
+		of each trait are read from the trait's study listing, and the 
+		association listing of each study tells which study each association
+		belongs to, so that a study shared by many associations is not 
+		fetched for each of them. Resources already fetched by earlier 
+		queries of the run are reused, and the requests sent and resources 
+		reused are counted by kind. Concurrent fetches are bounded by the 
+		slots semaphore, shared by all the queries of a run.
+
+	"""
+	def __init__(self, slots=None):
+		if slots is None:
+			slots = threading.BoundedSemaphore(1)
+		self.slots = slots
+		self.requests = collections.Counter()
+		self.reused = collections.Counter()
+		self.lock = threading.Lock()
+
+	def count(self, counter, kind):
+		with self.lock:
+			counter[kind] += 1
+
+	def get(self, server, ext, known=None, kind='other'):
+		"""
+
+			Fetches a resource, unless it is already in the known dict
+			Args:
+			* string (server)
+			* string (extension)
+			* dict(string => object) or None
+			* string (kind of resource, for the counts)
+			Returntype: object
+
+		"""
+		if known is not None and server + ext in known:
+			self.count(self.reused, kind)
+			return known[server + ext]
+
+		self.count(self.requests, kind)
+		with self.slots:
+			hash = postgap.REST.get(server, ext)
+		if known is not None:
+			known[server + ext] = hash
+		return hash
+
+	def resolve_studies(self, studies_url, map_function=map):
+		"""
+
+			Reads the studies of a trait from its study listing, then the 
+			association listing of each study, to find out the study of each
+			association of the trait before the associations are processed
+			Args:
+			* string (URL of the study listing of a trait)
+			* function (map, e.g. onto the threads of a pool)
+
+		"""
+		try:
+			studies = self.get(studies_url, "", known_study_lists, 'study listings')["_embedded"]["studies"]
+		except:
+			logging.warning("Could not read the study listing %s, studies will be fetched for each association" % (studies_url))
+			return
+
+		accessions = []
+		for study in studies:
+			try:
+				metadata = study_metadata(study)
+			except (KeyError, TypeError, ValueError):
+				continue
+			known_studies[metadata[0]] = metadata
+			accessions.append((metadata[0], link(study, "associations")))
+
+		map_function(lambda (accession, associations_url): self.read_study_associations(accession, associations_url), accessions)
+
+	def read_study_associations(self, accession, associations_url):
+		"""
+
+			Records the study of each association listed by a study, along 
+			with the SNPs of the association, if the listing includes them
+			Args:
+			* string (study accession)
+			* string (URL of the association listing of the study)
+
+		"""
+		try:
+			associations = self.get(associations_url, "?projection=associationByStudy", known_association_lists, 'study association listings')["_embedded"]["associations"]
+		except:
+			logging.warning("Could not read the associations of study %s" % (accession))
+			return
+
+		for current_association in associations:
+			id = association_id(current_association)
+			if id is None:
+				continue
+			known_association_studies[id] = accession
+			if current_association.get("snps") is not None:
+				known_association_snps[id] = current_association["snps"]
+
+	def get_snps(self, current_association):
+		"""
+
+			Returns the SNPs of an association, from the association listing
+			of its study if it included them, otherwise fetched
+			Args:
+			* dict (association hash)
+			Returntype: [ dict ]
+
+		"""
+		id = association_id(current_association)
+		if id in known_association_snps:
+			self.count(self.reused, 'snps')
+			return known_association_snps[id]
+
+		# e.g. snp_url can be: http://wwwdev.ebi.ac.uk/gwas/beta/rest/api/associations/16513018/snps
+		#
+		snp_response = self.get(link(current_association, "snps"), "", known_snp_lists, 'snps')
+		"""
+		Example response:
+		{
+			_embedded: {
+				singleNucleotidePolymorphisms: [
+						{
+							rsId: "rs3757057",
+							merged: 0,
+							functionalClass: "intron_variant",
+							lastUpdateDate: "2016-12-25T03:48:35.194+0000",
+							_links: {}
+							}
+						]
+			},
+			_links: {}
+		}
+		"""
+		return snp_response["_embedded"]["singleNucleotidePolymorphisms"]
+
+	def get_study(self, current_association):
+		"""
+
+			Returns the metadata of the study of an association, read from the
+			study listing of the trait if the association was found there, 
+			otherwise fetched through the study link of the association
+			Args:
+			* dict (association hash)
+			Returntype: (study accession, PubMed ID, reported trait, sample size)
+
+		"""
+		id = association_id(current_association)
+		accession = known_association_studies.get(id)
+		if accession is not None and accession in known_studies:
+			self.count(self.reused, 'studies')
+			return known_studies[accession]
+
+		metadata = study_metadata(self.get(link(current_association, "study"), "", None, 'studies'))
+		known_studies[metadata[0]] = metadata
+		if id is not None:
+			known_association_studies[id] = metadata[0]
+		return metadata
+
+	def summary(self):
+		"""
+
+			Describes the requests sent and the resources reused, by kind
+			Returntype: string
+
+		"""
+		kinds = sorted(set(self.requests.keys()) | set(self.reused.keys()))
+		return ", ".join("%s: %i sent, %i reused" % (kind, self.requests[kind], self.reused[kind]) for kind in kinds)
+
 class GWASCatalog(GWAS_source):
 	display_name = 'GWAS Catalog'
 
@@ -66,20 +457,71 @@ class GWASCatalog(GWAS_source):
 		"""
 
 		if iris is not None and len(iris) > 0:
-			res = concatenate(self.query(query) for query in iris)
+			terms = list(iris)
+		else:
+			terms = list(diseases)
+
+		# Shared by the queries of this run only, so that concurrent runs do not interfere.
+		# The terms and the associations of each term run on separate pools, so that a
+		# term waiting for its associations never holds a thread they need; the slots
+		# bound the requests in flight over both.
+		threads = max(1, postgap.Globals.GWAS_CATALOG_THREADS)
+		slots = threading.BoundedSemaphore(threads)
+		if threads > 1:
+			pool = ThreadPool(threads)
+			term_pool = ThreadPool(min(threads, max(1, len(terms))))
 		else:
-			res = concatenate(self.query(query) for query in diseases)
+			pool = None
+			term_pool = None
+
+		try:
+			# Concatenated in the order of the terms, as when run serially
+			res = concatenate(self.map(lambda term: self.query(term, slots, pool), terms, term_pool))
+		finally:
+			for current_pool in [pool, term_pool]:
+				if current_pool is not None:
+					current_pool.close()
+					current_pool.join()
 
 		logging.debug("\tFound %i GWAS SNPs associated to diseases (%s) or EFO IDs (%s) in GWAS Catalog" % (len(res), ", ".join(diseases), ", ".join(iris)))
 
 		return res
 
-	def query(self, efo):
+	def map(self, function, items, pool=None):
+		"""
+
+			Applies a function to each item, on the threads of the pool if any
+			Args:
+			* function
+			* [ object ]
+			* ThreadPool or None
+			Returntype: [ object ], in the same order as the items
+
+		"""
+		items = list(items)
+		if pool is None or len(items) <= 1:
+			return map(function, items)
+		return pool.map(function, items)
+
+	def query(self, efo, slots=None, pool=None):
+		"""
+
+			Returns the GWAS SNPs associated to one trait in GWAS Catalog. 
+			The associations of the trait are processed on the threads of the
+			pool, if any, with at most as many requests in flight as slots.
+			Args:
+			* string (trait Ontology IRI)
+			* threading.BoundedSemaphore or None
+			* ThreadPool or None
+			Returntype: [ GWAS_Association ]
+
+		"""
 		logging.info("Querying GWAS catalog for " + efo);
+		plan = gwas_catalog_fetch_plan(slots)
 		server = 'http://www.ebi.ac.uk'
 		url = '/gwas/rest/api/efoTraits/search/findByEfoUri?uri=%s' % (efo)
 
-		hash = postgap.REST.get(server, url)
+		hash = plan.get(server, url)
 
 		'''
 			hash looks like this:
@@ -120,7 +562,6 @@ class GWASCatalog(GWAS_source):
 				}
 			}
 		'''
-
 		list_of_GWAS_Associations = []
 
 		efoTraits = hash["_embedded"]["efoTraits"]
@@ -136,9 +577,13 @@ class GWASCatalog(GWAS_source):
 			try:
 				# e.g.: http://wwwdev.ebi.ac.uk/gwas/beta/rest/api/efoTraits/71/associations
 				#
-				association_response = postgap.REST.get(association_url, "")
+				association_response = plan.get(association_url, "", known_association_lists, 'trait association listings')
 			except:
 				continue
+
+			# e.g.: http://wwwdev.ebi.ac.uk/gwas/beta/rest/api/efoTraits/71/studies
+			#
+			plan.resolve_studies(link(efoTraitHash, "studies"), lambda function, items: self.map(function, items, pool))
 			
 			associations = association_response["_embedded"]["associations"]
 			
@@ -195,205 +640,385 @@ class GWASCatalog(GWAS_source):
 			logging.info("Received " + str(len(associations)) + " associations with SNPs.")
 			logging.info("Fetching SNPs and pvalues.")
 
-			for current_association in associations:
-				# e.g. snp_url can be: http://wwwdev.ebi.ac.uk/gwas/beta/rest/api/associations/16513018/snps
-				#
-				snp_url = current_association["_links"]["snps"]["href"]
-				snp_response = postgap.REST.get(snp_url, "")
-				"""
-				Example response:
-				{
-					_embedded: {
-						singleNucleotidePolymorphisms: [
-								{
-									rsId: "rs3757057",
-									merged: 0,
-									functionalClass: "intron_variant",
-									lastUpdateDate: "2016-12-25T03:48:35.194+0000",
-									_links: {}
-									}
-								]
-					},
-					_links: {}
-				}
-				"""
-				singleNucleotidePolymorphisms = snp_response["_embedded"]["singleNucleotidePolymorphisms"]
-
-				if (len(singleNucleotidePolymorphisms) == 0):
-					# sys.exit("Got no snp for a pvalue!")
-					continue
-
-				study_url = current_association["_links"]["study"]["href"]
-				study_response = postgap.REST.get(study_url, "")
-				"""
-				Example response:
-				{
-					author: "Barber MJ",
-					publicationDate: "2010-03-22T00:00:00.000+0000",
-					publication: "PLoS One",
-					title: "Genome-wide association of lipid-lowering response to statins in combined study populations.",
-					initialSampleSize: "3,928 European ancestry individuals",
-					replicateSampleSize: "NA",
-					pubmedId: "20339536",
-					gxe: false,
-					gxg: false,
-					genomewideArray: true,
-					targetedArray: false,
-					snpCount: 2500000,
-					qualifier: "~",
-					imputed: true,
-					pooled: false,
-					studyDesignComment: null,
-					accessionId: "GCST000635",
-					fullPvalueSet: false,
-					_links: {}
-				}
-				"""
-				study_id = study_response['accessionId']
-				pubmedId = study_response["publicationInfo"]["pubmedId"]
-
-				diseaseTrait = study_response["diseaseTrait"]["trait"]
-				ancestries = study_response["ancestries"]
-				"""
-				Example response:
-				{
-					_embedded: {
-						ancestries: [
-								{
-									type: "initial",
-									numberOfIndividuals: 3928,
-									description: "Los Angeles, CA; ",
-									previouslyReported: null,
-									notes: null,
-									_links: {}
-									}
-								]
-						},
-						_links: {}
-				}
-				"""
-				sample_size = sum(int(ancestry['numberOfIndividuals']) for ancestry in ancestries if ancestry['numberOfIndividuals'] is not None)
-
-				for current_snp in singleNucleotidePolymorphisms:
-					is_dbSNP_accession = "rs" in current_snp["rsId"]
-					
-					if not(is_dbSNP_accession):
-						logging.warning("Did not get a valid dbSNP accession: (" + current_snp["rsId"] + ") from " + snp_url)
-						continue
-					
-					if current_snp["rsId"] == '6':
-						continue
-					if current_snp["rsId"][-1] == u'\xa0':
-						current_snp["rsId"] = current_snp["rsId"].strip()
-
-					logging.debug("    received association with snp rsId: " + '{:12}'.format(current_snp["rsId"]) + " with a pvalue of " + str(current_association["pvalue"]))
-					
-					associations_href = current_snp["_links"]["associations"]["href"]
-					associations = postgap.REST.get(associations_href, ext="")
-
-					riskAlleles = []
-					loci = current_association["loci"]
-					for locus in loci:
-						strongestRiskAlleles = locus["strongestRiskAlleles"]
-						riskAlleles.append(strongestRiskAlleles)
-
-					for riskAllele in riskAlleles:
-						try:
-						
-							if gwas_risk_alleles_present_in_reference(riskAllele):
-								risk_alleles_present_in_reference = True
-								logging.info("Risk allele is present in reference");
-							else:
-								risk_alleles_present_in_reference = False
-								logging.info("Risk allele is not present in reference");
-						
-						except none_of_the_risk_alleles_is_a_substitution_exception as e:
-							logging.warning(str(e))
-							logging.warning("Skipping this snp.")
-							continue
-						
-						except variant_mapping_is_ambiguous_exception:
-							logging.warning("The variant mapping is ambiguous.")
-							logging.warning("Skipping this snp.")
-							continue
-						
-						except some_alleles_present_in_reference_others_not_exception as e:
-							logging.warning(str(e));
-							logging.warning("Skipping this snp.")
-							continue
-						
-						except no_dbsnp_accession_for_snp_exception as e:
-							logging.warning(str(e))
-							logging.warning("Skipping this snp.")
-							continue
-
-						except base_in_allele_missing_exception as e:
-							logging.warning(str(e));
-							logging.warning("Skipping this snp.")
-							continue
-
-						except cant_determine_base_at_snp_in_reference_exception as e:
-							logging.warning(str(e));
-							logging.warning("Skipping this snp.")
-							continue
-						
-						except gwas_data_integrity_exception as e:
-							logging.warning(str(e));
-							logging.warning("Skipping this snp.")
-							continue
-
-						ci_start_value = None
-						ci_end_value = None
-
-						if not current_association["range"] == None:
-							ci_values = re.findall('\d+\.\d+', current_association["range"])
-
-							if ci_values:
-								try:
-									ci_start_value = ci_values[0]
-									ci_end_value = ci_values[1]
-								except:
-									pass
-
-
-						list_of_GWAS_Associations.append(
-							GWAS_Association(
-								disease = Disease(
-									name = efoTraitName,
-									efo  = efo
-								),
-								reported_trait = diseaseTrait,
-								snp     = current_snp["rsId"],
-								pvalue  = current_association["pvalue"],
-								pvalue_description = current_association["pvalueDescription"],
-								source  = 'GWAS Catalog',
-								publication = 'PMID' + pubmedId,
-								study   = study_id,
-								sample_size = sample_size,
-								
-								# For fetching additional information like risk allele later, if needed.
-								# E.g.: http://wwwdev.ebi.ac.uk/gwas/beta/rest/api/singleNucleotidePolymorphisms/9765
-								rest_hash = current_snp,
-								risk_alleles_present_in_reference = risk_alleles_present_in_reference,
-								
-								odds_ratio                 = current_association["orPerCopyNum"],
-								odds_ratio_ci_start        = ci_start_value,
-								odds_ratio_ci_end 		   = ci_end_value,
-								beta_coefficient           = current_association["betaNum"],
-								beta_coefficient_unit      = current_association["betaUnit"],
-								beta_coefficient_direction = current_association["betaDirection"]
-							)
-						)
+			list_of_GWAS_Associations += concatenate(self.map(lambda current_association: self.get_associations(plan, efo, efoTraitName, current_association), associations, pool))
 
 		if len(list_of_GWAS_Associations) > 0:
 			logging.info("Fetched " +  str(len(list_of_GWAS_Associations)) + " SNPs and pvalues.")
 		if len(list_of_GWAS_Associations) == 0:
 			logging.info("Found no associated SNPs and pvalues.")
+		logging.info("Sent %i GWAS Catalog requests for %s, reused %i resources (%s)" % (sum(plan.requests.values()), efo, sum(plan.reused.values()), plan.summary()))
 	
 		return list_of_GWAS_Associations
 
+	def get_associations(self, plan, efo, efoTraitName, current_association):
+		"""
+
+			Returns the GWAS SNPs of one GWAS Catalog association. The study 
+			is only fetched once some SNP and risk allele are known to be 
+			reported.
+			Args:
+			* gwas_catalog_fetch_plan
+			* string (trait Ontology IRI)
+			* string (trait name)
+			* dict (association hash)
+			Returntype: [ GWAS_Association ]
+
+		"""
+		singleNucleotidePolymorphisms = []
+		for current_snp in plan.get_snps(current_association):
+			is_dbSNP_accession = "rs" in current_snp["rsId"]
+			
+			if not(is_dbSNP_accession):
+				logging.warning("Did not get a valid dbSNP accession: (" + current_snp["rsId"] + ") from association " + str(association_id(current_association)))
+				continue
+			
+			if current_snp["rsId"] == '6':
+				continue
+			if current_snp["rsId"][-1] == u'\xa0':
+				current_snp["rsId"] = current_snp["rsId"].strip()
+
+			singleNucleotidePolymorphisms.append(current_snp)
+
+		if (len(singleNucleotidePolymorphisms) == 0):
+			return []
+
+		# The risk alleles belong to the association, not to each of its SNPs
+		with plan.slots:
+			risk_allele_orientations = self.get_risk_allele_orientations(current_association)
+		if len(risk_allele_orientations) == 0:
+			return []
+
+		study_id, pubmedId, diseaseTrait, sample_size = plan.get_study(current_association)
+
+		ci_start_value = None
+		ci_end_value = None
+
+		if not current_association["range"] == None:
+			ci_values = re.findall('\d+\.\d+', current_association["range"])
+
+			if ci_values:
+				try:
+					ci_start_value = ci_values[0]
+					ci_end_value = ci_values[1]
+				except:
+					pass
+
+		res = []
+		for current_snp in singleNucleotidePolymorphisms:
+			logging.debug("    received association with snp rsId: " + '{:12}'.format(current_snp["rsId"]) + " with a pvalue of " + str(current_association["pvalue"]))
+
+			for risk_alleles_present_in_reference in risk_allele_orientations:
+				res.append(
+					GWAS_Association(
+						disease = Disease(
+							name = efoTraitName,
+							efo  = efo
+						),
+						reported_trait = diseaseTrait,
+						snp     = current_snp["rsId"],
+						pvalue  = current_association["pvalue"],
+						pvalue_description = current_association["pvalueDescription"],
+						source  = 'GWAS Catalog',
+						publication = 'PMID' + pubmedId,
+						study   = study_id,
+						sample_size = sample_size,
+						
+						# For fetching additional information like risk allele later, if needed.
+						# E.g.: http://wwwdev.ebi.ac.uk/gwas/beta/rest/api/singleNucleotidePolymorphisms/9765
+						rest_hash = current_snp,
+						risk_alleles_present_in_reference = risk_alleles_present_in_reference,
+						
+						odds_ratio                 = current_association["orPerCopyNum"],
+						odds_ratio_ci_start        = ci_start_value,
+						odds_ratio_ci_end 		   = ci_end_value,
+						beta_coefficient           = current_association["betaNum"],
+						beta_coefficient_unit      = current_association["betaUnit"],
+						beta_coefficient_direction = current_association["betaDirection"]
+					)
+				)
+
+		return res
+
+	def get_risk_allele_orientations(self, current_association):
+		"""
+
+			Checks whether the risk alleles of each locus of an association
+			are present in the reference, skipping inconsistent loci
+			Args:
+			* dict (association hash)
+			Returntype: [ boolean ]
+
+		"""
+		res = []
+		for locus in current_association["loci"]:
+			riskAllele = locus["strongestRiskAlleles"]
+			try:
+			
+				if gwas_risk_alleles_present_in_reference(riskAllele):
+					res.append(True)
+					logging.info("Risk allele is present in reference");
+				else:
+					res.append(False)
+					logging.info("Risk allele is not present in reference");
+			
+			except none_of_the_risk_alleles_is_a_substitution_exception as e:
+				logging.warning(str(e))
+				logging.warning("Skipping this snp.")
+			
+			except variant_mapping_is_ambiguous_exception:
+				logging.warning("The variant mapping is ambiguous.")
+				logging.warning("Skipping this snp.")
+			
+			except some_alleles_present_in_reference_others_not_exception as e:
+				logging.warning(str(e));
+				logging.warning("Skipping this snp.")
+			
+			except no_dbsnp_accession_for_snp_exception as e:
+				logging.warning(str(e))
+				logging.warning("Skipping this snp.")
+
+			except base_in_allele_missing_exception as e:
+				logging.warning(str(e));
+				logging.warning("Skipping this snp.")
+
+			except cant_determine_base_at_snp_in_reference_exception as e:
+				logging.warning(str(e));
+				logging.warning("Skipping this snp.")
+			
+			except gwas_data_integrity_exception as e:
+				logging.warning(str(e));
+				logging.warning("Skipping this snp.")
+
+		return res
+
+class GWAS_Catalog_File(GWAS_source):
+	display_name = "GWAS Catalog File"
+
+	def run(self, diseases, iris):
+		"""
+
+			Returns all GWAS SNPs associated to a disease in the GWAS Catalog
+			download (GWAS_Catalog.txt), through an index by mapped trait URI 
+			and reported trait
+			Args:
+			* [ string ] (trait descriptions)
+			* [ string ] (trait Ontology IRIs)
+			Returntype: [ GWAS_Association ]
+
+		"""
+		filename = postgap.Globals.DATABASES_DIR + "/GWAS_Catalog.txt"
+		columns = self.read_header(filename)
+		index = postgap.FlatFileIndex.get_index(filename, 'traits', lambda line: self.get_catalog_keys(line, columns), header_lines=1, pvalue_function=lambda line: read_pvalue(line.rstrip('\n').split('\t'), columns['P-VALUE']))
+
+		if iris is not None and len(iris) > 0:
+			lines = index.lines(iris, postgap.Globals.GWAS_PVALUE_CUTOFF)
+		else:
+			lines = index.lines(diseases, postgap.Globals.GWAS_PVALUE_CUTOFF)
+		trait_names = self.get_trait_names(lines, columns, iris)
+		res = concatenate(self.get_associations(line, columns, diseases, iris, trait_names) for line in lines)
+
+		logging.info("\tFound %i GWAS SNPs associated to diseases (%s) or EFO IDs (%s) in GWAS Catalog File" % (len(res), ", ".join(diseases), ", ".join(iris)))
+
+		return res
+
+	def read_header(self, filename):
+		"""
+
+			Reads the column names of the GWAS Catalog download
+			Args:
+			* string (filename)
+			Returntype: dict(string => int)
+
+		"""
+		file = open(filename)
+		header = file.readline().rstrip('\n').split('\t')
+		file.close()
+		return dict((column, i) for i, column in enumerate(header))
+
+	def get_catalog_keys(self, line, columns):
+		items = line.rstrip('\n').split('\t')
+		if len(items) < len(columns):
+			return []
+		return self.get_iris(items, columns) + [items[columns['DISEASE/TRAIT']]]
+
+	def get_iris(self, items, columns):
+		return [iri.strip() for iri in items[columns['MAPPED_TRAIT_URI']].split(',') if iri.strip() != '']
+
+	def get_trait_names(self, lines, columns, iris):
+		"""
+
+			Finds the names of the mapped traits of the matching lines. The
+			MAPPED_TRAIT column lists them separated by commas, which trait 
+			names may also contain, so a name is read from a line mapped to
+			that trait alone, or from a line whose names and IRIs split 
+			evenly. The names of the remaining IRIs are looked up in OLS, all
+			at once.
+			Args:
+			* [ string ] (lines)
+			* dict(string => int) (columns)
+			* [ string ] (trait Ontology IRIs)
+			Returntype: dict(string (IRI) => string (trait name))
+
+		"""
+		res = dict()
+		reported_iris = set()
+		for line in lines:
+			items = line.rstrip('\n').split('\t')
+			if len(items) < len(columns):
+				continue
+			line_iris = self.get_iris(items, columns)
+			names = items[columns['MAPPED_TRAIT']]
+			if len(line_iris) == 1:
+				res[line_iris[0]] = names
+			elif len(names.split(', ')) == len(line_iris):
+				for iri, name in zip(line_iris, names.split(', ')):
+					res.setdefault(iri, name)
+
+			# The IRIs get_associations reports for the line
+			matched_iris = [iri for iri in line_iris if iri in (iris or [])]
+			reported_iris.update(matched_iris or line_iris[:1])
+
+		postgap.EFO.prefetch_terms(iri for iri in reported_iris if iri not in res)
+		return res
+
+	def get_associations(self, line, columns, diseases, iris, trait_names=None):
+		'''
+
+			GWAS Catalog download ("alternative" format), relevant columns:
+			* PUBMEDID
+			* DISEASE/TRAIT
+			* INITIAL SAMPLE SIZE
+			* REPLICATION SAMPLE SIZE
+			* STRONGEST SNP-RISK ALLELE (separated like SNPS)
+			* SNPS (separated by ';' or ' x ' for haplotypes and interactions)
+			* MERGED
+			* CONTEXT
+			* P-VALUE
+			* P-VALUE (TEXT)
+			* OR or BETA
+			* 95% CI (TEXT), e.g. "[1.05-1.12]" or "[0.01-0.03] unit increase"
+			* MAPPED_TRAIT (comma separated)
+			* MAPPED_TRAIT_URI (comma separated)
+			* STUDY ACCESSION
+
+			The records match those of GWASCatalog: risk allele orientations
+			are computed the same way from the strongest risk alleles, with 
+			one Ensembl query per lead SNP, and rest_hash holds the rsId, 
+			merged and functionalClass fields of the GWAS Catalog SNP 
+			resource. The other fields of that resource are not in the 
+			download.
+
+		'''
+		items = line.rstrip('\n').split('\t')
+		if len(items) < len(columns):
+			return []
+
+		try:
+			pvalue = float(items[columns['P-VALUE']])
+		except ValueError:
+			return []
+
+		line_iris = self.get_iris(items, columns)
+		matched_iris = [iri for iri in line_iris if iri in iris]
+		reported_trait = items[columns['DISEASE/TRAIT']]
+		if len(matched_iris) == 0:
+			if reported_trait not in diseases or len(line_iris) == 0:
+				return []
+			matched_iris = line_iris[:1]
+
+		if trait_names is None:
+			trait_names = self.get_trait_names([line], columns, iris)
+
+		pvalue_description = items[columns['P-VALUE (TEXT)']]
+		if pvalue_description == '':
+			pvalue_description = None
+
+		sample_size = sum(int(number.replace(',', '')) for column in ['INITIAL SAMPLE SIZE', 'REPLICATION SAMPLE SIZE'] for number in re.findall('\d[\d,]*', items[columns[column]]))
+
+		odds_ratio = None
+		odds_ratio_ci_start = None
+		odds_ratio_ci_end = None
+		beta_coefficient = None
+		beta_coefficient_unit = None
+		beta_coefficient_direction = None
+		effect_size = items[columns['OR or BETA']]
+		ci_text = items[columns['95% CI (TEXT)']]
+		ci_values = re.findall('\d+\.\d+', ci_text)
+		effect_direction = re.search('([^\]]*?)\s*(increase|decrease)', ci_text)
+		try:
+			if effect_direction is not None:
+				beta_coefficient = float(effect_size)
+				beta_coefficient_unit = effect_direction.group(1).strip()
+				beta_coefficient_direction = effect_direction.group(2)
+			elif effect_size != '':
+				odds_ratio = float(effect_size)
+		except ValueError:
+			pass
+		# As in GWASCatalog, the interval is reported whatever the effect size
+		if len(ci_values) >= 2:
+			odds_ratio_ci_start = ci_values[0]
+			odds_ratio_ci_end = ci_values[1]
+
+		snps = []
+		for snp in re.split('[;,]| x ', items[columns['SNPS']]):
+			snp = snp.strip()
+			if not snp.startswith('rs'):
+				logging.warning("Did not get a valid dbSNP accession: (" + snp + ") from " + items[columns['STUDY ACCESSION']])
+				continue
+			snps.append(snp)
+		if len(snps) == 0:
+			return []
+
+		# The strongest risk alleles stand for the loci of the REST association
+		risk_alleles = [allele.strip() for allele in re.split('[;,]| x ', items[columns['STRONGEST SNP-RISK ALLELE']]) if allele.strip() != '']
+		risk_allele_orientations = GWASCatalog().get_risk_allele_orientations({"loci": [{"strongestRiskAlleles": [{"riskAlleleName": allele}]} for allele in risk_alleles]})
+		if len(risk_allele_orientations) == 0:
+			return []
+
+		merged = items[columns['MERGED']] if 'MERGED' in columns else ''
+		context = items[columns['CONTEXT']] if 'CONTEXT' in columns else ''
+
+		res = []
+		for iri in matched_iris:
+			if iri in trait_names:
+				trait_name = trait_names[iri]
+			else:
+				trait_name = postgap.EFO.term(iri)
+
+			for snp, risk_alleles_present_in_reference in [(snp, orientation) for snp in snps for orientation in risk_allele_orientations]:
+				res.append(GWAS_Association(
+					disease = Disease(
+						name = trait_name,
+						efo  = iri
+					),
+					reported_trait = reported_trait,
+					snp     = snp,
+					pvalue  = pvalue,
+					pvalue_description = pvalue_description,
+					source  = 'GWAS Catalog',
+					publication = 'PMID' + items[columns['PUBMEDID']],
+					study   = items[columns['STUDY ACCESSION']],
+					sample_size = sample_size,
+					rest_hash = {
+						'rsId': snp,
+						'merged': int(merged) if merged.isdigit() else None,
+						'functionalClass': context if context != '' else None
+					},
+					risk_alleles_present_in_reference = risk_alleles_present_in_reference,
+					odds_ratio                 = odds_ratio,
+					odds_ratio_ci_start        = odds_ratio_ci_start,
+					odds_ratio_ci_end          = odds_ratio_ci_end,
+					beta_coefficient           = beta_coefficient,
+					beta_coefficient_unit      = beta_coefficient_unit,
+					beta_coefficient_direction = beta_coefficient_direction
+				))
+
+		return res
+
 class Neale_UKB(GWAS_source):
 	display_name = "Neale_UKB"
+	data_file = "Neale_UKB.txt"
+
 	def run(self, diseases, iris):
 		"""
 
@@ -410,14 +1035,23 @@ class Neale_UKB(GWAS_source):
 		if diseases == None or len(diseases) == 0:
 			return []
 
-		file = open(postgap.Globals.DATABASES_DIR+"/Neale_UKB.txt")
-		res = [ self.get_association(line, diseases, iris) for line in file ]
+		lines = self.get_matching_lines(postgap.Globals.DATABASES_DIR + "/" + self.data_file, diseases, iris)
+		res = [ self.get_association(line, diseases, iris) for line in lines ]
 		res = filter(lambda X: X is not None, res)
 
 		logger.info("\tFound %i GWAS SNPs associated to diseases (%s) or EFO IDs (%s) in Neale_UKB" % (len(res), ", ".join(diseases), ", ".join(iris)))
 
 		return res
 
+	def get_keys(self, line):
+		items = line.strip().split('\t')
+		if len(items) != 10:
+			return []
+		return [items[2]]
+
+	def get_pvalue(self, line):
+		return read_pvalue(line.strip().split('\t'), 3)
+
 	def get_association(self, line, diseases, iris):
 		'''
 			Neale_UKB file format:
@@ -452,6 +1086,8 @@ class Neale_UKB(GWAS_source):
 
 class GRASP(GWAS_source):
 	display_name = "GRASP"
+	data_file = "GRASP.txt"
+
 	def run(self, diseases, iris):
 		"""
 
@@ -462,14 +1098,25 @@ class GRASP(GWAS_source):
 			Returntype: [ GWAS_Association ]
 
 		"""
-		file = open(postgap.Globals.DATABASES_DIR+"/GRASP.txt")
-		res = [ self.get_association(line, diseases, iris) for line in file ]
+		lines = self.get_matching_lines(postgap.Globals.DATABASES_DIR + "/" + self.data_file, diseases, iris)
+		res = [ self.get_association(line, diseases, iris) for line in lines ]
 		res = filter(lambda X: X is not None, res)
 
 		logging.info("\tFound %i GWAS SNPs associated to diseases (%s) or EFO IDs (%s) in GRASP" % (len(res), ", ".join(diseases), ", ".join(iris)))
 
 		return res
 
+	def get_keys(self, line):
+		items = line.rstrip().split('\t')
+		if len(items) <= 12:
+			return []
+		if len(items) <= 70:
+			return [items[12]]
+		return items[70].split(',') + [items[12]]
+
+	def get_pvalue(self, line):
+		return read_pvalue(line.rstrip().split('\t'), 10)
+
 	def get_association(self, line, diseases, iris):
 		'''
 
@@ -622,6 +1269,7 @@ class GRASP(GWAS_source):
 
 class Phewas_Catalog(GWAS_source):
 	display_name = "Phewas Catalog"
+	data_file = "Phewas_Catalog.txt"
 	
 	def run(self, diseases, iris):
 		"""
@@ -633,14 +1281,23 @@ class Phewas_Catalog(GWAS_source):
 			Returntype: [ GWAS_Association ]
 
 		"""
-		file = open(postgap.Globals.DATABASES_DIR+"/Phewas_Catalog.txt")
-		res = [ self.get_association(line, diseases, iris) for line in file ]
+		lines = self.get_matching_lines(postgap.Globals.DATABASES_DIR + "/" + self.data_file, diseases, iris)
+		res = [ self.get_association(line, diseases, iris) for line in lines ]
 		res = filter(lambda X: X is not None, res)
 
 		logging.info("\tFound %i GWAS SNPs associated to diseases (%s) or EFO IDs (%s) in Phewas Catalog" % (len(res), ", ".join(diseases), ", ".join(iris)))
 
 		return res
 
+	def get_keys(self, line):
+		items = line.rstrip().split('\t')
+		if len(items) <= 9:
+			return []
+		return items[9].split(',') + [items[2]]
+
+	def get_pvalue(self, line):
+		return read_pvalue(line.rstrip().split('\t'), 4)
+
 	def get_association(self, line, diseases, iris):
 		'''
 
@@ -707,54 +1364,33 @@ class Phewas_Catalog(GWAS_source):
 class GWAS_File(GWAS_source):
 	display_name = "GWAS File"
 	
-	def create_gwas_association_collector(self):
-		
-		class gwas_association_collector:
-			
-			def __init__(self):
-				self.found_list = []
-			
-			def add_to_found_list(self, gwas_association):
-				self.found_list.append(gwas_association)
-			
-			def get_found_list(self):
-				return self.found_list
-		
-		return gwas_association_collector()
-
-	
 	def run(self, diseases, iris):
 		"""
 
-			Returns all GWAS SNPs associated to a disease in known gwas files
+			Returns the GWAS SNPs of the summary statistics file below the 
+			p-value cutoff. They are read one batch at a time as the result
+			is iterated over, so that the file is never held in memory.
 			Args:
 			* [ string ] (trait descriptions)
 			* [ string ] (trait Ontology IRIs)
-			Returntype: [ GWAS_Association ]
+			Returntype: iterator of GWAS_Association
 
 		"""
 		
 		gwas_data_file = postgap.Globals.GWAS_SUMMARY_STATS_FILE
 			
 		if gwas_data_file is None:
-			return None
+			return
 		
 		logging.info( "gwas_data_file = " + gwas_data_file )
 		
-		pvalue_filtered_gwas_associations = self.create_gwas_association_collector()
-		
-		pvalue_filter = self.create_pvalue_filter(pvalue_threshold = postgap.Globals.GWAS_PVALUE_CUTOFF)
+		count = 0
+		for batch in postgap.SummaryStats.association_batches(gwas_data_file, pvalue_threshold = postgap.Globals.GWAS_PVALUE_CUTOFF):
+			count += len(batch)
+			for gwas_association in batch:
+				yield gwas_association
 		
-		self.parse_gwas_data_file(
-			gwas_data_file                    = gwas_data_file,
-			want_this_gwas_association_filter = pvalue_filter,
-			callback                          = pvalue_filtered_gwas_associations.add_to_found_list,
-			max_lines_to_return_threshold     = None,
-		)
-		
-		logging.info( "Found " + str(len(pvalue_filtered_gwas_associations.get_found_list())) + " gwas associations with a pvalue of " + str(postgap.Globals.GWAS_PVALUE_CUTOFF) + " or less.")
-		
-		return pvalue_filtered_gwas_associations.get_found_list()
+		logging.info( "Found " + str(count) + " gwas associations with a pvalue of " + str(postgap.Globals.GWAS_PVALUE_CUTOFF) + " or less.")
 	
 	def create_gwas_clusters_with_pvalues_from_file(self, gwas_clusters, gwas_data_file):
 		
@@ -770,29 +1406,20 @@ class GWAS_File(GWAS_source):
 
 	def create_gwas_cluster_with_pvalues_from_file(self, gwas_cluster, gwas_data_file):
 
-		ld_gwas_associations = self.create_gwas_association_collector()
-		
-		self.parse_gwas_data_file(
-			gwas_data_file                    = gwas_data_file, 
-			want_this_gwas_association_filter = self.create_snp_filter(gwas_cluster.ld_snps),
-			callback                          = ld_gwas_associations.add_to_found_list,
-			max_lines_to_return_threshold     = len(gwas_cluster.ld_snps)
-		)
-		logging.info( "ld_gwas_associations.found_list: " + pformat(ld_gwas_associations.get_found_list()) )
+		# rsID => (pvalue, beta), read from the cluster's region if the file is tabix indexed
+		ld_snp_results = postgap.SummaryStats.get_snp_results(gwas_data_file, gwas_cluster.ld_snps)
 		
 		ld_snps_converted_to_gwas_snps = []
 		ld_snps_that_could_not_be_converted_to_gwas_snps = []
 		
 		for ld_snp in gwas_cluster.ld_snps:
 			
-			gwas_associations_for_ld_snp = filter(lambda x : ld_snp.rsID == x.snp.rsID, ld_gwas_associations.get_found_list())
-			
 			# If one could be found, add that.
-			if len(gwas_associations_for_ld_snp) == 1:
+			if ld_snp.rsID in ld_snp_results:
 				
 				logging.info("Found " + ld_snp.rsID + " in the file! All good.")
-				gwas_association = gwas_associations_for_ld_snp[0] 
-				assert type(gwas_association) is GWAS_Association, "gwas_association is GWAS_Association."
+				pvalue, beta = ld_snp_results[ld_snp.rsID]
+				gwas_association = postgap.SummaryStats.create_association(ld_snp.rsID, pvalue, beta)
 			
 				gwas_snp = GWAS_SNP(
 					snp      = gwas_association.snp,
@@ -803,99 +1430,23 @@ class GWAS_File(GWAS_source):
 				)
 				ld_snps_converted_to_gwas_snps.append(gwas_snp)
 			
-			# If more than one assocation was found: error.	
-			if len(gwas_associations_for_ld_snp) > 1:
-				logging.info("Found more than one matching assocation for " + ld_snp.rsID + " in the file. Bad!")
-				sys.exit(1)
-			
 			# If the snp wasn't found, add it as a regular snp.
-			if len(gwas_associations_for_ld_snp) == 0:
+			else:
 				logging.info("Found no matching assocation for " + ld_snp.rsID + " in the file. Including it as regular snp.")
 				ld_snps_that_could_not_be_converted_to_gwas_snps.append(ld_snp)
 				
 		proper_gwas_cluster = GWAS_Cluster(
 			gwas_snps          = gwas_cluster.gwas_snps,
 			ld_snps            = ld_snps_converted_to_gwas_snps + ld_snps_that_could_not_be_converted_to_gwas_snps,
-			finemap_posteriors = None,
+			ld_matrix          = None,
+			z_scores           = None,
+			gwas_configuration_posteriors = None,
 		)
 		return proper_gwas_cluster
-	
-	def create_snp_filter(self, snps):
-		
-		rsIDs_to_look_for = []
-		
-		for snp in snps:
-			rsIDs_to_look_for.append(snp.rsID)
-		
-		logging.info( "Searching for snps: " + pformat(rsIDs_to_look_for) )
-		
-		def snp_name_filter(gwas_association):
-			
-			rsID  = gwas_association.snp.rsID
-			found = rsID in rsIDs_to_look_for
-			
-			return found
-		
-		return snp_name_filter
-
-	def create_pvalue_filter(self, pvalue_threshold):
-		return lambda pvalue: float(pvalue) < pvalue_threshold
-	
-	def parse_gwas_data_file(
-			self, 
-			gwas_data_file, 
-			callback, 
-			want_this_gwas_association_filter,
-			max_lines_to_return_threshold = None,
-		):
-		
-
-		file = open(gwas_data_file)
-		column_labels = file.readline().strip().split('\t')
-
-		number_of_lines_returned = 0
-		for line in file:
-			items = line.rstrip().split('\t')
-			
-			parsed = dict()
-			for column_index, column_label in enumerate(column_labels):
-				parsed[column_label] = items[column_index]
-			
-			if not want_this_gwas_association_filter(parsed["p-value"]):
-				continue
-
-			try:
-				# TODO insert study info (from command line? config file?)
-				gwas_association = GWAS_Association(
-					pvalue                            = float(parsed["p-value"]),
-					pvalue_description		  = 'Manual',
-					snp                               = parsed["variant_id"],
-					disease                           = Disease(name = 'Manual', efo = 'EFO_Manual'),
-					reported_trait                    = "Manual",
-					source                            = "Manual",
-					publication			  = "PMID000",
-					study                             = "Manual",
-					sample_size                       = 1000,
-					odds_ratio                        = None,
-					odds_ratio_ci_start		  = None,
-					odds_ratio_ci_end		  = None,
-					beta_coefficient                  = float(parsed["beta"]),
-					beta_coefficient_unit             = "Manual",
-					beta_coefficient_direction        = "Manual",
-					rest_hash                         = None,
-					risk_alleles_present_in_reference = None,
-				)
-			except ValueError:
-				continue
-
-			callback(gwas_association)
-			
-			number_of_lines_returned += 1
-			if max_lines_to_return_threshold is not None and number_of_lines_returned>=max_lines_to_return_threshold:
-				break
 
 class GWAS_DB(GWAS_source):
 	display_name = "GWAS DB"
+	data_file = "GWAS_DB.txt"
 	
 	def run(self, diseases, iris):
 		"""
@@ -907,15 +1458,24 @@ class GWAS_DB(GWAS_source):
 			Returntype: [ GWAS_Association ]
 
 		"""
-		file = open(postgap.Globals.DATABASES_DIR+"/GWAS_DB.txt")
+		lines = self.get_matching_lines(postgap.Globals.DATABASES_DIR + "/" + self.data_file, diseases, iris)
 	
-		res = [ self.get_association(line, diseases, iris) for line in file ]
+		res = [ self.get_association(line, diseases, iris) for line in lines ]
 		res = filter(lambda X: X is not None, res)
 
 		logging.info("\tFound %i GWAS SNPs associated to diseases (%s) or EFO IDs (%s) in GWAS DB" % (len(res), ", ".join(diseases), ", ".join(iris)))
 
 		return res
 
+	def get_keys(self, line):
+		items = line.rstrip().split('\t')
+		if len(items) <= 6:
+			return []
+		return items[6].split(',') + [items[5]]
+
+	def get_pvalue(self, line):
+		return read_pvalue(line.rstrip().split('\t'), 3)
+
 	def get_association(self, line, diseases, iris):
 		'''
 
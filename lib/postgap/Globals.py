@@ -58,8 +58,40 @@ finemap_gwas_clusters_directory = None
 
 GWAS_PVALUE_CUTOFF = 1e-4
 
+# Clumping of summary statistics SNPs: width of the window around each lead SNP, and r2 cutoff
+CLUMP_WINDOW = 500000
+CLUMP_R2 = 0.7
+
+GWAS_CATALOG_THREADS = 1
+
 GWAS_SUMMARY_STATS_FILE = None
 
+# Labels of the columns of the summary statistics file
+SUMMARY_STATS_COLUMNS = {
+	'variant_id': 'variant_id',
+	'p-value': 'p-value',
+	'beta': 'beta',
+	'chromosome': 'chromosome',
+	'base_pair_location': 'base_pair_location'
+}
+
 PERFORM_BAYESIAN = False
 
 ALL_TISSUES=[]
+
+REST_CACHE_FILE = None
+REST_CACHE_MAX_SIZE = 1024 * 1024 * 1024
+REST_POOL_SIZE = 10
+REST_TIMEOUT = 180
+REST_MAX_IN_FLIGHT = 10
+REST_MAX_RETRIES = 10
+REST_RETRY_BUDGET = 1000
+REST_HOST_RETRY_BUDGET = 500
+REST_RECORD_DIR = None
+REST_REPLAY_DIR = None
+REST_REPLAY_LATENCY = 0
+REST_REPLAY_ERROR_RATE = 0
+REST_REPLAY_SEED = 0
+LOOKUP_SNAPSHOT_FILE = None
+# Directory of the flat file indexes which cannot be written next to their file
+INDEX_CACHE_DIR = None
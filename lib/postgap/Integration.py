@@ -28,6 +28,7 @@ limitations under the License.
 
 """
 import collections
+import itertools
 import math
 import os
 import sys
@@ -53,6 +54,10 @@ import sys
 
 phenotype_cache = ()
 
+# Genes further than this from all LD SNPs of a cluster (bp) are not prefetched,
+# GTEx eQTLs being called within 1Mb of the TSS
+CLUSTER_GENE_WINDOW = 1000000
+
 def diseases_to_genes(diseases, efos, population, tissues):
 	"""
 
@@ -67,6 +72,21 @@ def diseases_to_genes(diseases, efos, population, tissues):
 	"""
 	return gwas_snps_to_genes(diseases_to_gwas_snps(diseases, efos), population, tissues)
 
+def diseases_to_genes_many(queries, population, tissues):
+	"""
+
+		Associates genes to each of several lists of diseases, scanning the
+		GWAS databases once for all of them
+		Args:
+		* dict(query id => ([ string ] (trait descriptions), [ string ] (trait EFO identifiers)))
+		* string (population name)
+		* [ string ] (tissue names)
+		Returntype: dict(query id => [ GeneCluster_Association ])
+
+	"""
+	gwas_snps = diseases_to_gwas_snps_many(queries)
+	return dict((query_id, gwas_snps_to_genes(gwas_snps[query_id], population, tissues)) for query_id in queries)
+
 def diseases_to_gwas_snps(diseases, efos):
 	"""
 
@@ -77,9 +97,22 @@ def diseases_to_gwas_snps(diseases, efos):
 		Returntype: [ GWAS_SNP ]
 
 	"""
-	res = filter(lambda X: X.pvalue < postgap.Globals.GWAS_PVALUE_CUTOFF, scan_disease_databases(diseases, efos))
+	return diseases_to_gwas_snps_many({None: (diseases, efos)})[None]
 
-	logging.info("Found %i GWAS SNPs associated to diseases (%s) or EFO IDs (%s) after p-value filter (%f)" % (len(res), ", ".join(diseases), ", ".join(efos), postgap.Globals.GWAS_PVALUE_CUTOFF))
+def diseases_to_gwas_snps_many(queries):
+	"""
+
+		Associates gwas_snps from several lists of diseases
+		Args:
+		* dict(query id => ([ string ] (trait descriptions - free strings), [ string ] (trait EFO identifiers)))
+		Returntype: dict(query id => [ GWAS_SNP ])
+
+	"""
+	res = dict()
+	for query_id, gwas_snps in scan_disease_databases_many(queries).items():
+		diseases, efos = queries[query_id]
+		res[query_id] = filter(lambda X: X.pvalue < postgap.Globals.GWAS_PVALUE_CUTOFF, gwas_snps)
+		logging.info("Found %i GWAS SNPs associated to diseases (%s) or EFO IDs (%s) after p-value filter (%f)" % (len(res[query_id]), ", ".join(diseases), ", ".join(efos), postgap.Globals.GWAS_PVALUE_CUTOFF))
 
 	return res
 
@@ -92,20 +125,53 @@ def scan_disease_databases(diseases, efos):
 		* [ string ] (trait EFO identifiers)
 		Returntype: [ GWAS_SNP ]
 
+	"""
+	return scan_disease_databases_many({None: (diseases, efos)})[None]
+
+def scan_disease_databases_many(queries):
+	"""
+
+		Associates gwas_snps from several lists of diseases, each GWAS 
+		source serving all the queries in a single pass
+		Args:
+		* dict(query id => ([ string ] (trait descriptions), [ string ] (trait EFO identifiers)))
+		Returntype: dict(query id => [ GWAS_SNP ])
+
 	"""
 	if postgap.Globals.GWAS_SUMMARY_STATS_FILE is not None:
-		gwas_associations = postgap.GWAS.GWAS_File().run(diseases, efos)
+		sources = [postgap.GWAS.GWAS_File]
 	elif postgap.Globals.GWAS_adaptors == None:
-		logging.info("Searching for GWAS SNPs associated to diseases (%s) or EFO IDs (%s) in all databases" % (", ".join(diseases), ", ".join(efos)))
-		gwas_associations = concatenate(source().run(diseases, efos) for source in [postgap.GWAS.GWASCatalog])
+		logging.info("Searching for GWAS SNPs associated to %i queries in all databases" % (len(queries)))
+		sources = [postgap.GWAS.GWASCatalog]
 	else:
-		logging.info("Searching for GWAS SNPs associated to diseases (%s) or EFO IDs (%s) in (%s)" % (", ".join(diseases), ", ".join(efos), ", ".join(postgap.Globals.GWAS_adaptors)))
-		gwas_associations = concatenate(source().run(diseases, efos) for source in postgap.GWAS.get_filtered_subclasses(postgap.Globals.GWAS_adaptors))
+		logging.info("Searching for GWAS SNPs associated to %i queries in (%s)" % (len(queries), ", ".join(postgap.Globals.GWAS_adaptors)))
+		sources = postgap.GWAS.get_filtered_subclasses(postgap.Globals.GWAS_adaptors)
+
+	# The results of each source are chained rather than concatenated, so that
+	# streaming sources such as GWAS_File are reduced to GWAS SNPs as they are read
+	gwas_associations = dict((query_id, []) for query_id in queries)
+	for source in sources:
+		for query_id, source_associations in source().run_many(queries).items():
+			gwas_associations[query_id].append(source_associations)
+
+	return dict((query_id, gwas_associations_to_gwas_snps(itertools.chain.from_iterable(gwas_associations[query_id]), diseases, efos)) for query_id, (diseases, efos) in queries.items())
+
+def gwas_associations_to_gwas_snps(gwas_associations, diseases, efos):
+	"""
 
-	logging.info("Done searching for GWAS SNPs. Found %s gwas associations." % len(gwas_associations) )
+		Keeps the most significant association of each SNP, reading the
+		associations once, as they come
+		Args:
+		* iterable of GWAS_Association
+		* [ string ] (trait descriptions)
+		* [ string ] (trait EFO identifiers)
+		Returntype: [ GWAS_SNP ]
 
+	"""
+	count = 0
 	associations_by_snp = dict()
 	for gwas_association in gwas_associations:
+		count += 1
 		# Sanity filter to avoid breaking downstream code
 		# Looking at you GWAS DB, "p-value = 0", pshaw!
 		if gwas_association.pvalue <= 0:
@@ -135,6 +201,8 @@ def scan_disease_databases(diseases, efos):
 				beta     = beta
 			)
 
+	logging.info("Done searching for GWAS SNPs associated to diseases (%s) or EFO IDs (%s). Found %s gwas associations." % (", ".join(diseases), ", ".join(efos), count))
+
 	gwas_snps = associations_by_snp.values()
 
 	if postgap.Globals.GWAS_adaptors == None:
@@ -160,6 +228,7 @@ def gwas_snps_to_genes(gwas_snps, population, tissue_weights):
 		tissue_weights = gwas_snps_to_tissue_weights(gwas_snps)
 
 	clusters = cluster_gwas_snps(gwas_snps, population)
+	prefetch_cluster_genes(clusters)
 	res = concatenate(cluster_to_genes(cluster, tissue_weights, population) for cluster in clusters)
 
 	logging.info("\tFound %i genes associated to all clusters" % (len(res)))
@@ -180,6 +249,7 @@ def clusters_to_genes(clusters, population, tissue_weights):
 		Returntype: [ string ]
 
 	"""
+	prefetch_cluster_genes(clusters)
 	res = concatenate(cluster_to_genes(cluster, tissue_weights, population) for cluster in clusters)
 
 	logging.info("\tFound %i genes associated to all clusters" % (len(res)))
@@ -189,6 +259,37 @@ def clusters_to_genes(clusters, population, tissue_weights):
 	else:
 		return sorted(res, key=lambda X: X.score)
 
+def prefetch_cluster_genes(clusters):
+	"""
+
+		Loads all the genes within CLUSTER_GENE_WINDOW of the LD SNPs of the 
+		clusters into the Ensembl_lookup cache, so that the Cisreg adaptors
+		do not need to look genes up one at a time
+		Args:
+		* [ Cluster ]
+
+	"""
+	windows = collections.defaultdict(list)
+	for cluster in clusters:
+		for snp in cluster.ld_snps:
+			windows[snp.chrom].append((max(1, snp.pos - CLUSTER_GENE_WINDOW), snp.pos + CLUSTER_GENE_WINDOW))
+
+	# Merge overlapping windows
+	regions = []
+	for chrom in windows:
+		start, end = None, None
+		for window_start, window_end in sorted(windows[chrom]):
+			if end is not None and window_start <= end + 1:
+				end = max(end, window_end)
+			else:
+				if end is not None:
+					regions.append((chrom, start, end))
+				start, end = window_start, window_end
+		if end is not None:
+			regions.append((chrom, start, end))
+
+	postgap.Ensembl_lookup.prefetch_region_genes(regions)
+
 def gwas_snps_to_tissue_weights(gwas_snps):
 	"""
 
@@ -214,8 +315,12 @@ def cluster_gwas_snps(gwas_snps, population):
 	logging.info("Found %i locations from %i GWAS SNPs" % (len(gwas_snp_locations), len(gwas_snps)))
 
 	# For every gwas snp location, create the preclusters by simple LD expansion of independent SNPs.
+	# Summary statistics yield many significant SNPs per locus, so only the lead SNPs of clumps are expanded.
 	#
-	preclusters = filter (lambda X: X is not None, [ gwas_snp_to_precluster(gwas_snp_location, population) for gwas_snp_location in gwas_snp_locations ])
+	if postgap.Globals.GWAS_SUMMARY_STATS_FILE is not None:
+		preclusters = clump_gwas_snps(gwas_snp_locations, population)
+	else:
+		preclusters = gwas_snps_to_preclusters(gwas_snp_locations, population)
 	for precluster in preclusters:
 		for gwas_snp in precluster.gwas_snps:
 			assert gwas_snp.snp.rsID in [ld_snp.rsID for ld_snp in precluster.ld_snps]
@@ -261,6 +366,119 @@ def cluster_gwas_snps(gwas_snps, population):
 
 	return clusters
 
+def clump_gwas_snps(gwas_snps, population, window_len=None, r2=None):
+	"""
+
+		Greedy clumping of GWAS SNPs, as in PLINK: from the most significant
+		SNP down, each SNP not yet clumped is expanded by LD, and absorbs the
+		other GWAS SNPs in LD with it within the clumping window, which are
+		not expanded themselves. Absorbed SNPs are added to the LD SNPs of 
+		the lead SNP if the LD expansion did not reach them. GWAS SNPs are
+		told apart by their position in the list, so several associations
+		of the same SNP are all kept.
+		Args:
+		* [ GWAS_SNP ]
+		* string (population name)
+		* int (clumping window width, default Globals.CLUMP_WINDOW)
+		* float (clumping r2 cutoff, default Globals.CLUMP_R2)
+		Returntype: [ GWAS_Cluster ]
+
+	"""
+	if window_len is None:
+		window_len = postgap.Globals.CLUMP_WINDOW
+	if r2 is None:
+		r2 = postgap.Globals.CLUMP_R2
+
+	gwas_snps = list(gwas_snps)
+	unclumped = set(range(len(gwas_snps)))
+	indices_by_rsID = collections.defaultdict(list)
+	for index, gwas_snp in enumerate(gwas_snps):
+		indices_by_rsID[gwas_snp.snp.rsID].append(index)
+	preclusters = []
+
+	for index in sorted(range(len(gwas_snps)), key=lambda index: gwas_snps[index].pvalue):
+		if index not in unclumped:
+			continue
+		unclumped.remove(index)
+		gwas_snp = gwas_snps[index]
+
+		precluster = gwas_snp_to_precluster(gwas_snp, population)
+		if window_len == postgap.LD.WINDOW_LEN and r2 == postgap.LD.R2_CUTOFF:
+			clump_snps = precluster.ld_snps
+		else:
+			clump_snps = postgap.LD.calculate_window(gwas_snp.snp, population, window_len, r2)
+
+		absorbed_gwas_snps = []
+		for clump_snp in clump_snps:
+			for absorbed_index in indices_by_rsID.get(clump_snp.rsID, []):
+				if absorbed_index in unclumped:
+					unclumped.remove(absorbed_index)
+					absorbed_gwas_snps.append(gwas_snps[absorbed_index])
+
+		ld_snps = list(precluster.ld_snps)
+		ld_rsIDs = set(ld_snp.rsID for ld_snp in ld_snps)
+		for absorbed_gwas_snp in absorbed_gwas_snps:
+			if absorbed_gwas_snp.snp.rsID not in ld_rsIDs:
+				ld_snps.append(absorbed_gwas_snp.snp)
+				ld_rsIDs.add(absorbed_gwas_snp.snp.rsID)
+
+		preclusters.append(precluster._replace(gwas_snps = precluster.gwas_snps + absorbed_gwas_snps, ld_snps = ld_snps))
+
+	logging.info("Clumped %i GWAS SNPs around %i lead SNPs" % (len(gwas_snps), len(preclusters)))
+	return preclusters
+
+def group_gwas_snps_by_distance(gwas_snps, max_distance=250000, max_span=500000):
+	"""
+
+		Sweeps GWAS SNPs along the genome, grouping those which follow each
+		other within max_distance, with groups spanning at most max_span
+		Args:
+		* [ GWAS_SNP ]
+		* int (max distance between consecutive SNPs)
+		* int (max distance between first and last SNP of a group)
+		Returntype: [ [ GWAS_SNP ] ]
+
+	"""
+	groups = []
+	for gwas_snp in sorted(gwas_snps, key=lambda X: (X.snp.chrom, X.snp.pos)):
+		if len(groups) > 0:
+			last_snp = groups[-1][-1].snp
+			first_snp = groups[-1][0].snp
+			if last_snp.chrom == gwas_snp.snp.chrom and gwas_snp.snp.pos - last_snp.pos < max_distance and gwas_snp.snp.pos - first_snp.pos <= max_span:
+				groups[-1].append(gwas_snp)
+				continue
+		groups.append([gwas_snp])
+	return groups
+
+def gwas_snps_to_preclusters(gwas_snps, population):
+	"""
+
+		Extract neighbourhoods of GWAS snps, as gwas_snp_to_precluster, with
+		one LD query for each group of nearby GWAS snps
+		Args:
+		* [ GWAS_SNP ]
+		* string (population name)
+		Returntype: [ GWAS_Cluster ], in the same order as the GWAS snps
+
+	"""
+	groups = group_gwas_snps_by_distance(gwas_snps)
+	logging.info("Grouped %i GWAS SNPs into %i LD queries" % (len(gwas_snps), len(groups)))
+
+	preclusters = dict()
+	for group in groups:
+		windows = postgap.LD.calculate_windows([gwas_snp.snp for gwas_snp in group], population=population)
+		for gwas_snp, mapped_ld_snps in zip(group, windows):
+			logging.info("Found %i SNPs in the vicinity of %s" % (len(mapped_ld_snps), gwas_snp.snp.rsID))
+			preclusters[id(gwas_snp)] = GWAS_Cluster(
+				gwas_snps = [ gwas_snp ],
+				ld_snps = mapped_ld_snps,
+				ld_matrix = None,
+				z_scores = None,
+				gwas_configuration_posteriors = None
+			)
+
+	return [preclusters[id(gwas_snp)] for gwas_snp in gwas_snps]
+
 def gwas_snp_to_precluster(gwas_snp, population):
     """
 
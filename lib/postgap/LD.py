@@ -32,6 +32,7 @@ import os.path
 import sys
 import re
 import tempfile
+import collections
 import numpy
 from subprocess import Popen, PIPE
 from postgap.DataModel import *
@@ -40,7 +41,11 @@ import logging
 
 import pprint
 
-def calculate_window(snp, population, window_len=500000, cutoff=0.7):
+# Width of the LD windows and r2 cutoff of the LD expansion of GWAS SNPs
+WINDOW_LEN = 500000
+R2_CUTOFF = 0.7
+
+def calculate_window(snp, population, window_len=WINDOW_LEN, cutoff=R2_CUTOFF):
 	"""
 
 		Given a SNP id, calculate the pairwise LD between all SNPs within window_size base pairs.
@@ -113,6 +118,92 @@ def calculate_window(snp, population, window_len=500000, cutoff=0.7):
 	else:
 		return ld_snps + [snp]
 
+def calculate_windows(snps, population, window_len=WINDOW_LEN, cutoff=R2_CUTOFF):
+	"""
+
+		Same as calculate_window for a group of nearby SNPs on the same
+		chromosome, with a single ld_vcf run over a region covering all their
+		windows. Each SNP only keeps the partners within its own window, so
+		the results are those of separate calculate_window calls.
+
+		Args:
+		* [ SNP ]
+		* string, population name
+		* int, window width
+		* float, r2 cutoff
+		Returntype: [ [ SNP ] ], in the same order as the input SNPs
+
+	"""
+	if len(snps) == 1:
+		return [calculate_window(snps[0], population, window_len, cutoff)]
+
+	### Define the necessary region.
+	chrom = snps[0].chrom
+	assert all(snp.chrom == chrom for snp in snps)
+	from_pos = min(snp.pos for snp in snps) - (window_len / 2)
+	to_pos = max(snp.pos for snp in snps) + (window_len / 2)
+
+	### Find the relevant 1000 genomes BCF
+	chrom_file = os.path.join(postgap.Globals.DATABASES_DIR, '1000Genomes', population, "ALL.chr%s.phase3_shapeit2_mvncall_integrated_v5a.20130502.genotypes.bcf" % (chrom))
+	if not os.path.isfile(chrom_file):
+		logging.warning('Could not find BCF file %s', chrom_file)
+		return [[snp] for snp in snps]
+
+	### use ld_vcf, which computes the LD around each of the listed variants
+	rsIDs = []
+	for snp in snps:
+		if snp.rsID not in rsIDs:
+			rsIDs.append(snp.rsID)
+	ld_comm = [
+		"ld_vcf",
+		"-f", chrom_file,
+		"-r", "%s:%i-%i" % (chrom, from_pos, to_pos),
+		"-v", ",".join(rsIDs),
+		"-w", str(window_len)
+	]
+	logging.debug(" ".join(ld_comm))
+
+	process = Popen(ld_comm, stdout=PIPE)
+	(output, err) = process.communicate()
+	if process.wait():
+		raise Exception(err)
+
+	### Read LD file
+	# Pairs of two listed variants are reported twice, hence the dictionaries
+	partners = dict((rsID, collections.OrderedDict()) for rsID in rsIDs)
+	for line in output.split("\n"):
+
+		items = line.split()
+		if len(items) == 0:
+			continue
+
+		if float(items[6]) >= cutoff:
+			if items[3] in partners:
+				partners[items[3]].setdefault(items[5], int(items[4]))
+			if items[5] in partners:
+				partners[items[5]].setdefault(items[3], int(items[2]))
+
+	res = []
+	for snp in snps:
+		ld_snps = [
+			SNP(
+				rsID  = ld_id,
+				chrom = chrom,
+				pos   = ld_pos,
+				approximated_zscore =  None
+			)
+			for ld_id, ld_pos in partners[snp.rsID].items()
+			if abs(ld_pos - snp.pos) <= window_len / 2
+		]
+
+		# Make sure the snp is among the ld_snps. If it isn't already, it is added.
+		if any(ld_snp.rsID == snp.rsID for ld_snp in ld_snps):
+			res.append(ld_snps)
+		else:
+			res.append(ld_snps + [snp])
+
+	return res
+
 def get_lds_from_top_gwas(gwas_snp, ld_snps, population):
 	"""
 
@@ -0,0 +1,226 @@
+#! /usr/bin/env python
+
+"""
+
+Copyright [1999-2018] EMBL-European Bioinformatics Institute
+
+Licensed under the Apache License, Version 2.0 (the "License")
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+		 http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+"""
+
+	Please email comments or questions to the public Ensembl
+	developers list at <http://lists.ensembl.org/mailman/listinfo/dev>.
+
+	Questions may also be sent to the Ensembl help desk at
+	<http://www.ensembl.org/Help/Contact>.
+
+"""
+import os
+import gzip
+import logging
+import threading
+import collections
+import numpy
+
+import postgap.Globals
+from postgap.DataModel import *
+
+# UCSC chain file from GRCh37 to GRCh38, in the databases directory
+CHAIN_FILE = "hg19ToHg38.over.chain.gz"
+
+chain_indexes = {}
+chain_indexes_lock = threading.Lock()
+
+def ensembl_chrom(chrom):
+	"""
+
+		Converts UCSC chromosome names to Ensembl ones
+		Args:
+		* string
+		Returntype: string
+
+	"""
+	if chrom.startswith('chr'):
+		chrom = chrom[3:]
+	if chrom == 'M':
+		return 'MT'
+	return chrom
+
+class chain_index(object):
+	"""
+
+		Interval index over the aligned blocks of a chain file. For each
+		source chromosome, blocks are stored in numpy arrays sorted by start,
+		so that a batch of positions is converted with a single searchsorted.
+		Blocks of different chains may overlap: a running maximum of block
+		ends tells which positions need to look further back than the
+		nearest block.
+
+	"""
+	def __init__(self, filename):
+		self.filename = filename
+		self.target_chroms = []
+		target_chrom_ids = dict()
+		blocks = collections.defaultdict(list)
+
+		'''
+			Chain file format (0-based, half open coordinates):
+			chain score tName tSize tStrand tStart tEnd qName qSize qStrand qStart qEnd id
+			size dt dq
+			...
+			size
+		'''
+		if filename.endswith('.gz'):
+			file = gzip.open(filename)
+		else:
+			file = open(filename)
+
+		for line in file:
+			items = line.split()
+			if len(items) == 0:
+				continue
+			if items[0] == 'chain':
+				source_chrom = ensembl_chrom(items[2])
+				source_pos = int(items[5])
+				target_chrom = ensembl_chrom(items[7])
+				if target_chrom not in target_chrom_ids:
+					target_chrom_ids[target_chrom] = len(self.target_chroms)
+					self.target_chroms.append(target_chrom)
+				target_chrom_id = target_chrom_ids[target_chrom]
+				target_size = int(items[8])
+				target_reverse = items[9] == '-'
+				target_pos = int(items[10])
+				continue
+
+			size = int(items[0])
+			blocks[source_chrom].append((source_pos, source_pos + size, target_pos, target_chrom_id, target_reverse, target_size))
+			if len(items) == 3:
+				source_pos += size + int(items[1])
+				target_pos += size + int(items[2])
+		file.close()
+
+		self.blocks = dict()
+		for chrom, chrom_blocks in blocks.items():
+			chrom_blocks.sort()
+			starts, ends, target_starts, target_chrom_ids, target_reverses, target_sizes = map(numpy.array, zip(*chrom_blocks))
+			self.blocks[chrom] = {
+				'starts': starts,
+				'ends': ends,
+				'max_ends': numpy.maximum.accumulate(ends),
+				'target_starts': target_starts,
+				'target_chrom_ids': target_chrom_ids,
+				'target_reverses': target_reverses,
+				'target_sizes': target_sizes,
+			}
+
+		logging.info("Loaded %i chain blocks from %s" % (sum(len(chrom_blocks) for chrom_blocks in blocks.values()), filename))
+
+	def convert(self, chroms, positions):
+		"""
+
+			Converts a batch of 1-based positions
+			Args:
+			* [ string ] (chromosomes)
+			* [ int ] (positions)
+			Returntype: [ (string, int) or None ]
+
+		"""
+		res = [None] * len(positions)
+		positions = numpy.asarray(positions, dtype=numpy.int64)
+		chroms = numpy.asarray(chroms)
+
+		for chrom in set(chroms.tolist()):
+			if chrom not in self.blocks:
+				continue
+			blocks = self.blocks[chrom]
+			indices = numpy.nonzero(chroms == chrom)[0]
+			# Chain coordinates are 0-based
+			chrom_positions = positions[indices] - 1
+
+			block_indices = numpy.searchsorted(blocks['starts'], chrom_positions, side='right') - 1
+			valid = block_indices >= 0
+			block_indices = numpy.maximum(block_indices, 0)
+			covered = valid & (chrom_positions < blocks['ends'][block_indices])
+
+			# Positions missed by the nearest block may still lie in an earlier, longer block
+			for i in numpy.nonzero(valid & ~covered & (chrom_positions < blocks['max_ends'][block_indices]))[0]:
+				block_index = block_indices[i] - 1
+				while block_index >= 0 and blocks['max_ends'][block_index] > chrom_positions[i]:
+					if blocks['starts'][block_index] <= chrom_positions[i] < blocks['ends'][block_index]:
+						block_indices[i] = block_index
+						covered[i] = True
+						break
+					block_index -= 1
+
+			target_positions = blocks['target_starts'][block_indices] + chrom_positions - blocks['starts'][block_indices]
+			reverse = blocks['target_reverses'][block_indices]
+			target_positions[reverse] = blocks['target_sizes'][block_indices][reverse] - target_positions[reverse] - 1
+
+			for i in numpy.nonzero(covered)[0]:
+				res[indices[i]] = (self.target_chroms[blocks['target_chrom_ids'][block_indices[i]]], int(target_positions[i]) + 1)
+
+		return res
+
+def get_chain_index():
+	"""
+
+		Loads the GRCh37 to GRCh38 chain file of the databases directory, if any
+		Returntype: chain_index or None
+
+	"""
+	if postgap.Globals.DATABASES_DIR is None:
+		return None
+
+	filename = os.path.join(postgap.Globals.DATABASES_DIR, CHAIN_FILE)
+	with chain_indexes_lock:
+		if filename not in chain_indexes:
+			if os.path.exists(filename):
+				chain_indexes[filename] = chain_index(filename)
+			else:
+				chain_indexes[filename] = None
+		return chain_indexes[filename]
+
+def available():
+	return get_chain_index() is not None
+
+def lift_snps(snps):
+	"""
+
+		Converts SNP locations from GRCh37 to GRCh38
+		Args:
+		* [ SNP ]
+		Returntype: [ SNP ], for those SNPs which could be converted
+
+	"""
+	snps = list(snps)
+	if len(snps) == 0:
+		return []
+
+	locations = get_chain_index().convert([snp.chrom for snp in snps], [snp.pos for snp in snps])
+	return [snp._replace(chrom = location[0], pos = location[1]) for snp, location in zip(snps, locations) if location is not None]
+
+def lift_gene(gene):
+	"""
+
+		Converts a gene TSS from GRCh37 to GRCh38
+		Args:
+		* Gene
+		Returntype: Gene or None if it could not be converted
+
+	"""
+	location = get_chain_index().convert([gene.chrom], [gene.tss])[0]
+	if location is None:
+		return None
+	return gene._replace(chrom = location[0], tss = location[1])
@@ -0,0 +1,202 @@
+#! /usr/bin/env python
+
+"""
+
+Copyright [1999-2018] EMBL-European Bioinformatics Institute
+
+Licensed under the Apache License, Version 2.0 (the "License")
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+		 http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+"""
+
+	Please email comments or questions to the public Ensembl
+	developers list at <http://lists.ensembl.org/mailman/listinfo/dev>.
+
+	Questions may also be sent to the Ensembl help desk at
+	<http://www.ensembl.org/Help/Contact>.
+
+"""
+import os
+import time
+import json
+import atexit
+import sqlite3
+import logging
+import threading
+
+import postgap.Globals
+
+# Number of new entries after which a snapshot is written to disk
+FLUSH_INTERVAL = 100
+
+# Negative results (e.g. unknown gene symbols) are forgotten after this many
+# seconds, as new Ensembl releases may resolve them
+NEGATIVE_TTL = 30 * 24 * 3600
+
+# How long to wait on a lock held by another process (seconds)
+SQLITE_TIMEOUT = 60
+
+snapshots = []
+
+class persistent_dict(dict):
+	"""
+
+		Dictionary of lookup results mirrored in the SQLite file named by
+		Globals.LOOKUP_SNAPSHOT_FILE. The file is read on first access, and
+		new entries are written back every FLUSH_INTERVAL insertions and
+		when the process exits. Keys are tuples of strings, values are
+		namedtuples (rebuilt with the factory) or None.
+
+		Assigning None only caches a failure in memory, e.g. after a network
+		error, whereas set_missing records that the server confirmed there
+		is no such entry, which is persisted too.
+
+	"""
+	def __init__(self, kind, factory):
+		dict.__init__(self)
+		self.kind = kind
+		self.factory = factory
+		self.filename = None
+		self.pending = []
+		self.lock = threading.RLock()
+		snapshots.append(self)
+
+	def ensure_loaded(self):
+		if self.filename != postgap.Globals.LOOKUP_SNAPSHOT_FILE:
+			with self.lock:
+				if self.filename != postgap.Globals.LOOKUP_SNAPSHOT_FILE:
+					self.flush()
+					self.filename = postgap.Globals.LOOKUP_SNAPSHOT_FILE
+					if self.filename is not None:
+						self.load()
+
+	def __contains__(self, key):
+		self.ensure_loaded()
+		return dict.__contains__(self, key)
+
+	def __getitem__(self, key):
+		self.ensure_loaded()
+		return dict.__getitem__(self, key)
+
+	def get(self, key, default=None):
+		self.ensure_loaded()
+		return dict.get(self, key, default)
+
+	def __setitem__(self, key, value):
+		self.ensure_loaded()
+		dict.__setitem__(self, key, value)
+		if value is not None:
+			self.persist(key, value)
+
+	def cache(self, key, value):
+		"""
+
+			Stores an entry in memory only
+			Args:
+			* tuple (key)
+			* namedtuple or None
+
+		"""
+		self.ensure_loaded()
+		dict.__setitem__(self, key, value)
+
+	def set_missing(self, key):
+		"""
+
+			Records that the server has no entry for a key
+			Args:
+			* tuple (key)
+
+		"""
+		self.ensure_loaded()
+		dict.__setitem__(self, key, None)
+		self.persist(key, None)
+
+	def persist(self, key, value):
+		if self.filename is None:
+			return
+		with self.lock:
+			self.pending.append((self.kind, json.dumps(key), None if value is None else json.dumps(value), time.time()))
+			if len(self.pending) >= FLUSH_INTERVAL:
+				self.flush()
+
+	def connect(self):
+		directory = os.path.dirname(self.filename)
+		if directory != '' and not os.path.exists(directory):
+			os.makedirs(directory)
+		connection = sqlite3.connect(self.filename, timeout=SQLITE_TIMEOUT)
+		connection.execute('PRAGMA journal_mode=WAL')
+		connection.execute('CREATE TABLE IF NOT EXISTS lookups (kind TEXT NOT NULL, key TEXT NOT NULL, value TEXT, created REAL NOT NULL, PRIMARY KEY (kind, key))')
+		return connection
+
+	def load(self):
+		"""
+
+			Reads the entries of the snapshot file
+
+		"""
+		try:
+			connection = self.connect()
+			rows = connection.execute('SELECT key, value, created FROM lookups WHERE kind = ?', (self.kind,)).fetchall()
+			connection.close()
+		except (sqlite3.Error, OSError) as e:
+			logging.warning("Could not read lookup snapshot %s: %s" % (self.filename, e))
+			return
+
+		now = time.time()
+		count = 0
+		for key, value, created in rows:
+			if value is None:
+				if now - created > NEGATIVE_TTL:
+					continue
+				dict.__setitem__(self, decode(key), None)
+			else:
+				dict.__setitem__(self, decode(key), self.factory(*decode(value)))
+			count += 1
+		logging.info("Loaded %i %s from lookup snapshot %s" % (count, self.kind, self.filename))
+
+	def flush(self):
+		"""
+
+			Writes the new entries to the snapshot file
+
+		"""
+		with self.lock:
+			if len(self.pending) == 0 or self.filename is None:
+				return
+			try:
+				connection = self.connect()
+				with connection:
+					connection.executemany('INSERT OR REPLACE INTO lookups (kind, key, value, created) VALUES (?, ?, ?, ?)', self.pending)
+				connection.close()
+			except (sqlite3.Error, OSError) as e:
+				logging.warning("Could not write lookup snapshot %s: %s" % (self.filename, e))
+			self.pending = []
+
+def decode(string):
+	"""
+
+		Parses a JSON list, with byte strings as in the rest of the pipeline
+		Args:
+		* string (JSON)
+		Returntype: tuple
+
+	"""
+	return tuple(element.encode('utf-8') if isinstance(element, unicode) else element for element in json.loads(string))
+
+def flush_all():
+	for snapshot in snapshots:
+		snapshot.flush()
+
+atexit.register(flush_all)
@@ -33,66 +33,510 @@ import json
 import time
 import logging
 import httplib
+import threading
+import collections
+import copy
+import random
+import urlparse
+from multiprocessing.pool import ThreadPool
 
-import signal
-
-class timeout_handler:
-	
-	url = 'initme'
-	
-	# Register an handler for the timeout
-	def handler_very_short(self, signum, frame):
-		logging.info("Url is being a bit sluggish " + self.url)
-		signal.signal(signal.SIGALRM, self.handler_long)
-		# Set second timeout
-		signal.alarm(4)
-
-	# Register an handler for the timeout
-	def handler_short(self, signum, frame):
-		logging.warning("Waiting for " + self.url)
-		signal.signal(signal.SIGALRM, self.handler_long)
-		# Set second timeout
-		signal.alarm(180)
-
-	def handler_long(self, signum, frame):
-		logging.error("Killing request for url: "  + self.url)
-		raise requests.exceptions.ReadTimeout("Killed request for url because of timeout: %s" % self.url)
+import postgap.Globals
+import postgap.RESTCache
+import postgap.RESTFixtures
+
+cache = None
+cache_lock = threading.Lock()
+
+def get_cache():
+	"""
+
+		Returns the on-disk response cache, if one was configured
+		Returntype: RESTCache or None
+
+	"""
+	global cache
+	if postgap.Globals.REST_CACHE_FILE is None:
+		return None
+
+	with cache_lock:
+		if cache is None or cache.filename != postgap.Globals.REST_CACHE_FILE:
+			cache = postgap.RESTCache.RESTCache(postgap.Globals.REST_CACHE_FILE, postgap.Globals.REST_CACHE_MAX_SIZE)
+	return cache
+
+sessions = dict()
+sessions_lock = threading.Lock()
+requests_per_host = collections.Counter()
+
+def make_adapter():
+	"""
+
+		Returns the transport of the REST sessions: the network, possibly
+		recording responses, or recorded responses only
+		Returntype: requests.adapters.BaseAdapter
+
+	"""
+	if postgap.Globals.REST_REPLAY_DIR is not None:
+		profile = postgap.RESTFixtures.replay_profile(
+			latency = postgap.Globals.REST_REPLAY_LATENCY, 
+			error_rate = postgap.Globals.REST_REPLAY_ERROR_RATE, 
+			seed = postgap.Globals.REST_REPLAY_SEED
+		)
+		return postgap.RESTFixtures.replay_adapter(postgap.Globals.REST_REPLAY_DIR, profile)
+	elif postgap.Globals.REST_RECORD_DIR is not None:
+		return postgap.RESTFixtures.recording_adapter(postgap.Globals.REST_RECORD_DIR, pool_connections=4, pool_maxsize=postgap.Globals.REST_POOL_SIZE)
+	else:
+		return requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=postgap.Globals.REST_POOL_SIZE)
+
+def get_session(url):
+	"""
+
+		Returns the pooled keep-alive session used for a given host
+		Args:
+		* String (url)
+		Returntype: requests.Session
+
+	"""
+	parsed_url = urlparse.urlparse(url)
+	host = "%s://%s" % (parsed_url.scheme, parsed_url.netloc)
+
+	with sessions_lock:
+		if host not in sessions:
+			session = requests.Session()
+			adapter = make_adapter()
+			session.mount('http://', adapter)
+			session.mount('https://', adapter)
+			session.headers['Connection'] = 'keep-alive'
+			sessions[host] = session
+		requests_per_host[host] += 1
+		return sessions[host]
+
+# Requests per second allowed by each server, see e.g. https://github.com/Ensembl/ensembl-rest/wiki/Rate-Limits
+RATE_LIMITS = {
+	'rest.ensembl.org': 15,
+	'grch37.rest.ensembl.org': 15,
+}
+DEFAULT_RATE_LIMIT = 10
+
+class token_bucket(object):
+	"""
+
+		Rate limiter shared by all the threads querying a host. Tokens
+		accumulate at a fixed rate up to a small burst capacity, and every
+		request consumes one. A pause (e.g. after a 429 response) blocks 
+		all threads until it expires.
+
+	"""
+	def __init__(self, rate, capacity=None):
+		self.rate = float(rate)
+		self.capacity = capacity if capacity is not None else rate
+		self.tokens = self.capacity
+		self.timestamp = time.time()
+		self.paused_until = 0
+		self.lock = threading.Lock()
+
+	def acquire(self):
+		while True:
+			with self.lock:
+				now = time.time()
+				if now < self.paused_until:
+					wait = self.paused_until - now
+				else:
+					self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+					self.timestamp = now
+					if self.tokens >= 1:
+						self.tokens -= 1
+						return
+					wait = (1 - self.tokens) / self.rate
+			time.sleep(wait)
+
+	def pause(self, seconds):
+		with self.lock:
+			self.paused_until = max(self.paused_until, time.time() + seconds)
+			self.tokens = 0
+			self.timestamp = self.paused_until
+
+rate_limiters = dict()
+
+def get_rate_limiter(url):
+	"""
+
+		Returns the rate limiter shared by all queries to a given host
+		Args:
+		* String (url)
+		Returntype: token_bucket
+
+	"""
+	hostname = urlparse.urlparse(url).hostname
+	with sessions_lock:
+		if hostname not in rate_limiters:
+			rate_limiters[hostname] = token_bucket(RATE_LIMITS.get(hostname, DEFAULT_RATE_LIMIT))
+		return rate_limiters[hostname]
+
+def connection_statistics():
+	"""
+
+		Counts how often connections were reused, per host
+		Returntype: { String (host): (requests sent, connections opened, connections reused) }
+
+	"""
+	statistics = dict()
+	with sessions_lock:
+		for host, session in sessions.items():
+			adapter = session.get_adapter(host)
+			if hasattr(adapter, 'poolmanager'):
+				pools = adapter.poolmanager.pools
+				connections_opened = sum(pools[key].num_connections for key in pools.keys())
+			else:
+				# Replayed responses
+				connections_opened = 0
+			statistics[host] = (requests_per_host[host], connections_opened, max(0, requests_per_host[host] - connections_opened))
+	return statistics
+
+def log_connection_statistics():
+	for host, (requests_sent, connections_opened, connections_reused) in sorted(connection_statistics().items()):
+		logging.info("REST: %i requests to %s over %i connections (%i reused)" % (requests_sent, host, connections_opened, connections_reused))
+	for host, count in sorted(coalesced_calls.items()):
+		logging.info("REST: %i duplicate queries to %s served by a query already in flight" % (count, host))
+	for host, counts in sorted(outcome_statistics().items()):
+		logging.info("REST: queries to %s: %s" % (host, ", ".join("%i %s" % (counts[outcome], outcome) for outcome in sorted(counts))))
+
+# Seconds allowed to establish a connection
+CONNECT_TIMEOUT = 10
+
+# Size of the blocks in which response bodies are read (bytes)
+BODY_CHUNK_SIZE = 64 * 1024
+
+# Delays after which a pending request gets logged, with the corresponding log level and message
+SLOW_REQUEST_THRESHOLDS = [
+	(1,  logging.INFO,    "Url is being a bit sluggish "),
+	(30, logging.WARNING, "Waiting for "),
+]
+
+class request_watchdog(object):
+	"""
+
+		Keeps track of the requests in flight and, from a single background
+		thread, logs those that are taking a long time. Unlike SIGALRM this 
+		works from any thread and with any number of concurrent requests.
+
+	"""
+	polling_interval = 0.5
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.in_flight = dict()
+		self.next_ticket = 0
+		self.thread = None
+
+	def register(self, url):
+		with self.lock:
+			ticket = self.next_ticket
+			self.next_ticket += 1
+			self.in_flight[ticket] = [url, time.time(), 0]
+
+			if self.thread is None:
+				self.thread = threading.Thread(target=self.watch, name="REST watchdog")
+				self.thread.daemon = True
+				self.thread.start()
+
+		return ticket
+
+	def unregister(self, ticket):
+		with self.lock:
+			del self.in_flight[ticket]
+
+	def watch(self):
+		while True:
+			time.sleep(self.polling_interval)
+			now = time.time()
+			with self.lock:
+				for request in self.in_flight.values():
+					url, start_time, warnings_issued = request
+					if warnings_issued < len(SLOW_REQUEST_THRESHOLDS):
+						delay, level, message = SLOW_REQUEST_THRESHOLDS[warnings_issued]
+						if now - start_time > delay:
+							logging.log(level, message + url)
+							request[2] += 1
+
+watchdog = request_watchdog()
+
+def set_read_timeout(r, seconds):
+	"""
+
+		Sets the socket read timeout of a streamed response, if it is read
+		from a socket
+		Args:
+		* requests.Response
+		* scalar (seconds)
+
+	"""
+	connection = getattr(r.raw, 'connection', None)
+	if connection is not None and connection.sock is not None:
+		connection.sock.settimeout(seconds)
+
+def read_with_deadline(r, url, deadline):
+	"""
+
+		Reads the body of a streamed response, giving up once past the 
+		deadline. The socket read timeout is cut down to the time left
+		before each block, so a stalled read ends at the deadline too.
+		Args:
+		* requests.Response
+		* String (url)
+		* scalar (deadline, in seconds since the epoch)
+		Returntype: String (body)
+
+	"""
+	chunks = []
+	content = r.iter_content(BODY_CHUNK_SIZE)
+	try:
+		while True:
+			time_left = deadline - time.time()
+			if time_left <= 0:
+				raise requests.exceptions.ReadTimeout("Killed request for url because of timeout: %s" % url)
+			set_read_timeout(r, time_left)
+			try:
+				chunks.append(next(content))
+			except StopIteration:
+				break
+			except requests.exceptions.ConnectionError:
+				# requests reports socket read timeouts as connection errors
+				if time.time() >= deadline:
+					raise requests.exceptions.ReadTimeout("Killed request for url because of timeout: %s" % url)
+				raise
+	except:
+		r.close()
+		raise
+
+	return ''.join(chunks)
+
+def request_with_timeout(method, url, headers, data, timeout):
+	"""
+
+		Sends a request and returns the response with its body, raising
+		requests.exceptions.ReadTimeout if it takes more than timeout seconds.
+		Args:
+		* String (HTTP method)
+		* String (url)
+		* dict (headers)
+		* String (body) or None
+		* scalar (seconds)
+		Returntype: (requests.Response, String (response body))
+
+	"""
+	session = get_session(url)
+	# Replayed responses do not count against the servers' rate limits
+	if not isinstance(session.get_adapter(url), postgap.RESTFixtures.replay_adapter):
+		get_rate_limiter(url).acquire()
+	ticket = watchdog.register(url)
+	try:
+		deadline = time.time() + timeout
+		r = session.request(method, url, headers = headers, data = data, timeout = (CONNECT_TIMEOUT, timeout), stream = True)
+		return r, read_with_deadline(r, url, deadline)
+	except requests.exceptions.ReadTimeout:
+		logging.error("Killing request for url: "  + url)
+		raise
+	finally:
+		watchdog.unregister(ticket)
 
 def post_request_with_timeout(url, headers, data, timeout):
-	
-	th = timeout_handler()
-	th.url = url
-	
-	# Register the signal function handler
-	signal.signal(signal.SIGALRM, th.handler_short)
-
-	# Set first timeout
-	signal.alarm(1)
-	
-	r = requests.post(url, headers = headers, data = data, timeout=timeout)
-	
-	# Cancel alarm
-	signal.alarm(0)
-
-	return r
+	return request_with_timeout('POST', url, headers, data, timeout)
 
 def get_request_with_timeout(url, headers, timeout):
-	
-	th = timeout_handler()
-	th.url = url
-	
-	# Register the signal function handler
-	signal.signal(signal.SIGALRM, th.handler_short)
-
-	# Set first timeout
-	signal.alarm(2)
-	
-	r = requests.get(url, headers = headers, timeout=timeout)
-	
-	# Cancel alarm
-	signal.alarm(0)
-
-	return r
+	return request_with_timeout('GET', url, headers, None, timeout)
+
+# Delays between retries grow exponentially from BACKOFF_BASE up to BACKOFF_MAX
+# seconds, each drawn uniformly below that ceiling ("full jitter") so that
+# threads which failed together do not retry together
+BACKOFF_BASE = 1
+BACKOFF_MAX = 120
+
+# Number of consecutive failures after which a host is considered down, and
+# how long (seconds) queries to it then fail fast before a probe is let through
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_COOLDOWN = 60
+
+# Period (seconds) over which spent retries are given back to the retry budgets
+RETRY_BUDGET_PERIOD = 3600
+
+def backoff(retries):
+	"""
+
+		Sleeps before a retry
+		Args:
+		* int (number of attempts so far)
+
+	"""
+	delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** retries))
+	logging.warning("Will try again in %.1f seconds." % delay)
+	time.sleep(delay)
+
+# Outcome of each query, per host: 'ok' (first attempt), 'retried' (succeeded
+# after retries), 'failed' or 'short-circuited' (not sent, host down or out of
+# retry budget)
+outcomes = collections.Counter()
+outcomes_lock = threading.Lock()
+
+def record_outcome(server, outcome):
+	with outcomes_lock:
+		outcomes[(urlparse.urlparse(server).netloc, outcome)] += 1
+
+def outcome_statistics():
+	"""
+
+		Counts the outcomes of all queries sent so far, per host
+		Returntype: { String (host): { String (outcome): int } }
+
+	"""
+	statistics = collections.defaultdict(dict)
+	with outcomes_lock:
+		for (host, outcome), count in outcomes.items():
+			statistics[host][outcome] = count
+	return dict(statistics)
+
+class retry_budget(object):
+	"""
+
+		Number of retries allowed, shared by all the threads spending it. 
+		Spent retries are given back linearly over RETRY_BUDGET_PERIOD 
+		seconds, so that a burst of errors only holds back retries for a 
+		while, not for the rest of a long run.
+
+	"""
+	def __init__(self):
+		self.spent = 0.0
+		self.timestamp = time.time()
+		self.lock = threading.Lock()
+
+	def spend(self, capacity):
+		"""
+
+			Takes one retry out of the budget, if there is any left
+			Args:
+			* int (retries allowed per RETRY_BUDGET_PERIOD)
+			Returntype: boolean
+
+		"""
+		with self.lock:
+			now = time.time()
+			self.spent = max(0.0, self.spent - (now - self.timestamp) * capacity / float(RETRY_BUDGET_PERIOD))
+			self.timestamp = now
+			if self.spent + 1 > capacity:
+				return False
+			self.spent += 1
+			return True
+
+	def refund(self):
+		with self.lock:
+			self.spent = max(0.0, self.spent - 1)
+
+run_retries = retry_budget()
+
+class host_health(object):
+	"""
+
+		Circuit breaker and retry budget of a host. After 
+		CIRCUIT_FAILURE_THRESHOLD consecutive failures the circuit opens 
+		and queries fail immediately with CircuitOpen. Once CIRCUIT_COOLDOWN
+		seconds have passed, a single probe query is let through: the 
+		circuit closes again if it succeeds, and stays open if it fails.
+		A probe ending any other way is released with end_probe, so that 
+		the next query probes again.
+
+	"""
+	def __init__(self, host):
+		self.host = host
+		self.consecutive_failures = 0
+		self.opened_at = None
+		# Ticket of the probe in flight, if any
+		self.probing = None
+		self.probes = 0
+		self.retries = retry_budget()
+		self.lock = threading.Lock()
+
+	def check(self, server, ext):
+		"""
+
+			Raises CircuitOpen if the host is down
+			Args:
+			* String (server name)
+			* String (extension string)
+			Returntype: int (probe ticket) if the query is a probe, else None
+
+		"""
+		with self.lock:
+			if self.opened_at is None:
+				return None
+			if self.probing is None and time.time() - self.opened_at >= CIRCUIT_COOLDOWN:
+				logging.warning("Probing %s after %i seconds of failures" % (self.host, CIRCUIT_COOLDOWN))
+				self.probes += 1
+				self.probing = self.probes
+				return self.probing
+		record_outcome(server, 'short-circuited')
+		raise CircuitOpen("%s is down, not querying %s%s" % (self.host, server, ext))
+
+	def end_probe(self, probe):
+		with self.lock:
+			if probe is not None and self.probing == probe:
+				self.probing = None
+
+	def spend_retry(self, server, ext):
+		if self.retries.spend(postgap.Globals.REST_HOST_RETRY_BUDGET):
+			if run_retries.spend(postgap.Globals.REST_RETRY_BUDGET):
+				return
+			self.retries.refund()
+		record_outcome(server, 'short-circuited')
+		raise RetryBudgetExhausted("Out of retries for %s, not querying %s%s again" % (self.host, server, ext))
+
+	def success(self):
+		with self.lock:
+			if self.opened_at is not None:
+				logging.info("%s is back up" % (self.host))
+			self.consecutive_failures = 0
+			self.opened_at = None
+			self.probing = None
+
+	def failure(self):
+		with self.lock:
+			self.consecutive_failures += 1
+			if self.probing is not None or (self.opened_at is None and self.consecutive_failures >= CIRCUIT_FAILURE_THRESHOLD):
+				logging.warning("%s seems to be down, failing fast for %i seconds" % (self.host, CIRCUIT_COOLDOWN))
+				self.opened_at = time.time()
+				self.probing = None
+
+host_healths = dict()
+
+def get_host_health(url):
+	"""
+
+		Returns the circuit breaker of a given host
+		Args:
+		* String (url)
+		Returntype: host_health
+
+	"""
+	host = urlparse.urlparse(url).netloc
+	with sessions_lock:
+		if host not in host_healths:
+			host_healths[host] = host_health(host)
+		return host_healths[host]
+
+class in_flight_call(object):
+	"""
+
+		A REST query being sent by one thread, which other threads 
+		issuing the same query wait on
+
+	"""
+	def __init__(self):
+		self.done = threading.Event()
+		self.followers = 0
+		self.result = None
+		self.error = None
+
+in_flight = dict()
+in_flight_lock = threading.Lock()
+coalesced_calls = collections.Counter()
 
 def get(server, ext, data=None):
 	"""
@@ -102,161 +546,409 @@ def get(server, ext, data=None):
 		Return type: JSON object
 
 	"""
-	maximum_retries = 10
+	cache = get_cache()
+	if cache is not None:
+		cached_response = cache.get(server, ext, data)
+		if cached_response is not None:
+			logging.debug("REST JSON Query (cached): %s%s" % (server, ext))
+			return json.loads(cached_response)
+
+	# Identical queries already in flight are not sent again, the 
+	# caller waits for the first one to return
+	key = postgap.RESTCache.cache_key(server, ext, data)
+	with in_flight_lock:
+		call = in_flight.get(key)
+		if call is None:
+			call = in_flight_call()
+			in_flight[key] = call
+			leader = True
+		else:
+			call.followers += 1
+			coalesced_calls[urlparse.urlparse(server).netloc] += 1
+			leader = False
+
+	if not leader:
+		logging.debug("REST JSON Query (coalesced): %s%s" % (server, ext))
+		call.done.wait()
+		if call.error is not None:
+			raise call.error
+		# Each caller gets its own copy, as results are sometimes modified in place
+		return copy.deepcopy(call.result)
+
+	result = None
+	try:
+		result = fetch(server, ext, data, cache)
+		return result
+	except Exception as e:
+		call.error = e
+		raise
+	finally:
+		with in_flight_lock:
+			del in_flight[key]
+			followers = call.followers
+		if followers > 0 and call.error is None:
+			call.result = copy.deepcopy(result)
+		call.done.set()
+
+def fetch(server, ext, data=None, cache=None):
+	"""
+
+		Sends a REST query to the server, retrying on failure with 
+		exponential backoff, within the hourly retry budgets of the run
+		and of the host. Fails fast with CircuitOpen if the host is known to be 
+		down.
+		Args:
+		* String (server name)
+		* String (extension string)
+		* JSON object (POST data) or None
+		* RESTCache or None (where to store the response)
+		Return type: JSON object
+
+	"""
+	host = get_host_health(server)
 
-	
-	for retries in range(maximum_retries):
+	for retries in range(postgap.Globals.REST_MAX_RETRIES):
 		
-		logging.debug("REST JSON Query: %s%s" % (server, ext))
-		start_time = time.time()
+		if retries > 0:
+			host.spend_retry(server, ext)
+			backoff(retries)
 
-		try:
-			if data is None:
-				headers = { "Content-Type" : "application/json" }
-				r = get_request_with_timeout(server.encode('ascii', 'xmlcharrefreplace')+ext.encode('ascii', 'xmlcharrefreplace'), headers = headers, timeout=200)
-			else:
-				headers = {'Content-Type': 'application/json', 'Accept': 'application/json'}
-				r = post_request_with_timeout(server.encode('ascii', 'xmlcharrefreplace')+ext.encode('ascii', 'xmlcharrefreplace'), headers = headers, data = json.dumps(data), timeout=200)
-                except requests.exceptions.ReadTimeout:
-			continue
-		except requests.exceptions.ConnectionError:
-			# A timeout can creep up as a connection error, so catching this as well.
-			# requests.exceptions.ConnectionError: HTTPConnectionPool(host='grch37.rest.ensembl.org', port=80): Read timed out.
-			logging.warning("Got a requests.exceptions.ConnectionError when querying %s%s" % (server, ext) )
-			continue
-		except requests.exceptions.ChunkedEncodingError:
-			# Happens every now and then when the eqtl server feels a bit 
-			# stressed.
-			logging.warning("Got a requests.exceptions.ChunkedEncodingError when querying %s%s" % (server, ext) )
-			continue
+		probe = host.check(server, ext)
 
+		try:
+			logging.debug("REST JSON Query: %s%s" % (server, ext))
+			start_time = time.time()
 
-		if not r.ok:
+			try:
+				if data is None:
+					headers = { "Content-Type" : "application/json" }
+					r, body = get_request_with_timeout(server.encode('ascii', 'xmlcharrefreplace')+ext.encode('ascii', 'xmlcharrefreplace'), headers = headers, timeout=postgap.Globals.REST_TIMEOUT)
+				else:
+					headers = {'Content-Type': 'application/json', 'Accept': 'application/json'}
+					r, body = post_request_with_timeout(server.encode('ascii', 'xmlcharrefreplace')+ext.encode('ascii', 'xmlcharrefreplace'), headers = headers, data = json.dumps(data), timeout=postgap.Globals.REST_TIMEOUT)
+			except requests.exceptions.ReadTimeout:
+				host.failure()
+				continue
+			except requests.exceptions.ConnectionError:
+				# A timeout can creep up as a connection error, so catching this as well.
+				# requests.exceptions.ConnectionError: HTTPConnectionPool(host='grch37.rest.ensembl.org', port=80): Read timed out.
+				logging.warning("Got a requests.exceptions.ConnectionError when querying %s%s" % (server, ext) )
+				host.failure()
+				continue
+			except requests.exceptions.ChunkedEncodingError:
+				# Happens every now and then when the eqtl server feels a bit 
+				# stressed.
+				logging.warning("Got a requests.exceptions.ChunkedEncodingError when querying %s%s" % (server, ext) )
+				host.failure()
+				continue
+
+
+			if not r.ok:
 			
-			logging.warning("Something went wrong code: %s" % (r.status_code))
+				logging.warning("Something went wrong code: %s" % (r.status_code))
 
-			http_response_code = None
+				http_response_code = None
 			
-			try:
-				http_response_code = httplib.responses[r.status_code]
-			except KeyError:
-				http_response_code = r.status_code
-				error_message = "Unknown status code %s" % (r.status_code)
-				logging.critical(error_message)
+				try:
+					http_response_code = httplib.responses[r.status_code]
+				except KeyError:
+					http_response_code = r.status_code
+					error_message = "Unknown status code %s" % (r.status_code)
+					logging.critical(error_message)
 			
-			#if (http_response_code == ""):
-				#error_message = "Unknown status code %s" % (r.status_code)
-				#logging.critical(error_message)
-				#raise RuntimeError(error_message)
+				logging.warning("Failed to get proper response to query %s%s" % (server, ext) )
+				logging.warning("With headers:" + repr(headers))
+				if data is not None:
+					logging.warning("With data:" + repr(data))
 			
-			logging.warning("Failed to get proper response to query %s%s" % (server, ext) )
-			logging.warning("With headers:" + repr(headers))
-			if data is not None:
-				logging.warning("With data:" + repr(data))
+				response_as_string = None
+				error_response = None
 			
-			response_as_string = None
+				try:
+					error_response = json.loads(body)
+					response_as_string = json.dumps(error_response)
+				except ValueError:
+					response_as_string = "<Error when stringifying>" + repr(r) + "</Error when stringifying>"
 			
-			try:
-				response_as_string = json.dumps(r.json())
-			except ValueError:
-				response_as_string = "<Error when stringifying>" + repr(r) + "</Error when stringifying>"
-			
-			logging.warning("Error code: %s (%s) %s" % (http_response_code, r.status_code, response_as_string ) )
-
-			#if retries == 5:
-			#	logging.critical("Giving up.")
-			#	r.raise_for_status()
+				logging.warning("Error code: %s (%s) %s" % (http_response_code, r.status_code, response_as_string ) )
 
-			if 'Retry-After' in r.headers:
-				if r.status_code == 429:
-					logging.warning("Got error 429 'Too Many Requests'" )
+				if 'Retry-After' in r.headers:
+					if r.status_code == 429:
+						logging.warning("Got error 429 'Too Many Requests'" )
 				
-				logging.warning("Will try again in %s seconds." % r.headers['Retry-After'])
-				time.sleep(int(r.headers['Retry-After']))
-
-			elif r.status_code == 502:
-				logging.warning("Got error 502 'Bad Gateway'. Will try again in %s seconds." % 2)
-				time.sleep(2) # Sleep while server cools down
-
-			elif r.status_code == 500:
-				logging.warning("Got error 500 'Internal server error'. Will try again in %s seconds." % 60)
-				time.sleep(2) # Sleep while server restarts 
-
-			elif r.status_code == requests.codes.forbidden:
-				logging.warning("Got 'forbidden' error: Will try again in %s seconds." % 600)
-				time.sleep(600) # Sleep 10 minutes while server calms down
-			elif r.status_code == 104 \
-				or r.status_code == requests.codes.gateway_timeout \
-				or r.status_code == requests.codes.request_timeout:
-
-				logging.warning("Got 'timeout error': Will try again in %s seconds." % 60)
-				time.sleep(60) # Sleep 1 minute while server cools down
-			elif r.status_code == 400:
-				# Check for errors that aren't actually errors
-				url = server + ext
-				if "/eqtl/" in url:
-					logging.warning("Error is expected behaviour by the eqtl server and will be passed on.")
-					raise EQTL400error(r)
-
-				if "/lookup/symbol" in url or '/lookup/id' in url:
-					logging.warning("Error is expected behaviour by the Ensembl gene lookup and will be passed on.")
-					raise GENE400error(r)
+					# Hold back every thread querying this server, not just this one
+					logging.warning("Will try again in %s seconds." % r.headers['Retry-After'])
+					get_rate_limiter(server + ext).pause(float(r.headers['Retry-After']))
+
+				elif r.status_code == 502:
+					logging.warning("Got error 502 'Bad Gateway'. Will try again.")
+					host.failure()
+
+				elif r.status_code == 500:
+					logging.warning("Got error 500 'Internal server error'. Will try again.")
+					host.failure()
+
+				elif r.status_code == requests.codes.forbidden:
+					logging.warning("Got 'forbidden' error: Will try again.")
+					host.failure()
+
+				elif r.status_code == 104 \
+					or r.status_code == requests.codes.gateway_timeout \
+					or r.status_code == requests.codes.request_timeout:
+
+					logging.warning("Got 'timeout error': Will try again.")
+					host.failure()
+
+				elif r.status_code == 400:
+					# The server is up, it just did not like the query
+					host.success()
+
+					# Check for errors that aren't actually errors
+					url = server + ext
+					if "/eqtl/" in url:
+						logging.warning("Error is expected behaviour by the eqtl server and will be passed on.")
+						raise EQTL400error(r, error_response)
+
+					if "/lookup/symbol" in url or '/lookup/id' in url:
+						logging.warning("Error is expected behaviour by the Ensembl gene lookup and will be passed on.")
+						raise GENE400error(r, error_response)
 				
-				if "/variation/" in url:
+					if "/variation/" in url:
 					
-					response = r.json()
+						response = error_response
 					
-					# Happens like this:
-					#
-					# Failed to get proper response to query http://grch37.rest.ensembl.org/variation/homo_sapiens/rs24449894?content-type=application/json
-					# With headers:{'Content-Type': 'application/json'}
-					# Error code: Bad Request (400) {"error": "rs24449894 not found for homo_sapiens"}
-					#
-					if " not found for" in response["error"]:
-						logging.warning("Error is expected behaviour by the variation endpoint and will be passed on.")
-						raise Variation400error(r)
-
-				if "/vep/" in url:
-					response = r.json()
-					if "No variant found with ID" in response["error"] or "No mappings found for variant" in response["error"]:
-						logging.warning("Error is expected behaviour by the vep endpoint and will be passed on.")
-						raise Variation400error(r)
-
-				# requests.exceptions.HTTPError: 400 Client Error: Bad Request for url: http://grch37.rest.ensembl.org/overlap/region/Human/5:117435127-119583975?feature=gene;content-type=application/json
-				if retries < 5:
-					logging.warning("Will try again in %s seconds." % 2)
-					time.sleep(2)
-					continue
-				logging.warning("Will try again in %s seconds." % 60)
-				time.sleep(60) # Sleep 1 minute while server cools down
-			else:
-				logging.warning("Got status code %s (%s)." % (r.status_code, http_response_code))
-				r.raise_for_status()
-			continue
+						# Happens like this:
+						#
+						# Failed to get proper response to query http://grch37.rest.ensembl.org/variation/homo_sapiens/rs24449894?content-type=application/json
+						# With headers:{'Content-Type': 'application/json'}
+						# Error code: Bad Request (400) {"error": "rs24449894 not found for homo_sapiens"}
+						#
+						if " not found for" in response["error"]:
+							logging.warning("Error is expected behaviour by the variation endpoint and will be passed on.")
+							raise Variation400error(r, error_response)
+
+					if "/vep/" in url:
+						response = error_response
+						if "No variant found with ID" in response["error"] or "No mappings found for variant" in response["error"]:
+							logging.warning("Error is expected behaviour by the vep endpoint and will be passed on.")
+							raise Variation400error(r, error_response)
+
+					# A bulk POST is rejected as a whole because of one bad ID: 
+					# retrying will not help, the caller splits the batch instead
+					if data is not None:
+						record_outcome(server, 'failed')
+						r.raise_for_status()
+
+					# requests.exceptions.HTTPError: 400 Client Error: Bad Request for url: http://grch37.rest.ensembl.org/overlap/region/Human/5:117435127-119583975?feature=gene;content-type=application/json
+					logging.warning("Will try again.")
+				else:
+					logging.warning("Got status code %s (%s)." % (r.status_code, http_response_code))
+					if 400 <= r.status_code < 500 and r.status_code != 429:
+						# A definitive answer: the server is up
+						host.success()
+					else:
+						host.failure()
+					record_outcome(server, 'failed')
+					r.raise_for_status()
+				continue
+
+			logging.debug("Time: %f" % (time.time() - start_time))
+			host.success()
+
+			try:
+				result = json.loads(body)
+			except:
+				error_message = "Failed to get proper response to query %s%s" % (server, ext) 
+				logging.critical(error_message)
+				record_outcome(server, 'failed')
+				raise requests.HTTPError(error_message)
 
-		logging.debug("Time: %f" % (time.time() - start_time))
+			if cache is not None:
+				cache.put(server, ext, data, result)
 
-		try:
-			return r.json()
-		except:
-			error_message = "Failed to get proper response to query %s%s" % (server, ext) 
-			logging.critical(error_message)
-			raise requests.HTTPError(error_message)
+			record_outcome(server, 'ok' if retries == 0 else 'retried')
+			return result
+		finally:
+			# A probe which neither succeeded nor failed (e.g. 429, or an
+			# unexpected exception) lets the next query probe again
+			host.end_probe(probe)
 
 	# Failed too many times
 	error_message = "Failed too many times to get a proper response for query %s%s !" % (server, ext)
 	logging.critical(error_message)
+	record_outcome(server, 'failed')
 	raise requests.exceptions.ConnectionError(error_message)
 
+# A batch slower than this (seconds) halves the batch size of its endpoint
+BATCH_LATENCY_TARGET = 30
+
+class batch_sizer(object):
+	"""
+
+		Picks the batch size of a bulk POST endpoint: the size doubles after
+		each full batch answered within BATCH_LATENCY_TARGET, up to the 
+		endpoint maximum, and halves when a batch is slow, times out or 
+		overloads the server.
+
+	"""
+	def __init__(self, maximum, initial=None):
+		self.maximum = maximum
+		self.size = initial if initial is not None else max(1, maximum / 4)
+		self.lock = threading.Lock()
+
+	def succeeded(self, batch_size, latency):
+		with self.lock:
+			if latency > BATCH_LATENCY_TARGET:
+				self.size = max(1, self.size / 2)
+			elif batch_size >= self.size:
+				self.size = min(self.maximum, self.size * 2)
+
+	def overloaded(self):
+		with self.lock:
+			self.size = max(1, self.size / 2)
+
+batch_sizers = dict()
+
+def get_batch_sizer(server, ext, maximum):
+	"""
+
+		Returns the batch sizer shared by all queries to a bulk endpoint
+		Args:
+		* String (server name)
+		* String (extension string)
+		* int (maximum batch size allowed by the endpoint)
+		Returntype: batch_sizer
+
+	"""
+	key = (server, urlparse.urlparse(ext).path, maximum)
+	with sessions_lock:
+		if key not in batch_sizers:
+			batch_sizers[key] = batch_sizer(maximum)
+		return batch_sizers[key]
+
+def post_in_batches(server, ext, key, ids, maximum_batch_size):
+	"""
+
+		Sends a list of IDs to a bulk POST endpoint, in batches sized by
+		the endpoint's batch_sizer. A batch rejected because of a bad ID is
+		split in half until the bad ID is isolated, without resending the
+		IDs of answered batches. IDs which cannot be queried are skipped.
+		Args:
+		* String (server name)
+		* String (extension string)
+		* String (key of the ID list in the POST data, e.g. 'ids')
+		* [ String ]
+		* int (maximum batch size allowed by the endpoint)
+		Return type: [ ([ String ] (batch), JSON object (response)) ]
+
+	"""
+	sizer = get_batch_sizer(server, ext, maximum_batch_size)
+	res = []
+	# Lists of IDs still to be sent, each sliced into batches in turn
+	pending = collections.deque([list(collections.OrderedDict.fromkeys(ids))])
+
+	while len(pending) > 0:
+		remaining = pending.popleft()
+		if len(remaining) == 0:
+			continue
+		batch = remaining[:sizer.size]
+		if len(remaining) > len(batch):
+			pending.appendleft(remaining[len(batch):])
+
+		start_time = time.time()
+		try:
+			response = get(server, ext, data = {key: batch})
+		except (CircuitOpen, RetryBudgetExhausted):
+			raise
+		except (unhandled_rest_exception, requests.exceptions.HTTPError) as error:
+			if isinstance(error, requests.exceptions.HTTPError) and error.response is not None and error.response.status_code in (requests.codes.gateway_timeout, requests.codes.request_entity_too_large):
+				overloaded(sizer, batch, pending, server, ext)
+				continue
+			if isinstance(error, requests.exceptions.HTTPError) and (error.response is None or error.response.status_code != requests.codes.bad_request):
+				raise
+			if len(batch) == 1:
+				logging.warning("Skipping %s, rejected by %s%s" % (batch[0], server, ext))
+			else:
+				pending.appendleft(batch[len(batch)/2:])
+				pending.appendleft(batch[:len(batch)/2])
+			continue
+		except requests.exceptions.ConnectionError:
+			overloaded(sizer, batch, pending, server, ext)
+			continue
+
+		sizer.succeeded(len(batch), time.time() - start_time)
+		res.append((batch, response))
+
+	return res
+
+def overloaded(sizer, batch, pending, server, ext):
+	"""
+
+		Shrinks the batch size of an endpoint after a timeout, and queues
+		the batch again, unless it cannot be made any smaller
+		Args:
+		* batch_sizer
+		* [ String ] (batch)
+		* collections.deque (pending lists of IDs)
+		* String (server name)
+		* String (extension string)
+
+	"""
+	sizer.overloaded()
+	if len(batch) == 1:
+		logging.warning("Skipping %s, timed out on %s%s" % (batch[0], server, ext))
+	else:
+		logging.warning("Reducing batch size of %s%s to %i" % (server, ext, sizer.size))
+		pending.appendleft(batch)
+
+def get_many(queries, max_in_flight=None):
+	"""
+
+		Runs several REST queries concurrently
+		Args:
+		* [ (String (server name), String (extension string)[, JSON object (POST data)]) ]
+		* int (maximum number of queries in flight, defaults to Globals.REST_MAX_IN_FLIGHT)
+		Return type: [ JSON object ], in the same order as the queries, with None for failed queries
+
+	"""
+	queries = list(queries)
+	if len(queries) == 0:
+		return []
+
+	if max_in_flight is None:
+		max_in_flight = postgap.Globals.REST_MAX_IN_FLIGHT
+
+	pool = ThreadPool(min(max_in_flight, len(queries)))
+	try:
+		return pool.map(get_or_none, queries)
+	finally:
+		pool.close()
+		pool.join()
+
+def get_or_none(query):
+	"""
+
+		Runs a REST query, logging failures instead of raising them
+		Args:
+		* (String (server name), String (extension string)[, JSON object (POST data)])
+		Return type: JSON object or None
+
+	"""
+	try:
+		return get(*query)
+	except Exception as e:
+		logging.warning("Got exception when querying %s%s: %s" % (query[0], query[1], e))
+		return None
+
 class unhandled_rest_exception(Exception):
-    def __init__(self, request):
+    def __init__(self, request, response):
 
         # No message to pass, so setting to ""
         super(Exception, self).__init__("")
 
         # Now for your custom code...
         self.request = request
-        self.response = request.json()
+        self.response = response
 
 class EQTL400error(unhandled_rest_exception):
 	pass
@@ -267,6 +959,12 @@ class GENE400error(unhandled_rest_exception):
 class Variation400error(unhandled_rest_exception):
 	pass
 
+class CircuitOpen(requests.exceptions.ConnectionError):
+	pass
+
+class RetryBudgetExhausted(requests.exceptions.ConnectionError):
+	pass
+
 
 
 
@@ -0,0 +1,215 @@
+#! /usr/bin/env python
+
+"""
+
+Copyright [1999-2018] EMBL-European Bioinformatics Institute
+
+Licensed under the Apache License, Version 2.0 (the "License")
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+		 http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+"""
+
+	Please email comments or questions to the public Ensembl
+	developers list at <http://lists.ensembl.org/mailman/listinfo/dev>.
+
+	Questions may also be sent to the Ensembl help desk at
+	<http://www.ensembl.org/Help/Contact>.
+
+"""
+import os
+import time
+import json
+import hashlib
+import sqlite3
+import logging
+import threading
+
+# Default upper bound on the total size of cached response bodies (bytes)
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024
+
+# Lifetime of cached responses, the first pattern found in the url wins.
+# GRCh37 is frozen, so most Ensembl payloads only change with a release,
+# whereas the GWAS Catalog is updated weekly.
+DAY = 24 * 3600
+ENDPOINT_TTLS = [
+	('/eqtl/',          30 * DAY),
+	('/variation/',     30 * DAY),
+	('/vep/',           30 * DAY),
+	('/lookup/',        30 * DAY),
+	('/overlap/',       30 * DAY),
+	('/ols/api/',        7 * DAY),
+	('/spot/zooma/',     7 * DAY),
+	('/gwas/rest/api/',  1 * DAY),
+]
+DEFAULT_TTL = 1 * DAY
+
+# How long to wait on a lock held by another worker process (seconds)
+SQLITE_TIMEOUT = 60
+
+# Access times are only refreshed when older than this, to spare writes on hot keys
+ACCESS_RESOLUTION = 60
+
+# Check the total size of the cache every so many insertions
+EVICTION_INTERVAL = 100
+
+# When over budget, evict down to this fraction of the maximum size
+EVICTION_TARGET = 0.9
+
+def cache_key(server, ext, data=None):
+	"""
+
+		Content address of a REST query
+		Args:
+		* String (server name)
+		* String (extension string)
+		* JSON object (POST body) or None
+		Returntype: String (hex digest)
+
+	"""
+	digest = hashlib.sha1()
+	digest.update(server.encode('utf-8'))
+	digest.update(ext.encode('utf-8'))
+	if data is not None:
+		digest.update(json.dumps(data, sort_keys=True))
+	return digest.hexdigest()
+
+def time_to_live(url):
+	"""
+
+		Lifetime of a cached response
+		Args:
+		* String (full url)
+		Returntype: scalar (seconds)
+
+	"""
+	for pattern, ttl in ENDPOINT_TTLS:
+		if pattern in url:
+			return ttl
+	return DEFAULT_TTL
+
+class RESTCache(object):
+	"""
+
+		Size-bounded, least-recently-used store of REST responses in an
+		SQLite file. The database runs in WAL mode so that several worker
+		processes can share one file, and each thread (or forked process)
+		opens its own connection.
+
+	"""
+	def __init__(self, filename, max_size=DEFAULT_MAX_SIZE):
+		self.filename = filename
+		self.max_size = max_size
+		self.local = threading.local()
+		self.insertions = 0
+		self.connection()
+
+	def connection(self):
+		if getattr(self.local, 'connection', None) is None or self.local.pid != os.getpid():
+			connection = sqlite3.connect(self.filename, timeout=SQLITE_TIMEOUT, isolation_level=None)
+			connection.text_factory = str
+			connection.execute('PRAGMA journal_mode=WAL')
+			connection.execute('PRAGMA synchronous=NORMAL')
+			connection.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, url TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL, size INTEGER NOT NULL, body TEXT NOT NULL)')
+			connection.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+			self.local.connection = connection
+			self.local.pid = os.getpid()
+		return self.local.connection
+
+	def get(self, server, ext, data=None):
+		"""
+
+			Returns the cached response body of a query if it is still fresh
+			Args:
+			* String (server name)
+			* String (extension string)
+			* JSON object (POST body) or None
+			Returntype: String (JSON) or None
+
+		"""
+		key = cache_key(server, ext, data)
+		now = time.time()
+		try:
+			connection = self.connection()
+			row = connection.execute('SELECT created, accessed, body FROM responses WHERE key = ?', (key,)).fetchone()
+			if row is None:
+				return None
+
+			created, accessed, body = row
+			if now - created > time_to_live(server + ext):
+				return None
+
+			if now - accessed > ACCESS_RESOLUTION:
+				connection.execute('UPDATE responses SET accessed = ? WHERE key = ?', (now, key))
+		except sqlite3.Error as e:
+			logging.warning("Could not read REST cache %s: %s" % (self.filename, e))
+			return None
+
+		return body
+
+	def put(self, server, ext, data, value):
+		"""
+
+			Stores the response to a query
+			Args:
+			* String (server name)
+			* String (extension string)
+			* JSON object (POST body) or None
+			* JSON object (response)
+
+		"""
+		key = cache_key(server, ext, data)
+		body = json.dumps(value)
+		now = time.time()
+		try:
+			self.connection().execute('INSERT OR REPLACE INTO responses (key, url, created, accessed, size, body) VALUES (?, ?, ?, ?, ?, ?)', (key, (server + ext).encode('utf-8'), now, now, len(body), body))
+		except sqlite3.Error as e:
+			logging.warning("Could not write to REST cache %s: %s" % (self.filename, e))
+			return
+
+		self.insertions += 1
+		if self.insertions % EVICTION_INTERVAL == 0:
+			self.evict()
+
+	def evict(self):
+		"""
+
+			Deletes the least recently used responses once the cache is over budget
+
+		"""
+		connection = self.connection()
+		try:
+			total_size = connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+			if total_size <= self.max_size:
+				return
+
+			excess = total_size - self.max_size * EVICTION_TARGET
+			connection.execute('BEGIN IMMEDIATE')
+			try:
+				freed = 0
+				keys = []
+				for key, size in connection.execute('SELECT key, size FROM responses ORDER BY accessed'):
+					keys.append((key,))
+					freed += size
+					if freed >= excess:
+						break
+				connection.executemany('DELETE FROM responses WHERE key = ?', keys)
+				connection.execute('COMMIT')
+			except:
+				connection.execute('ROLLBACK')
+				raise
+		except sqlite3.Error as e:
+			logging.warning("Could not evict from REST cache %s: %s" % (self.filename, e))
+			return
+
+		logging.info("Evicted %i responses (%i bytes) from REST cache %s" % (len(keys), freed, self.filename))
@@ -0,0 +1,327 @@
+#! /usr/bin/env python
+
+"""
+
+Copyright [1999-2018] EMBL-European Bioinformatics Institute
+
+Licensed under the Apache License, Version 2.0 (the "License")
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+		 http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+"""
+
+	Please email comments or questions to the public Ensembl
+	developers list at <http://lists.ensembl.org/mailman/listinfo/dev>.
+
+	Questions may also be sent to the Ensembl help desk at
+	<http://www.ensembl.org/Help/Contact>.
+
+"""
+
+"""
+
+	Stand-in for the REST servers, to run and benchmark POSTGAP offline.
+
+	In recording mode, every response received from a server is saved as a
+	JSON fixture in a directory. In replay mode, queries are answered from
+	these fixtures, either by a transport mounted on the REST sessions
+	(--rest_replay) or by a small HTTP proxy:
+
+		python lib/postgap/RESTFixtures.py fixtures/ --port 8080 --latency 0.1
+		http_proxy=http://localhost:8080 python POSTGAP.py ...
+
+	Replayed responses can be slowed down or replaced by errors, with a
+	seeded random generator so that runs are reproducible.
+
+"""
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import logging
+import argparse
+import threading
+import urlparse
+import StringIO
+import BaseHTTPServer
+import SocketServer
+
+import requests
+import requests.adapters
+import requests.structures
+
+# Status returned by injected errors, retried by postgap.REST.get
+DEFAULT_ERROR_STATUS = 502
+
+# Status returned by the proxy for queries that were never recorded
+MISSING_FIXTURE_STATUS = 404
+
+class missing_fixture_exception(Exception):
+	"""
+
+		Raised when replaying a query which was never recorded
+
+	"""
+	pass
+
+def fixture_key(method, url, body=None):
+	"""
+
+		Name of the fixture of a query. The scheme is left out, so that the
+		same fixtures serve http and https urls, as well as the proxy.
+		Args:
+		* String (HTTP method)
+		* String (url)
+		* String (request body) or None
+		Returntype: String (hex digest)
+
+	"""
+	parsed_url = urlparse.urlparse(url)
+	digest = hashlib.sha1()
+	digest.update(method.upper())
+	digest.update(' ')
+	digest.update(parsed_url.netloc + parsed_url.path)
+	if parsed_url.query:
+		digest.update('?' + parsed_url.query)
+	if body:
+		digest.update('\n')
+		digest.update(body)
+	return digest.hexdigest()
+
+def fixture_path(directory, key):
+	return os.path.join(directory, key[:2], key + '.json')
+
+def save_fixture(directory, method, url, body, status, headers, content):
+	"""
+
+		Writes a response to the fixture directory
+		Args:
+		* String (fixture directory)
+		* String (HTTP method)
+		* String (url)
+		* String (request body) or None
+		* int (HTTP status)
+		* dict (response headers)
+		* String (response body)
+
+	"""
+	filename = fixture_path(directory, fixture_key(method, url, body))
+	if not os.path.exists(os.path.dirname(filename)):
+		try:
+			os.makedirs(os.path.dirname(filename))
+		except OSError:
+			# Created by another thread in the meantime
+			pass
+
+	fixture = {
+		'method': method,
+		'url': url,
+		'body': body,
+		'status': status,
+		'headers': dict((key, value) for key, value in headers.items() if key.lower() in ('content-type', 'retry-after')),
+		'content': content.decode('utf-8', 'replace')
+	}
+
+	# Write then rename, so that concurrent readers never see half a fixture
+	temporary_filename = "%s.%i.%s.tmp" % (filename, os.getpid(), threading.current_thread().ident)
+	with open(temporary_filename, 'w') as file:
+		json.dump(fixture, file)
+	os.rename(temporary_filename, filename)
+
+def load_fixture(directory, method, url, body=None):
+	"""
+
+		Reads the recorded response to a query
+		Args:
+		* String (fixture directory)
+		* String (HTTP method)
+		* String (url)
+		* String (request body) or None
+		Returntype: dict (fixture) or None
+
+	"""
+	filename = fixture_path(directory, fixture_key(method, url, body))
+	if not os.path.exists(filename):
+		return None
+	with open(filename) as file:
+		return json.load(file)
+
+class replay_profile(object):
+	"""
+
+		Latencies and errors injected into replayed responses. Each response
+		is delayed by latency seconds plus a uniform jitter, and replaced by
+		an error_status response with probability error_rate.
+
+	"""
+	def __init__(self, latency=0, jitter=0, error_rate=0, error_status=DEFAULT_ERROR_STATUS, seed=0):
+		self.latency = latency
+		self.jitter = jitter
+		self.error_rate = error_rate
+		self.error_status = error_status
+		self.random = random.Random(seed)
+		self.lock = threading.Lock()
+
+	def draw(self):
+		"""
+
+			Returns the delay and whether to fail the next response
+			Returntype: (scalar (seconds), boolean)
+
+		"""
+		with self.lock:
+			delay = self.latency + self.random.uniform(0, self.jitter)
+			failure = self.random.random() < self.error_rate
+		return delay, failure
+
+def replay(directory, profile, method, url, body=None):
+	"""
+
+		Computes the replayed response to a query, after the profile's 
+		delay. Raises missing_fixture_exception if it was never recorded.
+		Args:
+		* String (fixture directory)
+		* replay_profile
+		* String (HTTP method)
+		* String (url)
+		* String (request body) or None
+		Returntype: (int (HTTP status), dict (headers), String (body))
+
+	"""
+	delay, failure = profile.draw()
+	if delay > 0:
+		time.sleep(delay)
+
+	if failure:
+		return profile.error_status, {'Content-Type': 'application/json'}, json.dumps({'error': 'Injected error'})
+
+	fixture = load_fixture(directory, method, url, body)
+	if fixture is None:
+		raise missing_fixture_exception("No fixture recorded for %s %s" % (method, url))
+
+	return fixture['status'], fixture['headers'], fixture['content'].encode('utf-8')
+
+class recording_adapter(requests.adapters.HTTPAdapter):
+	"""
+
+		Transport which queries the real servers and saves every response
+		as a fixture
+
+	"""
+	def __init__(self, directory, **kwargs):
+		self.directory = directory
+		super(recording_adapter, self).__init__(**kwargs)
+
+	def send(self, request, **kwargs):
+		response = super(recording_adapter, self).send(request, **kwargs)
+		# Reading the content here leaves it available to the caller
+		save_fixture(self.directory, request.method, request.url, request.body, response.status_code, response.headers, response.content)
+		return response
+
+class replay_adapter(requests.adapters.BaseAdapter):
+	"""
+
+		Transport which answers queries from the fixtures, without touching
+		the network
+
+	"""
+	def __init__(self, directory, profile=None):
+		self.directory = directory
+		self.profile = profile if profile is not None else replay_profile()
+		super(replay_adapter, self).__init__()
+
+	def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+		status, headers, content = replay(self.directory, self.profile, request.method, request.url, request.body)
+
+		response = requests.models.Response()
+		response.status_code = status
+		response.reason = BaseHTTPServer.BaseHTTPRequestHandler.responses.get(status, ('',))[0]
+		response.headers = requests.structures.CaseInsensitiveDict(headers)
+		response.encoding = 'utf-8'
+		response.url = request.url
+		response.request = request
+		response.connection = self
+		response.raw = StringIO.StringIO(content)
+		if not stream:
+			response.content
+		return response
+
+	def close(self):
+		pass
+
+class fixture_request_handler(BaseHTTPServer.BaseHTTPRequestHandler):
+	"""
+
+		Answers proxied queries from the fixtures of the server
+
+	"""
+	def do_GET(self):
+		self.answer(None)
+
+	def do_POST(self):
+		self.answer(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+
+	def answer(self, body):
+		# As a proxy, the full url is on the request line
+		if self.path.startswith('/'):
+			url = 'http://' + self.headers.get('Host', 'localhost') + self.path
+		else:
+			url = self.path
+
+		try:
+			status, headers, content = replay(self.server.directory, self.server.profile, self.command, url, body)
+		except missing_fixture_exception as e:
+			logging.warning(str(e))
+			status, headers, content = MISSING_FIXTURE_STATUS, {'Content-Type': 'application/json'}, json.dumps({'error': str(e)})
+		self.send_response(status)
+		for key, value in headers.items():
+			self.send_header(key, value)
+		self.send_header('Content-Length', str(len(content)))
+		self.end_headers()
+		self.wfile.write(content)
+
+	def log_message(self, format, *args):
+		logging.debug(format % args)
+
+class fixture_server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+
+	def __init__(self, address, directory, profile):
+		BaseHTTPServer.HTTPServer.__init__(self, address, fixture_request_handler)
+		self.directory = directory
+		self.profile = profile
+
+def main():
+	parser = argparse.ArgumentParser(description='Serves recorded REST responses as an HTTP proxy')
+	parser.add_argument('directory', help='Fixture directory, as filled by POSTGAP.py --rest_record')
+	parser.add_argument('--port', type=int, default=8080)
+	parser.add_argument('--latency', type=float, default=0, help='Delay added to each response (seconds)')
+	parser.add_argument('--jitter', type=float, default=0, help='Maximum random delay added on top of the latency (seconds)')
+	parser.add_argument('--error_rate', type=float, default=0, help='Fraction of responses replaced by errors')
+	parser.add_argument('--error_status', type=int, default=DEFAULT_ERROR_STATUS, help='HTTP status of injected errors')
+	parser.add_argument('--seed', type=int, default=0, help='Seed of the latency and error generator')
+	options = parser.parse_args()
+
+	logging.basicConfig(level=logging.INFO)
+	profile = replay_profile(options.latency, options.jitter, options.error_rate, options.error_status, options.seed)
+	server = fixture_server(('localhost', options.port), options.directory, profile)
+	logging.info("Serving fixtures from %s on port %i" % (options.directory, options.port))
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+
+if __name__ == "__main__":
+	main()
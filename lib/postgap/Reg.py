@@ -38,6 +38,9 @@ import subprocess
 import tempfile
 from postgap.REST import Variation400error
 
+# Maximum number of variants per VEP POST query, set by the Ensembl REST server
+VEP_MAX_BATCH_SIZE = 200
+
 class Reg_source(object):
 	def run(self, ld_snps, tissues):
 		"""
@@ -116,7 +119,7 @@ class VEP_reg(Reg_source):
 			Returntype: [ Regulatory_Evidence ]
 
 		"""
-		list = concatenate(self.get(chunk) for chunk in chunks(snps, 1))
+		list = self.get(snps)
 		'''
 
 			Example output from VEP:
@@ -223,7 +226,9 @@ class VEP_reg(Reg_source):
 	def get(self, chunk_param):
 		"""
 
-			Queries Ensembl servers. Recursively breaks down query if error code 400 is returned
+			Queries Ensembl servers in batches. Batches rejected with error 
+			code 400 ("Bad request") are broken down until the offending SNP
+			is isolated
 			Args:
 			* [ SNP ]
 			Returntype: [ Regulatory_Evidence ]
@@ -236,23 +241,10 @@ class VEP_reg(Reg_source):
 		if len(chunk) == 0:
 			return []
 
-		try:
-			server = "http://grch37.rest.ensembl.org"
-			ext = "/vep/%s/id" % (postgap.Globals.SPECIES)
-			return postgap.REST.get(server, ext, data = {"ids" : [snp.rsID for snp in chunk]})
-
-		except requests.exceptions.HTTPError as error:
-			if error.response.status_code == 400 or error.response.status_code == 504:
-				if len(chunk) == 1:
-					return []
-				else:
-					return self.get(chunk[:len(chunk)/2]) + self.get(chunk[len(chunk)/2:])
-			raise
-		except Variation400error as error:
-			if len(chunk) == 1:
-				return []
-			else:
-				return self.get(chunk[:len(chunk)/2]) + self.get(chunk[len(chunk)/2:])
+		server = "http://grch37.rest.ensembl.org"
+		ext = "/vep/%s/id" % (postgap.Globals.SPECIES)
+		return concatenate(response for batch, response in postgap.REST.post_in_batches(server, ext, "ids", [snp.rsID for snp in chunk], VEP_MAX_BATCH_SIZE))
+				
 
 class GERP(Reg_source):
 	display_name = 'GERP'
@@ -107,6 +107,8 @@ def get_options():
   # set defaults
   postgap.Globals.DATABASES_DIR = 'databases'
   postgap.Globals.SPECIES = 'Human'
+  # Keeps gene and SNP lookups across restarts
+  postgap.Globals.LOOKUP_SNAPSHOT_FILE = 'ensembl_lookups.sqlite'
 
   return options
 
@@ -0,0 +1,535 @@
+#! /usr/bin/env python
+
+"""
+
+Copyright [1999-2018] EMBL-European Bioinformatics Institute
+
+Licensed under the Apache License, Version 2.0 (the "License")
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+		 http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+"""
+
+	Please email comments or questions to the public Ensembl
+	developers list at <http://lists.ensembl.org/mailman/listinfo/dev>.
+
+	Questions may also be sent to the Ensembl help desk at
+	<http://www.ensembl.org/Help/Contact>.
+
+"""
+import os
+import re
+import io
+import gzip
+import array
+import logging
+import threading
+import numpy
+
+# pysam is only loaded if a tabix index is used
+pysam = None
+
+import postgap.Globals
+from postgap.DataModel import *
+
+# Number of GWAS_Associations returned at once
+BATCH_SIZE = 10000
+
+RSID_REGEX = re.compile('^rs(\d+)$')
+
+# Largest rsID number held in the uint32 arrays of a store
+MAX_RSID_NUMBER = 2**32 - 1
+
+# Position of variant IDs such as 1:12345, chr1_12345_A_G
+VARIANT_POSITION_REGEX = re.compile('^(?:chr)?([0-9A-Za-z]+)[:_](\d+)')
+
+# Largest position held in the uint32 arrays of a store
+MAX_POSITION = 2**32 - 1
+
+# SNPs closer than this share a tabix fetch, farther ones are fetched separately
+MAX_REGION_GAP = 10000
+
+stores = {}
+stores_lock = threading.Lock()
+
+class summary_stats_format_exception(Exception):
+	pass
+
+def open_summary_stats(filename):
+	"""
+
+		Opens a summary statistics file, plain text or compressed with gzip
+		or bgzip
+		Args:
+		* string (filename)
+		Returntype: file
+
+	"""
+	with open(filename, 'rb') as file:
+		magic = file.read(2)
+	if magic == '\x1f\x8b':
+		# GzipFile.readline is slow on its own
+		return io.BufferedReader(gzip.open(filename))
+	return open(filename)
+
+def get_column_indices(header, required):
+	"""
+
+		Finds the columns of a summary statistics file, using the labels of
+		Globals.SUMMARY_STATS_COLUMNS
+		Args:
+		* string (header line)
+		* [ string ] (required column names)
+		Returntype: dict(string (column name) => int (index))
+
+	"""
+	labels = header.rstrip('\r\n').split('\t')
+	indices = dict()
+	for name, label in postgap.Globals.SUMMARY_STATS_COLUMNS.items():
+		if label in labels:
+			indices[name] = labels.index(label)
+
+	for name in required:
+		if name not in indices:
+			raise summary_stats_format_exception("Summary statistics file has no column %s for %s, columns are: %s" % (postgap.Globals.SUMMARY_STATS_COLUMNS.get(name, name), name, ", ".join(labels)))
+
+	return indices
+
+def association_batches(filename, pvalue_threshold=None, batch_size=BATCH_SIZE):
+	"""
+
+		Reads the associations of a summary statistics file, in batches.
+		The p-value of each row is read first, so that the rest of the row
+		is only split if it passes the threshold.
+		Args:
+		* string (filename)
+		* float (p-value threshold, rows with a p-value at or above it are skipped)
+		* int (batch size)
+		Returntype: iterator of [ GWAS_Association ]
+
+	"""
+	file = open_summary_stats(filename)
+	indices = get_column_indices(file.readline(), ['variant_id', 'p-value', 'beta'])
+	pvalue_index = indices['p-value']
+	variant_id_index = indices['variant_id']
+	beta_index = indices['beta']
+
+	batch = []
+	for line in file:
+		try:
+			pvalue = float(line.split('\t', pvalue_index + 1)[pvalue_index])
+		except (ValueError, IndexError):
+			continue
+		if pvalue_threshold is not None and not pvalue < pvalue_threshold:
+			continue
+
+		items = line.rstrip('\r\n').split('\t')
+		try:
+			beta = float(items[beta_index])
+		except (ValueError, IndexError):
+			continue
+
+		batch.append(create_association(items[variant_id_index], pvalue, beta))
+		if len(batch) >= batch_size:
+			yield batch
+			batch = []
+
+	file.close()
+	if len(batch) > 0:
+		yield batch
+
+def create_association(variant_id, pvalue, beta):
+	"""
+
+		Creates a GWAS_Association for a row of summary statistics
+		Args:
+		* string (variant ID)
+		* float (p-value)
+		* float (beta)
+		Returntype: GWAS_Association
+
+	"""
+	# TODO insert study info (from command line? config file?)
+	return GWAS_Association(
+		pvalue                            = pvalue,
+		pvalue_description                = 'Manual',
+		snp                               = variant_id,
+		disease                           = Disease(name = 'Manual', efo = 'EFO_Manual'),
+		reported_trait                    = "Manual",
+		source                            = "Manual",
+		publication                       = "PMID000",
+		study                             = "Manual",
+		sample_size                       = 1000,
+		odds_ratio                        = None,
+		odds_ratio_ci_start               = None,
+		odds_ratio_ci_end                 = None,
+		beta_coefficient                  = beta,
+		beta_coefficient_unit             = "Manual",
+		beta_coefficient_direction        = "Manual",
+		rest_hash                         = None,
+		risk_alleles_present_in_reference = None,
+	)
+
+def rsid_number(variant_id):
+	"""
+
+		Returns the number of an rsID, if it fits the arrays of a store
+		Args:
+		* string (variant ID)
+		Returntype: int or None
+
+	"""
+	match = RSID_REGEX.match(variant_id)
+	if match is None or int(match.group(1)) > MAX_RSID_NUMBER:
+		return None
+	return int(match.group(1))
+
+def row_location(items, variant_id, chromosome_index, position_index):
+	"""
+
+		Returns the chromosome and position of a row, from its columns if
+		the file has them, otherwise from its variant ID
+		Args:
+		* [ string ] (row items)
+		* string (variant ID)
+		* int or None (index of the chromosome column)
+		* int or None (index of the position column)
+		Returntype: (string (chromosome, without chr prefix), int (position)) or None
+
+	"""
+	try:
+		chrom = items[chromosome_index]
+		pos = int(items[position_index])
+	except (TypeError, ValueError, IndexError):
+		match = VARIANT_POSITION_REGEX.match(variant_id)
+		if match is None:
+			return None
+		chrom = match.group(1)
+		pos = int(match.group(2))
+
+	if pos < 0 or pos > MAX_POSITION:
+		return None
+	return chromosome_name(chrom), pos
+
+def chromosome_name(chrom):
+	"""
+
+		Returns the name of a chromosome without its chr prefix
+		Args:
+		* string (chromosome)
+		Returntype: string
+
+	"""
+	if chrom.startswith('chr'):
+		return chrom[3:]
+	return chrom
+
+def first_rows(keys):
+	"""
+
+		Sorts the keys of the rows of a file, keeping only the first row
+		of each key
+		Args:
+		* numpy.array (keys)
+		Returntype: (numpy.array (sorted distinct keys), numpy.array (row of each key))
+
+	"""
+	# Stable sort, so that the first row of each key comes first
+	order = numpy.argsort(keys, kind='mergesort')
+	keys = keys[order]
+	first = numpy.ones(len(keys), dtype=bool)
+	first[1:] = keys[1:] != keys[:-1]
+	return keys[first], order[first]
+
+def find_rows(sorted_keys, rows, keys):
+	"""
+
+		Looks up keys among sorted keys
+		Args:
+		* numpy.array (sorted distinct keys)
+		* numpy.array (row of each sorted key)
+		* [ int ] (keys)
+		Returntype: (numpy.array (boolean, whether each key was found), numpy.array (row of each key))
+
+	"""
+	keys = numpy.array(keys, dtype=numpy.int64)
+	if len(sorted_keys) == 0:
+		return numpy.zeros(len(keys), dtype=bool), numpy.zeros(len(keys), dtype=numpy.int64)
+	positions = numpy.minimum(numpy.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)
+	return sorted_keys[positions] == keys, rows[positions]
+
+class summary_stats_store(object):
+	"""
+
+		P-values and betas of all the rows of a summary statistics file,
+		read once. rsIDs are stored as numpy arrays sorted by rsID number,
+		so that a batch of rsIDs is looked up with a single searchsorted.
+		Rows with other variant IDs are stored the same way, sorted by
+		chromosome and position, which are read from the chromosome and
+		base_pair_location columns, or else from the variant ID (e.g.
+		1:12345_A_G). Rows without either are skipped. Only the first row
+		of each rsID or position is kept. SNPs are looked up by rsID, then
+		by position among the rows without an rsID.
+
+	"""
+	def __init__(self, filename):
+		self.filename = filename
+		self.chromosomes = dict()
+		rsids = array.array('I')
+		rsid_rows = array.array('I')
+		chromosome_ids = array.array('I')
+		positions = array.array('I')
+		position_rows = array.array('I')
+		pvalues = array.array('d')
+		betas = array.array('d')
+		skipped = 0
+
+		file = open_summary_stats(filename)
+		indices = get_column_indices(file.readline(), ['variant_id', 'p-value', 'beta'])
+		variant_id_index = indices['variant_id']
+		pvalue_index = indices['p-value']
+		beta_index = indices['beta']
+		chromosome_index = indices.get('chromosome')
+		position_index = indices.get('base_pair_location')
+
+		for line in file:
+			items = line.rstrip('\r\n').split('\t')
+			try:
+				variant_id = items[variant_id_index]
+				pvalue = float(items[pvalue_index])
+				beta = float(items[beta_index])
+			except (ValueError, IndexError):
+				continue
+
+			number = rsid_number(variant_id)
+			if number is not None:
+				rsids.append(number)
+				rsid_rows.append(len(pvalues))
+			else:
+				location = row_location(items, variant_id, chromosome_index, position_index)
+				if location is None:
+					skipped += 1
+					continue
+				if location[0] not in self.chromosomes:
+					self.chromosomes[location[0]] = len(self.chromosomes)
+				chromosome_ids.append(self.chromosomes[location[0]])
+				positions.append(location[1])
+				position_rows.append(len(pvalues))
+			pvalues.append(pvalue)
+			betas.append(beta)
+		file.close()
+
+		self.rsids, self.rsid_rows = first_rows(numpy.frombuffer(rsids, dtype=numpy.uint32))
+		self.rsid_rows = numpy.frombuffer(rsid_rows, dtype=numpy.uint32)[self.rsid_rows]
+		self.positions, self.position_rows = first_rows(self.position_keys(numpy.frombuffer(chromosome_ids, dtype=numpy.uint32), numpy.frombuffer(positions, dtype=numpy.uint32)))
+		self.position_rows = numpy.frombuffer(position_rows, dtype=numpy.uint32)[self.position_rows]
+		self.pvalues = numpy.frombuffer(pvalues, dtype=numpy.float64)
+		self.betas = numpy.frombuffer(betas, dtype=numpy.float64)
+
+		if skipped > 0:
+			logging.warning("Skipped %i rows of %s without an rsID or a position" % (skipped, filename))
+		logging.info("Loaded %i variants from %s" % (len(self.rsids) + len(self.positions), filename))
+
+	def position_keys(self, chromosome_ids, positions):
+		"""
+
+			Combines chromosome IDs and positions into sortable keys
+			Args:
+			* numpy.array (chromosome IDs)
+			* numpy.array (positions)
+			Returntype: numpy.array
+
+		"""
+		return (chromosome_ids.astype(numpy.int64) << 32) | positions.astype(numpy.int64)
+
+	def get(self, snps):
+		"""
+
+			Returns the p-values and betas of the SNPs found in the file,
+			by rsID, or else by position among the rows without an rsID
+			Args:
+			* [ SNP ]
+			Returntype: dict(string (variant ID) => (float (p-value), float (beta)))
+
+		"""
+		snps = list(snps)
+		rsid_snps = dict()
+		for snp in snps:
+			number = rsid_number(snp.rsID)
+			if number is not None:
+				rsid_snps[snp.rsID] = number
+
+		res = dict()
+		self.find(rsid_snps, self.rsids, self.rsid_rows, res)
+
+		position_snps = dict()
+		for snp in snps:
+			if snp.rsID in res or snp.chrom is None or snp.pos is None or not 0 <= snp.pos <= MAX_POSITION:
+				continue
+			chromosome_id = self.chromosomes.get(chromosome_name(snp.chrom))
+			if chromosome_id is not None:
+				position_snps[snp.rsID] = (chromosome_id << 32) | snp.pos
+		self.find(position_snps, self.positions, self.position_rows, res)
+
+		return res
+
+	def find(self, keys, sorted_keys, rows, res):
+		"""
+
+			Looks up the keys of variants, and adds the values of those found
+			to a result dict
+			Args:
+			* dict(string (variant ID) => int (key))
+			* numpy.array (sorted distinct keys)
+			* numpy.array (row of each sorted key)
+			* dict(string (variant ID) => (float (p-value), float (beta)))
+
+		"""
+		if len(keys) == 0:
+			return
+		variant_ids = list(keys.keys())
+		found, found_rows = find_rows(sorted_keys, rows, [keys[variant_id] for variant_id in variant_ids])
+		for variant_id, row in zip(numpy.array(variant_ids)[found].tolist(), found_rows[found].tolist()):
+			res[variant_id] = (float(self.pvalues[row]), float(self.betas[row]))
+
+def get_store(filename):
+	"""
+
+		Returns the store of a summary statistics file, reading the file on
+		first use
+		Args:
+		* string (filename)
+		Returntype: summary_stats_store
+
+	"""
+	with stores_lock:
+		if filename not in stores:
+			stores[filename] = summary_stats_store(filename)
+		return stores[filename]
+
+def load_pysam():
+	"""
+
+		Loads pysam, if installed
+		Returntype: boolean
+
+	"""
+	global pysam
+	if pysam is None:
+		try:
+			import pysam
+		except ImportError:
+			logging.warning("pysam is not installed, summary statistics will be read without their tabix index")
+			pysam = False
+	return pysam is not False
+
+def get_snp_results(filename, snps):
+	"""
+
+		Returns the p-values and betas of SNPs, by rsID, or else by position
+		among the rows without an rsID. If the file is compressed with bgzip
+		and indexed with tabix, only the rows around the SNPs are read, 
+		otherwise the SNPs are looked up in the store of the file
+		Args:
+		* string (filename)
+		* [ SNP ]
+		Returntype: dict(string (variant ID) => (float (p-value), float (beta)))
+
+	"""
+	snps = list(snps)
+	if len(snps) == 0:
+		return dict()
+
+	if not os.path.exists(filename + '.tbi') or any(snp.chrom is None or snp.pos is None for snp in snps) or not load_pysam():
+		return get_store(filename).get(snps)
+
+	res = dict()
+	for chrom in set(chromosome_name(snp.chrom) for snp in snps):
+		chrom_snps = [snp for snp in snps if chromosome_name(snp.chrom) == chrom]
+		by_id = dict()
+		by_position = dict()
+		for start, end in snp_windows([snp.pos for snp in chrom_snps]):
+			for variant_id, (pos, pvalue, beta) in region_results(filename, chrom, start, end).items():
+				by_id.setdefault(variant_id, (pvalue, beta))
+				if pos is not None and rsid_number(variant_id) is None:
+					by_position.setdefault(pos, (pvalue, beta))
+
+		for snp in chrom_snps:
+			if snp.rsID in by_id:
+				res[snp.rsID] = by_id[snp.rsID]
+			elif snp.pos in by_position:
+				res[snp.rsID] = by_position[snp.pos]
+	return res
+
+def snp_windows(positions, max_gap=MAX_REGION_GAP):
+	"""
+
+		Groups the positions of SNPs into the regions to fetch: SNPs closer
+		than max_gap to the previous one share its region, others get a 
+		region of their own
+		Args:
+		* [ int ] (positions)
+		* int (largest gap within a region)
+		Returntype: [ (int (start, 1-based), int (end, inclusive)) ]
+
+	"""
+	res = []
+	for pos in sorted(positions):
+		if len(res) > 0 and pos - res[-1][1] <= max_gap:
+			res[-1] = (res[-1][0], pos)
+		else:
+			res.append((pos, pos))
+	return res
+
+def region_results(filename, chrom, start, end):
+	"""
+
+		Reads the positions, p-values and betas of the rows within a region,
+		through the tabix index of a file. Positions are read as in the 
+		store, and are None if a row has none.
+		Args:
+		* string (filename)
+		* string (chromosome)
+		* int (start, 1-based)
+		* int (end, inclusive)
+		Returntype: dict(string (variant ID) => (int (position) or None, float (p-value), float (beta)))
+
+	"""
+	file = open_summary_stats(filename)
+	indices = get_column_indices(file.readline(), ['variant_id', 'p-value', 'beta'])
+	file.close()
+
+	# Each call opens its own handle, so that concurrent workers can share the file
+	tabix_file = pysam.TabixFile(filename)
+	if chrom not in tabix_file.contigs and 'chr' + chrom in tabix_file.contigs:
+		chrom = 'chr' + chrom
+	if chrom not in tabix_file.contigs:
+		tabix_file.close()
+		return dict()
+
+	res = dict()
+	for line in tabix_file.fetch(chrom, start - 1, end):
+		items = line.split('\t')
+		try:
+			variant_id = items[indices['variant_id']]
+			pvalue = float(items[indices['p-value']])
+			beta = float(items[indices['beta']])
+		except (ValueError, IndexError):
+			continue
+		if variant_id not in res:
+			location = row_location(items, variant_id, indices.get('chromosome'), indices.get('base_pair_location'))
+			res[variant_id] = (None if location is None else location[1], pvalue, beta)
+	tabix_file.close()
+
+	logging.info("Read %i variants in %s:%i-%i from %s" % (len(res), chrom, start, end, filename))
+	return res
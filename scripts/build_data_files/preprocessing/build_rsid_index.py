@@ -0,0 +1,132 @@
+"""
+
+Copyright [1999-2018] EMBL-European Bioinformatics Institute
+
+Licensed under the Apache License, Version 2.0 (the "License")
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+		 http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+"""
+
+	Please email comments or questions to the public Ensembl
+	developers list at <http://lists.ensembl.org/mailman/listinfo/dev>.
+
+	Questions may also be sent to the Ensembl help desk at
+	<http://www.ensembl.org/Help/Contact>.
+
+"""
+
+"""
+
+	Reads a VCF file (dbSNP or 1000 Genomes) on STDIN and writes a binary
+	index from rsID to location, as numpy arrays sorted by rsID:
+	* PREFIX.rsids.npy: rsID numbers (uint32)
+	* PREFIX.chroms.npy: chromosome codes (uint8, see CHROMS)
+	* PREFIX.positions.npy: positions (uint32)
+
+	If the dbSNP merge history (RsMergeArch.bcp.gz) is provided, merged rsIDs
+	are also written, sorted by old rsID:
+	* PREFIX.merged_from.npy: old rsID numbers (uint32)
+	* PREFIX.merged_to.npy: current rsID numbers (uint32)
+
+	Usage: gzip -dc 00-common_all.vcf.gz | python build_rsid_index.py PREFIX [RsMergeArch.bcp.gz]
+
+	Only the first location of each rsID on the main chromosomes is kept.
+
+"""
+import sys
+import gzip
+import array
+import numpy
+
+# Must be kept in sync with postgap.Ensembl_lookup.known_chroms
+CHROMS = map(str, range(1,23)) + ['X','Y']
+CHROM_CODES = dict((chrom, code) for code, chrom in enumerate(CHROMS))
+
+def main():
+	prefix = sys.argv[1]
+
+	rsids = array.array('I')
+	chroms = array.array('B')
+	positions = array.array('I')
+
+	for line in sys.stdin:
+		if line[0] == '#':
+			continue
+		items = line.split('\t', 3)
+		chrom = items[0]
+		if chrom.startswith('chr'):
+			chrom = chrom[3:]
+		if chrom not in CHROM_CODES:
+			continue
+		for rsID in items[2].split(';'):
+			if rsID.startswith('rs') and rsID[2:].isdigit():
+				rsids.append(int(rsID[2:]))
+				chroms.append(CHROM_CODES[chrom])
+				positions.append(int(items[1]))
+
+	rsids = numpy.frombuffer(rsids, dtype=numpy.uint32)
+	# Stable sort, so that the first location of each rsID comes first
+	order = numpy.argsort(rsids, kind='mergesort')
+	rsids = rsids[order]
+	first = numpy.ones(len(rsids), dtype=bool)
+	first[1:] = rsids[1:] != rsids[:-1]
+	order = order[first]
+
+	numpy.save(prefix + '.rsids.npy', rsids[first])
+	numpy.save(prefix + '.chroms.npy', numpy.frombuffer(chroms, dtype=numpy.uint8)[order])
+	numpy.save(prefix + '.positions.npy', numpy.frombuffer(positions, dtype=numpy.uint32)[order])
+	sys.stderr.write("Indexed %i rsIDs\n" % (len(order)))
+
+	if len(sys.argv) > 2:
+		write_merged_rsids(prefix, sys.argv[2])
+
+def write_merged_rsids(prefix, filename):
+	"""
+
+		Writes the mapping from merged rsIDs to current rsIDs
+		Args:
+		* string (output prefix)
+		* string (RsMergeArch.bcp.gz filename)
+
+	"""
+	merged_from = array.array('I')
+	merged_to = array.array('I')
+
+	'''
+		RsMergeArch columns:
+		1. rsHigh (old rsID)
+		2. rsLow
+		3. build_id
+		4. orien
+		5. create_time
+		6. last_updated_time
+		7. rsCurrent
+		8. orien2Current
+		9. comment
+	'''
+	for line in gzip.open(filename):
+		items = line.split('\t')
+		if len(items) < 7 or not items[0].isdigit() or not items[6].isdigit():
+			continue
+		merged_from.append(int(items[0]))
+		merged_to.append(int(items[6]))
+
+	merged_from = numpy.frombuffer(merged_from, dtype=numpy.uint32)
+	order = numpy.argsort(merged_from, kind='mergesort')
+	numpy.save(prefix + '.merged_from.npy', merged_from[order])
+	numpy.save(prefix + '.merged_to.npy', numpy.frombuffer(merged_to, dtype=numpy.uint32)[order])
+	sys.stderr.write("Indexed %i merged rsIDs\n" % (len(order)))
+
+if __name__ == "__main__":
+	main()
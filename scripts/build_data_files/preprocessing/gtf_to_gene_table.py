@@ -0,0 +1,105 @@
+"""
+
+Copyright [1999-2018] EMBL-European Bioinformatics Institute
+
+Licensed under the Apache License, Version 2.0 (the "License")
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+		 http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+"""
+
+	Please email comments or questions to the public Ensembl
+	developers list at <http://lists.ensembl.org/mailman/listinfo/dev>.
+
+	Questions may also be sent to the Ensembl help desk at
+	<http://www.ensembl.org/Help/Contact>.
+
+"""
+
+"""
+
+	Reads an Ensembl GTF file on STDIN, writes a gene table on STDOUT:
+	1. gene ID
+	2. gene symbol
+	3. synonyms (comma separated)
+	4. chrom
+	5. TSS
+	6. strand
+	7. biotype
+
+	Usage: gzip -dc Homo_sapiens.GRCh37.87.gtf.gz | python gtf_to_gene_table.py [hgnc_complete_set.txt] > Ensembl_genes.GRCh37.tsv
+
+	Synonyms are the previous and alias symbols of the HGNC complete set,
+	if provided.
+
+"""
+import sys
+import re
+
+ATTRIBUTE_REGEX = re.compile('(\S+) "([^"]*)"')
+
+def main():
+	if len(sys.argv) > 1:
+		synonyms = read_hgnc_synonyms(sys.argv[1])
+	else:
+		synonyms = dict()
+
+	for line in sys.stdin:
+		if line.startswith('#'):
+			continue
+		items = line.rstrip('\n').split('\t')
+		if len(items) < 9 or items[2] != 'gene':
+			continue
+
+		attributes = dict(ATTRIBUTE_REGEX.findall(items[8]))
+		gene_id = attributes['gene_id']
+		symbol = attributes.get('gene_name', gene_id)
+		biotype = attributes.get('gene_biotype', attributes.get('gene_type', ''))
+		strand = items[6]
+		if strand == '+':
+			tss = items[3]
+		else:
+			tss = items[4]
+
+		print "\t".join([gene_id, symbol, ",".join(synonyms.get(gene_id, [])), items[0], tss, strand, biotype])
+
+def read_hgnc_synonyms(filename):
+	"""
+
+		Reads the previous and alias symbols from the HGNC complete set
+		Args:
+		* string (filename)
+		Returntype: dict(gene ID => [ string ])
+
+	"""
+	synonyms = dict()
+	file = open(filename)
+	header = file.readline().rstrip('\n').split('\t')
+	id_column = header.index('ensembl_gene_id')
+	synonym_columns = [header.index(column) for column in ['alias_symbol', 'prev_symbol'] if column in header]
+
+	for line in file:
+		items = line.rstrip('\n').split('\t')
+		if len(items) <= id_column or items[id_column] == '':
+			continue
+		gene_synonyms = []
+		for column in synonym_columns:
+			if len(items) > column and items[column] != '':
+				gene_synonyms += items[column].strip('"').split('|')
+		synonyms[items[id_column]] = gene_synonyms
+
+	file.close()
+	return synonyms
+
+if __name__ == "__main__":
+	main()
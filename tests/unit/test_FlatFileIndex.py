@@ -0,0 +1,114 @@
+# ------------------------------------------------
+# built-ins
+import os
+import sys
+import glob
+import shutil
+import tempfile
+import unittest
+
+# local
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'lib'))
+import postgap.Globals
+import postgap.FlatFileIndex
+# ------------------------------------------------
+
+# Unit tests of the flat file indexes, run with python 2:
+#   python -m unittest discover -s tests/unit
+
+HEADER = 'trait\tiris\tpvalue\n'
+LINES = [
+	'Obesity\tEFO_1,EFO_2\t1e-8\n',
+	'Asthma\tEFO_3\t1e-9\n',
+	'Obesity\tEFO_2\t0.5\n',
+	'Asthma\tEFO_3,EFO_3\tNA\n',
+	'Caf\xc3\xa9 au lait\t\t1e-10\n',
+]
+
+def get_keys(line):
+	items = line.rstrip('\n').split('\t')
+	return items[1].split(',') + [items[0]]
+
+def get_pvalue(line):
+	try:
+		return float(line.rstrip('\n').split('\t')[2])
+	except ValueError:
+		return None
+
+class TestFlatFileIndex(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.filename = os.path.join(self.directory, 'data', 'traits.txt')
+		os.mkdir(os.path.dirname(self.filename))
+		file = open(self.filename, 'w')
+		file.write(HEADER + ''.join(LINES))
+		file.close()
+		self.index_cache_dir = postgap.Globals.INDEX_CACHE_DIR
+		postgap.Globals.INDEX_CACHE_DIR = os.path.join(self.directory, 'cache')
+		postgap.FlatFileIndex.indexes.clear()
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+		postgap.Globals.INDEX_CACHE_DIR = self.index_cache_dir
+		postgap.FlatFileIndex.indexes.clear()
+
+	def index(self):
+		return postgap.FlatFileIndex.flat_file_index(self.filename, 'traits', get_keys, header_lines=1, pvalue_function=get_pvalue)
+
+	def test_lines(self):
+		index = self.index()
+
+		self.assertEqual(index.lines(['EFO_2']), [LINES[0], LINES[2]])
+		# Lines are read once, in file order, whichever keys they match
+		self.assertEqual(index.lines(['EFO_3', 'Obesity', 'EFO_1']), LINES[:4])
+		self.assertEqual(index.lines([u'Caf\xe9 au lait']), [LINES[4]])
+		self.assertEqual(index.lines(['EFO_4', 'a much longer key than any of the indexed ones']), [])
+
+	def test_pvalue_cutoff(self):
+		index = self.index()
+
+		self.assertEqual(index.lines(['Obesity'], 1e-4), [LINES[0]])
+		# Lines of unknown p-value are kept
+		self.assertEqual(index.lines(['EFO_3'], 1e-9), [LINES[3]])
+
+	def test_saved_next_to_file(self):
+		self.index()
+		self.assertTrue(os.path.exists(self.filename + '.traits.offsets.npy'))
+		self.assertFalse(os.path.exists(postgap.Globals.INDEX_CACHE_DIR))
+
+		index = self.index()
+		self.assertTrue(index.load(os.path.dirname(self.filename)))
+		self.assertEqual(index.lines(['EFO_2'], 1e-4), [LINES[0]])
+
+	def test_out_of_date(self):
+		self.index()
+		file = open(self.filename, 'a')
+		file.write('Gout\tEFO_5\t1e-5\n')
+		file.close()
+
+		index = postgap.FlatFileIndex.get_index(self.filename, 'traits', get_keys, header_lines=1)
+		self.assertEqual(index.lines(['EFO_5']), ['Gout\tEFO_5\t1e-5\n'])
+
+	def test_saved_in_cache(self):
+		# The data directory cannot be written: the temporary index file is taken by a directory
+		os.mkdir("%s.traits.keys.npy.%i.tmp" % (self.filename, os.getpid()))
+		self.index()
+
+		self.assertEqual(glob.glob(self.filename + '.traits.*.npy'), [])
+		self.assertEqual(len(glob.glob(os.path.join(postgap.Globals.INDEX_CACHE_DIR, 'traits.txt.*.traits.*.npy'))), 5)
+
+		index = self.index()
+		self.assertTrue(index.load(postgap.Globals.INDEX_CACHE_DIR))
+		self.assertEqual(index.lines(['Asthma']), [LINES[1], LINES[3]])
+
+	def test_kept_in_memory(self):
+		os.mkdir("%s.traits.keys.npy.%i.tmp" % (self.filename, os.getpid()))
+		postgap.Globals.INDEX_CACHE_DIR = None
+
+		index = self.index()
+		self.assertEqual(glob.glob(os.path.join(self.directory, '*', '*.npy')), [])
+		self.assertEqual(index.lines(['EFO_1']), [LINES[0]])
+
+if __name__ == '__main__':
+	unittest.main()
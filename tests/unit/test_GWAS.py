@@ -0,0 +1,288 @@
+# ------------------------------------------------
+# built-ins
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+# local
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'lib'))
+import postgap.Globals
+import postgap.REST
+import postgap.EFO
+import postgap.GWAS
+import postgap.SummaryStats
+# ------------------------------------------------
+
+# Unit tests of the GWAS Catalog adaptor, run with python 2:
+#   python -m unittest discover -s tests/unit
+
+API = 'http://www.ebi.ac.uk/gwas/rest/api'
+EFO = 'http://www.ebi.ac.uk/efo/EFO_0000400'
+EFO2 = 'http://www.ebi.ac.uk/efo/EFO_0001360'
+
+def association(id, pvalue):
+	return {
+		'pvalue': pvalue,
+		'pvalueDescription': None,
+		'range': '[1.1-1.3]',
+		'orPerCopyNum': 1.2,
+		'betaNum': None,
+		'betaUnit': None,
+		'betaDirection': None,
+		'loci': [],
+		'_links': {
+			'self': {'href': API + '/associations/%i{?projection}' % id},
+			'snps': {'href': API + '/associations/%i/snps' % id},
+			'study': {'href': API + '/associations/%i/study' % id},
+		}
+	}
+
+def study(accession, pubmed_id, associations):
+	return {
+		'accessionId': accession,
+		'publicationInfo': {'pubmedId': pubmed_id},
+		'diseaseTrait': {'trait': 'Type 2 diabetes'},
+		'ancestries': [{'numberOfIndividuals': 1000}, {'numberOfIndividuals': None}, {'numberOfIndividuals': 500}],
+		'_links': {'associations': {'href': API + '/studies/%s/associations{?projection}' % accession}},
+		'associations': associations,
+	}
+
+def catalog(study_listing=True, efo=EFO, trait=71, first=1):
+	"""
+		Responses of a trait with three associations, two of them from the
+		same study
+	"""
+	studies = [study('GCST%i' % first, '111', [first, first + 1]), study('GCST%i' % (first + 1), '222', [first + 2])]
+	responses = {
+		'http://www.ebi.ac.uk/gwas/rest/api/efoTraits/search/findByEfoUri?uri=' + efo: {'_embedded': {'efoTraits': [{
+			'trait': 'diabetes mellitus',
+			'_links': {
+				'associations': {'href': API + '/efoTraits/%i/associations' % trait},
+				'studies': {'href': API + '/efoTraits/%i/studies' % trait},
+			}
+		}]}},
+		API + '/efoTraits/%i/associations' % trait: {'_embedded': {'associations': [association(id, 1e-8) for id in range(first, first + 3)]}},
+	}
+	if study_listing:
+		responses[API + '/efoTraits/%i/studies' % trait] = {'_embedded': {'studies': studies}}
+	for current_study in studies:
+		listed = []
+		for id in current_study['associations']:
+			listed_association = association(id, None)
+			listed_association['snps'] = [{'rsId': 'rs%i' % id}]
+			listed.append(listed_association)
+		responses[API + '/studies/%s/associations?projection=associationByStudy' % current_study['accessionId']] = {'_embedded': {'associations': listed}}
+		for id in current_study['associations']:
+			responses[API + '/associations/%i/study' % id] = current_study
+			responses[API + '/associations/%i/snps' % id] = {'_embedded': {'singleNucleotidePolymorphisms': [{'rsId': 'rs%i' % id}]}}
+	return responses
+
+class catalog_test_case(unittest.TestCase):
+	"""
+		Serves canned GWAS Catalog responses, with empty caches
+	"""
+
+	def setUp(self):
+		self.get = postgap.REST.get
+		self.threads = postgap.Globals.GWAS_CATALOG_THREADS
+		self.orientations = postgap.GWAS.GWASCatalog.get_risk_allele_orientations
+		postgap.GWAS.GWASCatalog.get_risk_allele_orientations = lambda self, current_association: [True]
+		self.clear()
+
+	def clear(self):
+		for known in [postgap.GWAS.known_association_lists, postgap.GWAS.known_study_lists, postgap.GWAS.known_snp_lists, postgap.GWAS.known_studies, postgap.GWAS.known_association_studies, postgap.GWAS.known_association_snps]:
+			known.clear()
+		self.urls = []
+
+	def tearDown(self):
+		postgap.REST.get = self.get
+		postgap.Globals.GWAS_CATALOG_THREADS = self.threads
+		postgap.GWAS.GWASCatalog.get_risk_allele_orientations = self.orientations
+
+	def serve(self, responses):
+		def get(server, ext, data=None):
+			url = server + ext
+			self.urls.append(url)
+			if url not in responses:
+				raise postgap.REST.requests.exceptions.HTTPError(url)
+			return responses[url]
+		postgap.REST.get = get
+
+class TestGWASCatalog(catalog_test_case):
+
+	def test_studies_resolved_once(self):
+		self.serve(catalog())
+		associations = postgap.GWAS.GWASCatalog().run(['diabetes'], [EFO])
+
+		self.assertEqual([(association.snp, association.study, association.publication, association.sample_size) for association in associations], [
+			('rs1', 'GCST1', 'PMID111', 1500),
+			('rs2', 'GCST1', 'PMID111', 1500),
+			('rs3', 'GCST2', 'PMID222', 1500),
+		])
+		self.assertFalse(any(url.endswith('/study') or url.endswith('/snps') for url in self.urls))
+		self.assertEqual(len(self.urls), 5)
+
+	def test_fallback_without_study_listing(self):
+		self.serve(catalog(study_listing=False))
+		associations = postgap.GWAS.GWASCatalog().run(['diabetes'], [EFO])
+
+		self.assertEqual([(association.snp, association.study) for association in associations], [('rs1', 'GCST1'), ('rs2', 'GCST1'), ('rs3', 'GCST2')])
+		self.assertEqual(len([url for url in self.urls if url.endswith('/study')]), 3)
+
+	def test_terms_in_parallel(self):
+		responses = catalog()
+		responses.update(catalog(efo=EFO2, trait=72, first=10))
+		self.serve(responses)
+		postgap.Globals.GWAS_CATALOG_THREADS = 1
+		serial = postgap.GWAS.GWASCatalog().run(['diabetes'], [EFO, EFO2])
+		self.clear()
+		postgap.Globals.GWAS_CATALOG_THREADS = 4
+		parallel = postgap.GWAS.GWASCatalog().run(['diabetes'], [EFO, EFO2])
+
+		self.assertEqual(len(serial), 6)
+		self.assertEqual(parallel, serial)
+
+	def test_counts(self):
+		self.serve(catalog())
+		plan = postgap.GWAS.gwas_catalog_fetch_plan()
+		postgap.GWAS.GWASCatalog().query(EFO, plan.slots)
+		plan.resolve_studies(API + '/efoTraits/71/studies')
+
+		self.assertEqual(plan.requests['study listings'], 0)
+		self.assertEqual(plan.reused['study listings'], 1)
+		self.assertEqual(plan.reused['study association listings'], 2)
+
+OBESITY = 'http://www.ebi.ac.uk/efo/EFO_0001073'
+
+CATALOG_FILE_HEADER = ['PUBMEDID', 'DISEASE/TRAIT', 'INITIAL SAMPLE SIZE', 'REPLICATION SAMPLE SIZE', 'STRONGEST SNP-RISK ALLELE', 'SNPS', 'MERGED', 'CONTEXT', 'P-VALUE', 'P-VALUE (TEXT)', 'OR or BETA', '95% CI (TEXT)', 'MAPPED_TRAIT', 'MAPPED_TRAIT_URI', 'STUDY ACCESSION']
+CATALOG_FILE_ROWS = [
+	['111', 'Type 2 diabetes', '1,000 European ancestry cases', '500 European ancestry cases', 'rs1-A', 'rs1', '0', 'intron_variant', '1E-8', '', '1.2', '[1.1-1.3]', 'diabetes, type 2', EFO, 'GCST1'],
+	['222', 'Type 2 diabetes', '1,000 European ancestry individuals', '500 Japanese ancestry individuals', 'rs3-G', 'rs3', '0', 'missense_variant', '1E-10', '(EA)', '0.5', '[0.1-0.9] unit increase', 'diabetes, type 2, obesity', EFO + ', ' + OBESITY, 'GCST2'],
+]
+
+def catalog_hashes():
+	"""
+		REST responses holding the same associations as CATALOG_FILE_ROWS
+	"""
+	first = association(1, 1e-8)
+	first['loci'] = [{'strongestRiskAlleles': [{'riskAlleleName': 'rs1-A'}]}]
+	second = association(3, 1e-10)
+	second.update({'pvalueDescription': '(EA)', 'range': '[0.1-0.9]', 'orPerCopyNum': None, 'betaNum': 0.5, 'betaUnit': 'unit', 'betaDirection': 'increase'})
+	second['loci'] = [{'strongestRiskAlleles': [{'riskAlleleName': 'rs3-G'}]}]
+	studies = [study('GCST1', '111', [1]), study('GCST2', '222', [3])]
+	snps = {1: {'rsId': 'rs1', 'merged': 0, 'functionalClass': 'intron_variant'}, 3: {'rsId': 'rs3', 'merged': 0, 'functionalClass': 'missense_variant'}}
+
+	responses = {
+		'http://www.ebi.ac.uk/gwas/rest/api/efoTraits/search/findByEfoUri?uri=' + EFO: {'_embedded': {'efoTraits': [{
+			'trait': 'diabetes, type 2',
+			'_links': {
+				'associations': {'href': API + '/efoTraits/71/associations'},
+				'studies': {'href': API + '/efoTraits/71/studies'},
+			}
+		}]}},
+		API + '/efoTraits/71/associations': {'_embedded': {'associations': [first, second]}},
+		API + '/efoTraits/71/studies': {'_embedded': {'studies': studies}},
+	}
+	for current_study in studies:
+		listed = []
+		for id in current_study['associations']:
+			listed_association = association(id, None)
+			listed_association['snps'] = [snps[id]]
+			listed.append(listed_association)
+		responses[API + '/studies/%s/associations?projection=associationByStudy' % current_study['accessionId']] = {'_embedded': {'associations': listed}}
+	return responses
+
+class TestGWASCatalogFile(catalog_test_case):
+
+	def setUp(self):
+		catalog_test_case.setUp(self)
+		self.databases_dir = postgap.Globals.DATABASES_DIR
+		self.term = postgap.EFO.term
+		self.present = postgap.GWAS.gwas_risk_alleles_present_in_reference
+		# Only the allele of rs1 is in the reference
+		postgap.GWAS.GWASCatalog.get_risk_allele_orientations = self.orientations
+		postgap.GWAS.gwas_risk_alleles_present_in_reference = lambda risk_alleles: risk_alleles[0]['riskAlleleName'] == 'rs1-A'
+		postgap.EFO.term = lambda iri: self.fail('Looked up the term of ' + iri)
+
+		postgap.Globals.DATABASES_DIR = tempfile.mkdtemp()
+		file = open(os.path.join(postgap.Globals.DATABASES_DIR, 'GWAS_Catalog.txt'), 'w')
+		for row in [CATALOG_FILE_HEADER] + CATALOG_FILE_ROWS:
+			file.write('\t'.join(row) + '\n')
+		file.close()
+
+	def tearDown(self):
+		shutil.rmtree(postgap.Globals.DATABASES_DIR)
+		postgap.Globals.DATABASES_DIR = self.databases_dir
+		postgap.EFO.term = self.term
+		postgap.GWAS.gwas_risk_alleles_present_in_reference = self.present
+		catalog_test_case.tearDown(self)
+
+	def test_same_records_as_rest(self):
+		self.serve(catalog_hashes())
+		rest = postgap.GWAS.GWASCatalog().run(['diabetes'], [EFO])
+		self.urls = []
+		flat_file = postgap.GWAS.GWAS_Catalog_File().run(['diabetes'], [EFO])
+
+		self.assertEqual([association.risk_alleles_present_in_reference for association in rest], [True, False])
+		self.assertEqual(flat_file, rest)
+		self.assertEqual(self.urls, [])
+
+	def test_trait_names_with_commas(self):
+		# The name of EFO is read from the line mapped to it alone
+		associations = postgap.GWAS.GWAS_Catalog_File().run([], [EFO])
+		self.assertEqual(set(association.disease for association in associations), set([postgap.GWAS.Disease(name='diabetes, type 2', efo=EFO)]))
+
+		# The name of OBESITY cannot be told apart in the file
+		postgap.EFO.term = self.term
+		postgap.EFO.known_terms[OBESITY] = 'obesity'
+		try:
+			associations = postgap.GWAS.GWAS_Catalog_File().run([], [OBESITY])
+		finally:
+			del postgap.EFO.known_terms[OBESITY]
+		self.assertEqual([association.disease for association in associations], [postgap.GWAS.Disease(name='obesity', efo=OBESITY)])
+
+class TestGWASFile(unittest.TestCase):
+
+	def setUp(self):
+		self.summary_stats_file = postgap.Globals.GWAS_SUMMARY_STATS_FILE
+		self.batch_size = postgap.SummaryStats.BATCH_SIZE
+		self.directory = tempfile.mkdtemp()
+		postgap.Globals.GWAS_SUMMARY_STATS_FILE = os.path.join(self.directory, 'summary_stats.tsv')
+		file = open(postgap.Globals.GWAS_SUMMARY_STATS_FILE, 'w')
+		file.write('variant_id\tp-value\tbeta\n')
+		for index in range(10):
+			file.write('rs%i\t%g\t0.1\n' % (index, 10 ** -index))
+		file.close()
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+		postgap.Globals.GWAS_SUMMARY_STATS_FILE = self.summary_stats_file
+
+	def test_streamed(self):
+		batches = []
+		association_batches = postgap.SummaryStats.association_batches
+		def counted_batches(*args, **kwargs):
+			for batch in association_batches(*args, batch_size=2, **kwargs):
+				batches.append(batch)
+				yield batch
+		postgap.SummaryStats.association_batches = counted_batches
+		try:
+			associations = postgap.GWAS.GWAS_File().run([], [])
+			first = next(associations)
+			# Only the first batch has been read
+			self.assertEqual(len(batches), 1)
+			rest = list(associations)
+		finally:
+			postgap.SummaryStats.association_batches = association_batches
+
+		self.assertEqual([association.snp for association in [first] + rest], ['rs%i' % index for index in range(5, 10)])
+		self.assertEqual(len(batches), 3)
+
+	def test_no_file(self):
+		postgap.Globals.GWAS_SUMMARY_STATS_FILE = None
+		self.assertEqual(list(postgap.GWAS.GWAS_File().run_many({None: ([], [])})[None]), [])
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,147 @@
+# ------------------------------------------------
+# built-ins
+import os
+import sys
+import unittest
+
+# local
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'lib'))
+import postgap.Globals
+import postgap.LD
+from postgap.DataModel import *
+try:
+	import postgap.Integration
+except ImportError as e:
+	# Integration needs the full set of dependencies, e.g. pybedtools
+	postgap.Integration = None
+	missing_dependency = str(e)
+# ------------------------------------------------
+
+# Unit tests of the clustering of GWAS SNPs, run with python 2:
+#   python -m unittest discover -s tests/unit
+
+def gwas_snp(rsID, pos, pvalue):
+	return GWAS_SNP(
+		snp = SNP(rsID = rsID, chrom = '1', pos = pos, approximated_zscore = None),
+		pvalue = pvalue,
+		z_score = None,
+		evidence = [],
+		beta = None
+	)
+
+# SNPs in LD with each SNP, at r2 0.7 and 0.2
+LD = {
+	0.7: {'rs1': ['rs1', 'rs2'], 'rs2': ['rs1', 'rs2'], 'rs3': ['rs3'], 'rs4': ['rs4']},
+	0.2: {'rs1': ['rs1', 'rs2', 'rs3'], 'rs2': ['rs1', 'rs2', 'rs3'], 'rs3': ['rs1', 'rs2', 'rs3'], 'rs4': ['rs4']},
+}
+POSITIONS = {'rs1': 100, 'rs2': 200, 'rs3': 300, 'rs4': 5000000}
+
+@unittest.skipIf(postgap.Integration is None, 'Integration cannot be imported')
+class TestClumping(unittest.TestCase):
+
+	def setUp(self):
+		self.calculate_window = postgap.LD.calculate_window
+		self.windows = []
+		def calculate_window(snp, population, window_len=postgap.LD.WINDOW_LEN, cutoff=postgap.LD.R2_CUTOFF):
+			self.windows.append((snp.rsID, window_len, cutoff))
+			return [SNP(rsID = rsID, chrom = '1', pos = POSITIONS[rsID], approximated_zscore = None) for rsID in LD[cutoff][snp.rsID]]
+		postgap.LD.calculate_window = calculate_window
+
+	def tearDown(self):
+		postgap.LD.calculate_window = self.calculate_window
+
+	def clusters(self, preclusters):
+		return [([(gwas_snp.snp.rsID, gwas_snp.pvalue) for gwas_snp in precluster.gwas_snps], sorted(ld_snp.rsID for ld_snp in precluster.ld_snps)) for precluster in preclusters]
+
+	def test_clumping(self):
+		gwas_snps = [gwas_snp('rs3', 300, 1e-6), gwas_snp('rs2', 200, 1e-9), gwas_snp('rs1', 100, 1e-8), gwas_snp('rs4', 5000000, 1e-7)]
+		preclusters = postgap.Integration.clump_gwas_snps(gwas_snps, 'EUR', postgap.LD.WINDOW_LEN, 0.7)
+
+		self.assertEqual(self.clusters(preclusters), [
+			([('rs2', 1e-9), ('rs1', 1e-8)], ['rs1', 'rs2']),
+			([('rs4', 1e-7)], ['rs4']),
+			([('rs3', 1e-6)], ['rs3']),
+		])
+		# The LD expansion is reused for clumping with the same parameters
+		self.assertEqual(len(self.windows), 3)
+
+	def test_clumping_parameters(self):
+		gwas_snps = [gwas_snp('rs3', 300, 1e-6), gwas_snp('rs2', 200, 1e-9), gwas_snp('rs4', 5000000, 1e-7)]
+		preclusters = postgap.Integration.clump_gwas_snps(gwas_snps, 'EUR', 100000, 0.2)
+
+		# rs3 is clumped at r2 0.2, and added to the LD SNPs of the lead SNP
+		self.assertEqual(self.clusters(preclusters), [
+			([('rs2', 1e-9), ('rs3', 1e-6)], ['rs1', 'rs2', 'rs3']),
+			([('rs4', 1e-7)], ['rs4']),
+		])
+		self.assertTrue(('rs2', 100000, 0.2) in self.windows)
+
+	def test_same_snp_kept(self):
+		gwas_snps = [gwas_snp('rs1', 100, 1e-8), gwas_snp('rs1', 100, 1e-6), gwas_snp('rs4', 5000000, 1e-7)]
+		preclusters = postgap.Integration.clump_gwas_snps(gwas_snps, 'EUR', postgap.LD.WINDOW_LEN, 0.7)
+
+		self.assertEqual(self.clusters(preclusters), [
+			([('rs1', 1e-8), ('rs1', 1e-6)], ['rs1', 'rs2']),
+			([('rs4', 1e-7)], ['rs4']),
+		])
+
+	def test_defaults(self):
+		window, r2 = postgap.Globals.CLUMP_WINDOW, postgap.Globals.CLUMP_R2
+		postgap.Globals.CLUMP_WINDOW, postgap.Globals.CLUMP_R2 = 100000, 0.2
+		try:
+			postgap.Integration.clump_gwas_snps([gwas_snp('rs1', 100, 1e-8)], 'EUR')
+		finally:
+			postgap.Globals.CLUMP_WINDOW, postgap.Globals.CLUMP_R2 = window, r2
+
+		self.assertEqual(self.windows, [('rs1', postgap.LD.WINDOW_LEN, postgap.LD.R2_CUTOFF), ('rs1', 100000, 0.2)])
+
+def association(snp, pvalue, efo):
+	return GWAS_Association(
+		snp = snp,
+		disease = Disease(name = efo, efo = efo),
+		reported_trait = efo,
+		pvalue = pvalue,
+		pvalue_description = None,
+		sample_size = 1000,
+		source = 'Test',
+		publication = None,
+		study = None,
+		odds_ratio = None,
+		odds_ratio_ci_start = None,
+		odds_ratio_ci_end = None,
+		beta_coefficient = None,
+		beta_coefficient_unit = None,
+		beta_coefficient_direction = None,
+		rest_hash = None,
+		risk_alleles_present_in_reference = None
+	)
+
+@unittest.skipIf(postgap.Integration is None, 'Integration cannot be imported')
+class TestScanMany(unittest.TestCase):
+
+	def setUp(self):
+		self.get_filtered_subclasses = postgap.Integration.postgap.GWAS.get_filtered_subclasses
+		self.adaptors = postgap.Globals.GWAS_adaptors
+		self.calls = []
+		calls = self.calls
+		class test_source(postgap.Integration.postgap.GWAS.GWAS_source):
+			display_name = 'Test'
+			def run_many(self, queries):
+				calls.append(sorted(queries))
+				return dict((query_id, [association('rs%i' % len(efos), 1e-8, efo) for efo in efos] + [association('rs9', 0.5, 'weak')]) for query_id, (diseases, efos) in queries.items())
+		postgap.Globals.GWAS_adaptors = ['Test']
+		postgap.Integration.postgap.GWAS.get_filtered_subclasses = lambda adaptors: [test_source]
+
+	def tearDown(self):
+		postgap.Integration.postgap.GWAS.get_filtered_subclasses = self.get_filtered_subclasses
+		postgap.Globals.GWAS_adaptors = self.adaptors
+
+	def test_one_scan(self):
+		res = postgap.Integration.diseases_to_gwas_snps_many({'a': ([], ['EFO_1']), 'b': ([], ['EFO_2', 'EFO_3'])})
+
+		self.assertEqual(self.calls, [['a', 'b']])
+		self.assertEqual(dict((query_id, [gwas_snp.snp.rsID for gwas_snp in gwas_snps]) for query_id, gwas_snps in res.items()), {'a': ['rs1'], 'b': ['rs2']})
+		self.assertEqual([gwas_snp.snp.rsID for gwas_snp in postgap.Integration.diseases_to_gwas_snps([], ['EFO_1'])], ['rs1'])
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,117 @@
+# ------------------------------------------------
+# built-ins
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+# local
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'lib'))
+import postgap.Globals
+import postgap.LD
+from postgap.DataModel import SNP
+# ------------------------------------------------
+
+# Unit tests of the LD windows, run with python 2:
+#   python -m unittest discover -s tests/unit
+
+# Pairs of variants in LD on chromosome 1: position, ID, position, ID, r2
+PAIRS = [
+	(600, 'rs0', 1000, 'rs1', 0.75),
+	(600, 'rs0', 1500, 'rs3', 0.99),
+	(1000, 'rs1', 1200, 'rs2', 0.9),
+	(1000, 'rs1', 1500, 'rs3', 0.8),
+	(1200, 'rs2', 1500, 'rs3', 0.5),
+	(1500, 'rs3', 1900, 'rs4', 0.95),
+]
+
+class ld_vcf(object):
+	"""
+
+		Stands for the ld_vcf process: reports the pairs of the region
+		which involve any of the listed variants, once per listed variant
+
+	"""
+	runs = []
+
+	def __init__(self, command, stdout=None):
+		arguments = dict(zip(command[1::2], command[2::2]))
+		chrom, region = arguments['-r'].split(':')
+		start, end = map(int, region.split('-'))
+		variants = arguments['-v'].split(',')
+		window = int(arguments['-w'])
+		ld_vcf.runs.append(arguments['-r'])
+
+		lines = []
+		for pos1, id1, pos2, id2, r2 in PAIRS:
+			if chrom == '1' and start <= pos1 <= end and start <= pos2 <= end and abs(pos2 - pos1) <= window:
+				for variant in variants:
+					if variant in (id1, id2):
+						lines.append("1\t0\t%i\t%s\t%i\t%s\t%f\n" % (pos1, id1, pos2, id2, r2))
+		self.output = ''.join(lines)
+
+	def communicate(self):
+		return self.output, None
+
+	def wait(self):
+		return 0
+
+def snp(rsID, pos):
+	return SNP(rsID=rsID, chrom='1', pos=pos, approximated_zscore=None)
+
+def locations(snps):
+	return sorted((snp.pos, snp.rsID) for snp in snps)
+
+class TestLD(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.databases_dir = postgap.Globals.DATABASES_DIR
+		postgap.Globals.DATABASES_DIR = self.directory
+		os.makedirs(os.path.join(self.directory, '1000Genomes', 'EUR'))
+		open(os.path.join(self.directory, '1000Genomes', 'EUR', 'ALL.chr1.phase3_shapeit2_mvncall_integrated_v5a.20130502.genotypes.bcf'), 'w').close()
+		self.popen = postgap.LD.Popen
+		postgap.LD.Popen = ld_vcf
+		ld_vcf.runs = []
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+		postgap.Globals.DATABASES_DIR = self.databases_dir
+		postgap.LD.Popen = self.popen
+
+	def test_same_as_single_windows(self):
+		snps = [snp('rs1', 1000), snp('rs3', 1500), snp('rs5', 1800), snp('rs1', 1000)]
+
+		windows = postgap.LD.calculate_windows(snps, 'EUR', window_len=1000)
+		self.assertEqual(ld_vcf.runs, ['1:500-2300'])
+
+		self.assertEqual([locations(window) for window in windows], [locations(postgap.LD.calculate_window(gwas_snp, 'EUR', window_len=1000)) for gwas_snp in snps])
+		self.assertEqual([locations(window) for window in windows], [
+			[(600, 'rs0'), (1000, 'rs1'), (1200, 'rs2'), (1500, 'rs3')],
+			# rs0 is in the region, but outside the window of rs3
+			[(1000, 'rs1'), (1500, 'rs3'), (1900, 'rs4')],
+			[(1800, 'rs5')],
+			[(600, 'rs0'), (1000, 'rs1'), (1200, 'rs2'), (1500, 'rs3')],
+		])
+
+	def test_cutoff(self):
+		windows = postgap.LD.calculate_windows([snp('rs1', 1000), snp('rs2', 1200)], 'EUR', window_len=1000, cutoff=0.85)
+
+		self.assertEqual([locations(window) for window in windows], [
+			[(1000, 'rs1'), (1200, 'rs2')],
+			[(1000, 'rs1'), (1200, 'rs2')],
+		])
+
+	def test_single_snp(self):
+		self.assertEqual(locations(postgap.LD.calculate_windows([snp('rs4', 1900)], 'EUR', window_len=1000)[0]), [(1500, 'rs3'), (1900, 'rs4')])
+		self.assertEqual(ld_vcf.runs, ['1:1400-2400'])
+
+	def test_no_bcf_file(self):
+		snps = [snp('rs1', 1000), snp('rs3', 1500)]
+
+		self.assertEqual(postgap.LD.calculate_windows(snps, 'AFR', window_len=1000), [[snps[0]], [snps[1]]])
+		self.assertEqual(ld_vcf.runs, [])
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,101 @@
+# ------------------------------------------------
+# built-ins
+import os
+import sys
+import gzip
+import shutil
+import tempfile
+import unittest
+
+# local
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'lib'))
+import postgap.Globals
+import postgap.Liftover
+from postgap.DataModel import SNP, Gene
+# ------------------------------------------------
+
+# Unit tests of the GRCh37 to GRCh38 conversions, run with python 2:
+#   python -m unittest discover -s tests/unit
+
+CHAIN = '''chain 1000 chr1 5000 + 0 300 chr1 6000 + 1000 1310 1
+100 10 20
+190
+
+chain 900 chr2 500 + 0 50 chr3 1000 - 100 150 2
+50
+
+chain 800 chr5 5000 + 0 1000 chr5 9000 + 5000 6000 3
+1000
+
+chain 700 chr5 5000 + 100 110 chr6 100 + 0 10 4
+10
+
+chain 600 chrM 100 + 0 100 chrM 100 + 0 100 5
+100
+'''
+
+class TestLiftover(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.databases_dir = postgap.Globals.DATABASES_DIR
+		postgap.Globals.DATABASES_DIR = self.directory
+		file = gzip.open(os.path.join(self.directory, postgap.Liftover.CHAIN_FILE), 'wb')
+		file.write(CHAIN)
+		file.close()
+		postgap.Liftover.chain_indexes.clear()
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+		postgap.Globals.DATABASES_DIR = self.databases_dir
+		postgap.Liftover.chain_indexes.clear()
+
+	def test_convert(self):
+		index = postgap.Liftover.get_chain_index()
+
+		self.assertTrue(postgap.Liftover.get_chain_index() is index)
+		self.assertEqual(index.convert(['1', '1', '1', '1', '1', '4'], [1, 100, 101, 110, 111, 1]), [
+			('1', 1001),
+			('1', 1100),
+			# Gap between two blocks
+			None,
+			None,
+			('1', 1121),
+			# Unknown chromosome
+			None,
+		])
+
+	def test_reverse_strand(self):
+		self.assertEqual(postgap.Liftover.get_chain_index().convert(['2', '2', '2'], [1, 50, 51]), [('3', 900), ('3', 851), None])
+
+	def test_overlapping_blocks(self):
+		# Positions past a short block may lie in an earlier, longer block
+		self.assertEqual(postgap.Liftover.get_chain_index().convert(['5', '5', '5', '5'], [50, 101, 501, 1001]), [('5', 5050), ('6', 1), ('5', 5501), None])
+
+	def test_lift_snps(self):
+		snps = [
+			SNP(rsID='rs1', chrom='1', pos=1, approximated_zscore=None),
+			SNP(rsID='rs2', chrom='1', pos=105, approximated_zscore=None),
+			SNP(rsID='rs3', chrom='MT', pos=10, approximated_zscore=1.5),
+		]
+
+		self.assertTrue(postgap.Liftover.available())
+		self.assertEqual(postgap.Liftover.lift_snps(iter(snps)), [
+			SNP(rsID='rs1', chrom='1', pos=1001, approximated_zscore=None),
+			SNP(rsID='rs3', chrom='MT', pos=10, approximated_zscore=1.5),
+		])
+		self.assertEqual(postgap.Liftover.lift_snps([]), [])
+
+	def test_lift_gene(self):
+		gene = Gene(name='GENE', id='ENSG1', chrom='2', tss=1, biotype='protein_coding')
+
+		self.assertEqual(postgap.Liftover.lift_gene(gene), gene._replace(chrom='3', tss=900))
+		self.assertEqual(postgap.Liftover.lift_gene(gene._replace(tss=51)), None)
+
+	def test_no_chain_file(self):
+		os.remove(os.path.join(self.directory, postgap.Liftover.CHAIN_FILE))
+
+		self.assertFalse(postgap.Liftover.available())
+
+if __name__ == '__main__':
+	unittest.main()
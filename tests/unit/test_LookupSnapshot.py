@@ -0,0 +1,105 @@
+# ------------------------------------------------
+# built-ins
+import os
+import sys
+import time
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+# local
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'lib'))
+import postgap.Globals
+import postgap.LookupSnapshot
+from postgap.DataModel import Gene
+# ------------------------------------------------
+
+# Unit tests of the lookup snapshots, run with python 2:
+#   python -m unittest discover -s tests/unit
+
+GENE = Gene(name='BRCA2', id='ENSG00000139618', chrom='13', tss=32315474, biotype='protein_coding')
+
+class TestLookupSnapshot(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.lookup_snapshot_file = postgap.Globals.LOOKUP_SNAPSHOT_FILE
+		postgap.Globals.LOOKUP_SNAPSHOT_FILE = os.path.join(self.directory, 'work', 'ensembl_lookups.sqlite')
+		self.snapshots = []
+
+	def tearDown(self):
+		for snapshot in self.snapshots:
+			postgap.LookupSnapshot.snapshots.remove(snapshot)
+		shutil.rmtree(self.directory)
+		postgap.Globals.LOOKUP_SNAPSHOT_FILE = self.lookup_snapshot_file
+
+	def snapshot(self):
+		snapshot = postgap.LookupSnapshot.persistent_dict('genes', Gene)
+		self.snapshots.append(snapshot)
+		return snapshot
+
+	def test_round_trip(self):
+		snapshot = self.snapshot()
+		snapshot[('BRCA2', 'Homo_sapiens')] = GENE
+		snapshot.set_missing(('FOO', 'Homo_sapiens'))
+		snapshot[('BAR', 'Homo_sapiens')] = None
+		snapshot.cache(('BAZ', 'Homo_sapiens'), GENE)
+		postgap.LookupSnapshot.flush_all()
+
+		reloaded = self.snapshot()
+		self.assertEqual(reloaded.get(('BRCA2', 'Homo_sapiens')), GENE)
+		self.assertEqual(type(reloaded[('BRCA2', 'Homo_sapiens')].name), str)
+		# Confirmed misses are kept, failures and cached entries are not
+		self.assertTrue(('FOO', 'Homo_sapiens') in reloaded)
+		self.assertEqual(reloaded[('FOO', 'Homo_sapiens')], None)
+		self.assertFalse(('BAR', 'Homo_sapiens') in reloaded)
+		self.assertFalse(('BAZ', 'Homo_sapiens') in reloaded)
+
+	def test_flush_interval(self):
+		snapshot = self.snapshot()
+		for i in range(postgap.LookupSnapshot.FLUSH_INTERVAL):
+			snapshot[('GENE%i' % i, 'Homo_sapiens')] = GENE._replace(name = 'GENE%i' % i)
+
+		self.assertEqual(snapshot.pending, [])
+		self.assertEqual(self.snapshot().get(('GENE7', 'Homo_sapiens')), GENE._replace(name = 'GENE7'))
+
+	def test_negative_ttl(self):
+		snapshot = self.snapshot()
+		snapshot.set_missing(('FOO', 'Homo_sapiens'))
+		snapshot.set_missing(('BAR', 'Homo_sapiens'))
+		snapshot.flush()
+
+		connection = sqlite3.connect(postgap.Globals.LOOKUP_SNAPSHOT_FILE)
+		with connection:
+			connection.execute('UPDATE lookups SET created = ? WHERE key = ?', (time.time() - postgap.LookupSnapshot.NEGATIVE_TTL - 1, '["FOO", "Homo_sapiens"]'))
+		connection.close()
+
+		reloaded = self.snapshot()
+		self.assertFalse(('FOO', 'Homo_sapiens') in reloaded)
+		self.assertTrue(('BAR', 'Homo_sapiens') in reloaded)
+
+	def test_change_of_file(self):
+		snapshot = self.snapshot()
+		snapshot[('BRCA2', 'Homo_sapiens')] = GENE
+
+		# Pending entries go to the file they were read for
+		postgap.Globals.LOOKUP_SNAPSHOT_FILE = os.path.join(self.directory, 'other.sqlite')
+		self.assertEqual(snapshot.get(('BRCA2', 'Homo_sapiens')), GENE)
+		self.assertEqual(snapshot.pending, [])
+		self.assertFalse(('BRCA2', 'Homo_sapiens') in self.snapshot())
+
+		postgap.Globals.LOOKUP_SNAPSHOT_FILE = os.path.join(self.directory, 'work', 'ensembl_lookups.sqlite')
+		self.assertEqual(self.snapshot().get(('BRCA2', 'Homo_sapiens')), GENE)
+
+	def test_no_file(self):
+		postgap.Globals.LOOKUP_SNAPSHOT_FILE = None
+		snapshot = self.snapshot()
+		snapshot[('BRCA2', 'Homo_sapiens')] = GENE
+		snapshot.flush()
+
+		self.assertEqual(snapshot.pending, [])
+		self.assertEqual(os.listdir(self.directory), [])
+
+if __name__ == '__main__':
+	unittest.main()
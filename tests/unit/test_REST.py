@@ -0,0 +1,195 @@
+# ------------------------------------------------
+# built-ins
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import unittest
+import StringIO
+
+# pipped
+import requests
+import requests.adapters
+import requests.structures
+
+# local
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'lib'))
+import postgap.Globals
+import postgap.REST
+import postgap.RESTFixtures
+# ------------------------------------------------
+
+# Unit tests of the REST client, run with python 2:
+#   python -m unittest discover -s tests/unit
+
+SERVER = 'http://circuit.example'
+
+class scripted_adapter(requests.adapters.BaseAdapter):
+	"""
+	Transport answering each query with the next status of a list,
+	or raising the next exception of the list.
+	"""
+
+	def __init__(self, answers):
+		super(scripted_adapter, self).__init__()
+		self.answers = list(answers)
+		self.urls = []
+
+	def send(self, request, **kwargs):
+		self.urls.append(request.url)
+		answer = self.answers.pop(0)
+		if isinstance(answer, Exception):
+			raise answer
+		status, headers = answer
+		response = requests.models.Response()
+		response.status_code = status
+		response.reason = 'scripted'
+		response.headers = requests.structures.CaseInsensitiveDict(headers)
+		response.url = request.url
+		response.request = request
+		response.raw = StringIO.StringIO(json.dumps({'status': status}))
+		return response
+
+	def close(self):
+		pass
+
+class TestCircuitBreaker(unittest.TestCase):
+
+	def setUp(self):
+		self.backoff = postgap.REST.backoff
+		postgap.REST.backoff = lambda retries: None
+		postgap.REST.host_healths.clear()
+		postgap.REST.sessions.clear()
+		postgap.REST.run_retries = postgap.REST.retry_budget()
+
+	def tearDown(self):
+		postgap.REST.backoff = self.backoff
+		postgap.REST.host_healths.clear()
+		postgap.REST.sessions.clear()
+
+	def mount(self, answers):
+		adapter = scripted_adapter(answers)
+		session = requests.Session()
+		session.mount('http://', adapter)
+		postgap.REST.sessions[SERVER] = session
+		return adapter
+
+	def open_circuit(self):
+		host = postgap.REST.get_host_health(SERVER)
+		host.opened_at = time.time() - postgap.REST.CIRCUIT_COOLDOWN - 1
+		return host
+
+	def test_probe_answered_404_closes_circuit(self):
+		host = self.open_circuit()
+		self.mount([(404, {}), (200, {})])
+
+		with self.assertRaises(requests.exceptions.HTTPError):
+			postgap.REST.fetch(SERVER, '/missing')
+		self.assertIsNone(host.probing)
+		self.assertIsNone(host.opened_at)
+
+		self.assertEqual(postgap.REST.fetch(SERVER, '/present'), {'status': 200})
+
+	def test_probe_answered_429_probes_again(self):
+		host = self.open_circuit()
+		adapter = self.mount([(429, {'Retry-After': '0'}), (200, {})])
+
+		self.assertEqual(postgap.REST.fetch(SERVER, '/busy'), {'status': 200})
+		self.assertEqual(len(adapter.urls), 2)
+		self.assertIsNone(host.opened_at)
+
+	def test_probe_interrupted_by_exception_is_released(self):
+		host = self.open_circuit()
+		self.mount([ValueError('unexpected'), (200, {})])
+
+		with self.assertRaises(ValueError):
+			postgap.REST.fetch(SERVER, '/broken')
+		self.assertIsNone(host.probing)
+
+		self.assertEqual(postgap.REST.fetch(SERVER, '/fixed'), {'status': 200})
+
+	def test_failed_probe_keeps_circuit_open(self):
+		host = self.open_circuit()
+		self.mount([(502, {})])
+
+		with self.assertRaises(postgap.REST.CircuitOpen):
+			postgap.REST.fetch(SERVER, '/down')
+		self.assertIsNotNone(host.opened_at)
+
+class TestBatches(unittest.TestCase):
+
+	def setUp(self):
+		self.backoff = postgap.REST.backoff
+		postgap.REST.backoff = lambda retries: None
+		postgap.REST.host_healths.clear()
+		postgap.REST.sessions.clear()
+		postgap.REST.batch_sizers.clear()
+
+	def tearDown(self):
+		postgap.REST.backoff = self.backoff
+		postgap.REST.host_healths.clear()
+		postgap.REST.sessions.clear()
+		postgap.REST.batch_sizers.clear()
+
+	def test_rejected_batch_is_split_without_retries(self):
+		# Batch of 4 rejected, then halves: [a, b] answered, [c, d] rejected, [c] answered, [d] rejected
+		adapter = scripted_adapter([(400, {}), (200, {}), (400, {}), (200, {}), (400, {})])
+		session = requests.Session()
+		session.mount('http://', adapter)
+		postgap.REST.sessions[SERVER] = session
+
+		batches = postgap.REST.post_in_batches(SERVER, '/bulk', 'ids', ['a', 'b', 'c', 'd'], 16)
+		self.assertEqual([batch for batch, response in batches], [['a', 'b'], ['c']])
+		self.assertEqual(len(adapter.urls), 5)
+		self.assertEqual(postgap.REST.get_batch_sizer(SERVER, '/bulk', 16).size, 4)
+
+class TestReplay(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		postgap.Globals.REST_REPLAY_DIR = self.directory
+		postgap.REST.host_healths.clear()
+		postgap.REST.sessions.clear()
+
+	def tearDown(self):
+		postgap.Globals.REST_REPLAY_DIR = None
+		postgap.REST.host_healths.clear()
+		postgap.REST.sessions.clear()
+		shutil.rmtree(self.directory)
+
+	def test_missing_fixture_during_probe(self):
+		postgap.RESTFixtures.save_fixture(self.directory, 'GET', SERVER + '/recorded', None, 200, {}, json.dumps({'recorded': True}))
+		host = postgap.REST.get_host_health(SERVER)
+		host.opened_at = time.time() - postgap.REST.CIRCUIT_COOLDOWN - 1
+
+		with self.assertRaises(postgap.RESTFixtures.missing_fixture_exception):
+			postgap.REST.fetch(SERVER, '/not_recorded')
+		self.assertEqual(postgap.REST.fetch(SERVER, '/recorded'), {'recorded': True})
+
+	def test_replay_is_not_rate_limited(self):
+		postgap.RESTFixtures.save_fixture(self.directory, 'GET', SERVER + '/recorded', None, 200, {}, json.dumps({'recorded': True}))
+		rate_limiter = postgap.REST.get_rate_limiter(SERVER)
+		rate_limiter.pause(60)
+
+		start_time = time.time()
+		postgap.REST.fetch(SERVER, '/recorded')
+		self.assertLess(time.time() - start_time, 1)
+		rate_limiter.paused_until = 0
+
+class TestRetryBudget(unittest.TestCase):
+
+	def test_budget_refills_over_time(self):
+		budget = postgap.REST.retry_budget()
+		self.assertTrue(budget.spend(2))
+		self.assertTrue(budget.spend(2))
+		self.assertFalse(budget.spend(2))
+
+		# Half a period later, half the budget is back
+		budget.timestamp -= postgap.REST.RETRY_BUDGET_PERIOD / 2
+		self.assertTrue(budget.spend(2))
+		self.assertFalse(budget.spend(2))
+
+if __name__ == '__main__':
+	unittest.main()
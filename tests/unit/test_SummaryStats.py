@@ -0,0 +1,121 @@
+# ------------------------------------------------
+# built-ins
+import os
+import sys
+import gzip
+import shutil
+import tempfile
+import unittest
+
+# local
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'lib'))
+import postgap.SummaryStats
+from postgap.DataModel import SNP
+# ------------------------------------------------
+
+# Unit tests of the summary statistics readers, run with python 2:
+#   python -m unittest discover -s tests/unit
+
+HEADER = ['variant_id', 'p-value', 'beta', 'chromosome', 'base_pair_location']
+ROWS = [
+	['rs5', '0.1', '1', '1', '100'],
+	['1_200_A_G', '0.2', '2', '1', '200'],
+	['rs5', '0.9', '9', '1', '100'],
+	['X:300', '0.3', '3', 'NA', 'NA'],
+	['foo', '0.4', '4', 'NA', 'NA'],
+	['rs3', '0.5', '5', '2', '50'],
+	['rs7', 'NA', '7', '2', '70'],
+]
+
+def snp(rsID, chrom=None, pos=None):
+	return SNP(rsID=rsID, chrom=chrom, pos=pos, approximated_zscore=None)
+
+class TestSummaryStats(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.filename = self.write('summary_stats.tsv', [HEADER] + ROWS)
+		postgap.SummaryStats.stores.clear()
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+		postgap.SummaryStats.stores.clear()
+
+	def write(self, name, rows, compress=False):
+		filename = os.path.join(self.directory, name)
+		if compress:
+			file = gzip.open(filename, 'wb')
+		else:
+			file = open(filename, 'w')
+		file.write(''.join('\t'.join(row) + '\n' for row in rows))
+		file.close()
+		return filename
+
+	def test_batches(self):
+		filename = self.write('summary_stats.tsv.gz', [HEADER] + ROWS, compress=True)
+		batches = list(postgap.SummaryStats.association_batches(filename, pvalue_threshold=0.45, batch_size=2))
+
+		self.assertEqual([[(association.snp, association.pvalue, association.beta_coefficient) for association in batch] for batch in batches], [
+			[('rs5', 0.1, 1.0), ('1_200_A_G', 0.2, 2.0)],
+			[('X:300', 0.3, 3.0), ('foo', 0.4, 4.0)],
+		])
+
+	def test_missing_column(self):
+		filename = self.write('no_beta.tsv', [['variant_id', 'p-value'], ['rs1', '0.1']])
+		self.assertRaises(postgap.SummaryStats.summary_stats_format_exception, postgap.SummaryStats.summary_stats_store, filename)
+
+	def test_store(self):
+		store = postgap.SummaryStats.get_store(self.filename)
+
+		self.assertTrue(postgap.SummaryStats.get_store(self.filename) is store)
+		self.assertEqual(store.get([snp('rs5', '1', 100), snp('rs3'), snp('rs4', '1', 1), snp('rs7', '2', 70)]), {
+			'rs5': (0.1, 1.0),
+			'rs3': (0.5, 5.0),
+		})
+
+	def test_store_by_position(self):
+		store = postgap.SummaryStats.get_store(self.filename)
+
+		# Rows without an rsID are found by the position of their columns or of their ID
+		self.assertEqual(store.get([snp('rs8', 'chr1', 200), snp('x', 'X', 300), snp('y', 'X', 301), snp('rs9')]), {
+			'rs8': (0.2, 2.0),
+			'x': (0.3, 3.0),
+		})
+		# Rows with an rsID are not found by position
+		self.assertEqual(store.get([snp('rs9', '2', 50)]), {})
+
+	def test_windows(self):
+		self.assertEqual(postgap.SummaryStats.snp_windows([500, 100, 20000, 105], max_gap=1000), [(100, 500), (20000, 20000)])
+		self.assertEqual(postgap.SummaryStats.snp_windows([]), [])
+
+	def test_tabix_matches_store(self):
+		regions = []
+		def region_results(filename, chrom, start, end):
+			regions.append((chrom, start, end))
+			res = dict()
+			for row in ROWS:
+				try:
+					location = (row[3], int(row[4]))
+				except ValueError:
+					location = postgap.SummaryStats.row_location(row, row[0], None, None)
+				if location is not None and location[0] == chrom and start <= location[1] <= end and row[0] not in res and row[1] != 'NA':
+					res[row[0]] = (location[1], float(row[1]), float(row[2]))
+			return res
+
+		self.write('summary_stats.tsv.tbi', [])
+		load_pysam = postgap.SummaryStats.load_pysam
+		original_region_results = postgap.SummaryStats.region_results
+		postgap.SummaryStats.load_pysam = lambda: True
+		postgap.SummaryStats.region_results = region_results
+		try:
+			snps = [snp('rs5', '1', 100), snp('rs8', 'chr1', 200), snp('x', 'X', 300), snp('rs3', '2', 50), snp('rs9', '2', 50), snp('rs4', '1', 50000)]
+			tabix = postgap.SummaryStats.get_snp_results(self.filename, snps)
+		finally:
+			postgap.SummaryStats.load_pysam = load_pysam
+			postgap.SummaryStats.region_results = original_region_results
+
+		self.assertEqual(tabix, postgap.SummaryStats.get_store(self.filename).get(snps))
+		self.assertEqual(sorted(regions), [('1', 100, 200), ('1', 50000, 50000), ('2', 50, 50), ('X', 300, 300)])
+
+if __name__ == '__main__':
+	unittest.main()